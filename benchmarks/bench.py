@@ -0,0 +1,232 @@
+"""Benchmark pockexport-to-anki against fake AnkiConnect and Pocket APIs.
+
+For each export size, writes a synthetic pockexport data file, fills a fake
+Anki collection with notes for most of its items, and runs a full sync (or
+an incremental one with `--incremental`) in a separate process. With
+`--from-pocket`, the items are served by the fake Pocket API instead, and
+read with `--from-pocket`. Reports the
+wall time, throughput, requests made to each API and the peak RSS of the
+sync process. Nothing outside of a temporary directory is read or written.
+
+Examples:
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --items 10000 --anki-latency-ms 2 -- --concurrency 4
+
+Arguments after `--` are passed on to pockexport-to-anki.
+"""
+
+import argparse
+import json
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+from fake_ankiconnect import FakeAnkiConnect, FakeCollection
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+def run_one(n, args, workdir):
+    items = synthetic.make_items(n, seed=args.seed)
+    export_path = os.path.join(workdir, "export.json")
+    sync_args = [export_path]
+    if args.from_pocket:
+        mirror_path = os.path.join(workdir, "pocket_items.sqlite3")
+        sync_args = ["--from-pocket", "--pocket-mirror", mirror_path]
+        if args.incremental:
+            # Mirror all but the 1% of the items updated last, which are read
+            # from the fake Pocket API.
+            sys.path.insert(0, REPO_DIR)
+            from pockexport_to_anki.pocket_source import PocketSource
+
+            since = sorted(int(item["time_updated"]) for item in items.values())[
+                -max(1, n // 100)
+            ]
+            mirror = PocketSource(None, mirror_path)
+            mirror.record(
+                [item for item in items.values() if int(item["time_updated"]) < since],
+                since,
+            )
+            # As synced by a previous run.
+            mirror.done()
+            mirror.close()
+    elif args.incremental:
+        # The old export is the current one with some items reverted and the
+        # newest ones missing.
+        old_items = synthetic.mutate_items(items, 0.01, seed=args.seed)
+        for item_id in sorted(old_items)[-max(1, n // 100) :]:
+            del old_items[item_id]
+        old_export_path = os.path.join(workdir, "export-old.json")
+        synthetic.write_export(old_export_path, old_items)
+        sync_args.append(old_export_path)
+    synthetic.write_export(export_path, items)
+    if args.store:
+        # Convert the exports before the sync, which is what is timed.
+        sys.path.insert(0, REPO_DIR)
+        from pockexport_to_anki.store import convert_export
+
+        for i, path in enumerate(sync_args):
+            store_path = os.path.splitext(path)[0] + ".pxstore"
+            convert_export(path, store_path)
+            sync_args[i] = store_path
+    collection = FakeCollection()
+    synthetic.populate_collection(collection, items, args.anki_fraction, seed=args.seed)
+    del items
+
+    home = os.path.join(workdir, "home")
+    os.makedirs(os.path.join(home, ".config", "pockexport"), exist_ok=True)
+    with open(os.path.join(home, ".config", "pockexport", "secrets.py"), "w") as f:
+        f.write('consumer_key = "bench"\naccess_token = "bench"\n')
+    metrics_path = os.path.join(workdir, "metrics.json")
+    report_path = os.path.join(workdir, "report.json")
+    sync_args += ["--metrics-out", metrics_path] + args.sync_args
+
+    server = FakeAnkiConnect(collection, args.anki_latency_ms / 1000).start()
+    env = dict(
+        os.environ,
+        HOME=home,
+        XDG_STATE_HOME=os.path.join(workdir, "state"),
+        PYTHONPATH=os.pathsep.join([REPO_DIR, BENCHMARKS_DIR]),
+        POCKEXPORT_TO_ANKI_ANKICONNECT_URL=server.url,
+        POCKEXPORT_TO_ANKI_LOGLEVEL=args.log_level,
+    )
+    if args.from_pocket:
+        env["BENCH_POCKET_ITEMS"] = export_path
+    env.pop("POCKEXPORT_TO_ANKI_DEBUG", None)
+    command = [
+        sys.executable,
+        os.path.join(BENCHMARKS_DIR, "sync_child.py"),
+        report_path,
+        str(args.pocket_latency_ms / 1000),
+        "--",
+    ] + sync_args
+    try:
+        start = time.perf_counter()
+        subprocess.run(command, env=env, check=True)
+        seconds = time.perf_counter() - start
+    finally:
+        server.stop()
+    with open(report_path) as f:
+        report = json.load(f)
+    with open(metrics_path) as f:
+        metrics = json.load(f)
+    return {
+        "items": n,
+        "seconds": seconds,
+        "items_per_second": n / seconds if seconds else 0.0,
+        "peak_rss_bytes": report["peak_rss_bytes"],
+        "anki_requests": server.requests,
+        "anki_actions": dict(sorted(server.actions.items())),
+        "pocket_requests": report["pocket_requests"],
+        "pocket_actions": dict(sorted(report["pocket_actions"].items())),
+        "phases": metrics["phases"],
+    }
+
+
+def print_result(result):
+    print(
+        f"{result['items']:>8} items  {result['seconds']:8.2f}s"
+        f"  {result['items_per_second']:9.1f} items/s"
+        f"  peak RSS {result['peak_rss_bytes'] / (1 << 20):7.1f} MiB"
+        f"  Anki {result['anki_requests']} requests"
+        f"  Pocket {result['pocket_requests']} requests"
+    )
+    print(
+        "    Anki actions: "
+        + ", ".join(f"{k}={v}" for k, v in result["anki_actions"].items())
+    )
+    if result["pocket_actions"]:
+        print(
+            "    Pocket actions: "
+            + ", ".join(f"{k}={v}" for k, v in result["pocket_actions"].items())
+        )
+    print(
+        "    Phases: " + ", ".join(f"{k}={v:.2f}s" for k, v in result["phases"].items())
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--items",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="Export sizes to benchmark. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--anki-latency-ms",
+        type=float,
+        default=0.0,
+        help="Latency added to each AnkiConnect request",
+    )
+    parser.add_argument(
+        "--pocket-latency-ms",
+        type=float,
+        default=0.0,
+        help="Latency added to each Pocket API request",
+    )
+    parser.add_argument(
+        "--anki-fraction",
+        type=float,
+        default=0.9,
+        help="Fraction of the Pocket items that already have an Anki note. "
+        "Default: %(default)s",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Also pass an older export, with 1%% of the items changed and 1%% "
+        "missing. With --from-pocket, read only the 1%% of the items updated last.",
+    )
+    parser.add_argument(
+        "--from-pocket",
+        action="store_true",
+        help="Serve the items from the fake Pocket API rather than an export "
+        "file. The peak RSS then includes the items held by the fake.",
+    )
+    parser.add_argument(
+        "--store",
+        action="store_true",
+        help="Convert the exports to export stores, and sync from those.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--log-level",
+        default="warning",
+        help="Log level of the sync. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--json-out",
+        default=None,
+        help="Also write the results to this file as JSON",
+    )
+    parser.add_argument("sync_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if args.sync_args[:1] == ["--"]:
+        args.sync_args = args.sync_args[1:]
+    if args.store and args.from_pocket:
+        parser.error("--store reads exports, not the fake Pocket API")
+
+    results = []
+    for n in args.items:
+        with tempfile.TemporaryDirectory(prefix="pockexport-to-anki-bench-") as d:
+            result = run_one(n, args, d)
+        print_result(result)
+        results.append(result)
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+"""In-process fake of the AnkiConnect HTTP API.
+
+Implements the subset of AnkiConnect actions, and of the Anki search syntax,
+that pockexport-to-anki uses, on top of an in-memory collection. Every
+request can be delayed by a fixed latency to simulate a slow Anki.
+"""
+
+import collections
+import json
+import re
+import shlex
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NOTE_FIELDS = (
+    "item_id",
+    "given_url",
+    "given_title",
+    "resolved_url",
+    "resolved_title",
+    "time_added",
+    "word_count",
+    "time_to_read",
+    "excerpt",
+    "authors",
+    "time_last_synced",
+)
+
+# Card types and queues, as in Anki.
+CARD_TYPE_NEW = 0
+CARD_TYPE_LEARN = 1
+CARD_TYPE_REVIEW = 2
+CARD_TYPE_RELEARN = 3
+QUEUES_LEARN = (1, 3)
+QUEUE_SUSPENDED = -1
+QUEUES_BURIED = (-2, -3)
+
+
+class AnkiConnectError(Exception):
+    pass
+
+
+def _wildcard_regex(pattern):
+    """Compile an Anki search wildcard pattern (`*` and `_`) to a regex."""
+    parts = []
+    for ch in pattern:
+        if ch == "*":
+            parts.append(".*")
+        elif ch == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(ch))
+    return re.compile("".join(parts), re.IGNORECASE | re.DOTALL)
+
+
+class FakeCollection:
+    """In-memory Anki collection with one card per note."""
+
+    def __init__(self, deck_name="Articles", model_name="Pocket Article"):
+        self.deck_name = deck_name
+        self.model_name = model_name
+        self.notes = dict()
+        self.cards = dict()
+        # Map the first field of each note to the IDs of the notes having it,
+        # for duplicate checks.
+        self.first_field = collections.defaultdict(set)
+        self._next_id = int(time.time() * 1000)
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def add_note(
+        self,
+        fields,
+        tags=(),
+        model_name=None,
+        deck_name=None,
+        card_type=CARD_TYPE_NEW,
+        queue=0,
+        due=None,
+        mod=None,
+    ):
+        note_id = self._new_id()
+        card_id = self._new_id()
+        mod = int(time.time()) if mod is None else mod
+        note_fields = dict((name, "") for name in NOTE_FIELDS)
+        note_fields.update(fields)
+        self.notes[note_id] = {
+            "noteId": note_id,
+            "modelName": model_name or self.model_name,
+            "fields": note_fields,
+            "tags": sorted(set(tags)),
+            "cards": [card_id],
+            "mod": mod,
+        }
+        self.cards[card_id] = {
+            "cardId": card_id,
+            "note": note_id,
+            "deckName": deck_name or self.deck_name,
+            "type": card_type,
+            "queue": queue,
+            "due": len(self.cards) if due is None else due,
+            "mod": mod,
+        }
+        self.first_field[
+            (self.notes[note_id]["modelName"], note_fields["item_id"])
+        ].add(note_id)
+        return note_id
+
+    def _touch_note(self, note_id):
+        self.notes[note_id]["mod"] = int(time.time())
+
+    def _note_info(self, note_id):
+        note = self.notes.get(note_id)
+        if note is None:
+            return dict()
+        return {
+            "noteId": note_id,
+            "modelName": note["modelName"],
+            "tags": list(note["tags"]),
+            "fields": dict(
+                (name, {"value": value, "order": i})
+                for i, (name, value) in enumerate(note["fields"].items())
+            ),
+            "cards": list(note["cards"]),
+            "mod": note["mod"],
+        }
+
+    def _card_info(self, card_id):
+        card = self.cards.get(card_id)
+        if card is None:
+            return dict()
+        note = self.notes[card["note"]]
+        return {
+            "cardId": card_id,
+            "note": card["note"],
+            "deckName": card["deckName"],
+            "modelName": note["modelName"],
+            "fields": dict(
+                (name, {"value": value, "order": i})
+                for i, (name, value) in enumerate(note["fields"].items())
+            ),
+            "type": card["type"],
+            "queue": card["queue"],
+            "due": card["due"],
+            "mod": card["mod"],
+        }
+
+    def _term_matcher(self, term):
+        """Return a function of `(note, card)` that matches search `term`."""
+        negate = term.startswith("-")
+        if negate:
+            term = term[1:]
+        key, sep, value = term.partition(":")
+        key = key.lower()
+        if not sep:
+            raise AnkiConnectError(f"unsupported search term {term!r}")
+        if key == "note":
+            regex = _wildcard_regex(value)
+
+            def match(note, card):
+                return bool(regex.fullmatch(note["modelName"]))
+
+        elif key == "deck":
+            regex = _wildcard_regex(value)
+
+            def match(note, card):
+                return bool(regex.fullmatch(card["deckName"]))
+
+        elif key == "edited":
+            cutoff = time.time() - int(value) * 86400
+
+            def match(note, card):
+                return note["mod"] >= cutoff
+
+        elif key == "is":
+            states = {
+                "new": lambda card: card["type"] == CARD_TYPE_NEW,
+                "learn": lambda card: card["queue"] in QUEUES_LEARN,
+                "review": lambda card: (
+                    card["type"] in (CARD_TYPE_REVIEW, CARD_TYPE_RELEARN)
+                ),
+                "suspended": lambda card: card["queue"] == QUEUE_SUSPENDED,
+                "buried": lambda card: card["queue"] in QUEUES_BURIED,
+            }
+            if value not in states:
+                raise AnkiConnectError(f"unsupported search term {term!r}")
+            state = states[value]
+
+            def match(note, card):
+                return state(card)
+
+        elif value == "":
+
+            def match(note, card):
+                return note["fields"].get(key, "") == ""
+
+        else:
+            regex = _wildcard_regex(value)
+
+            def match(note, card):
+                return key in note["fields"] and bool(
+                    regex.fullmatch(note["fields"][key])
+                )
+
+        if negate:
+
+            def negated(note, card):
+                return not match(note, card)
+
+            return negated
+        return match
+
+    def _search_cards(self, query):
+        matchers = [self._term_matcher(term) for term in shlex.split(query)]
+        return [
+            card_id
+            for card_id, card in self.cards.items()
+            if all(m(self.notes[card["note"]], card) for m in matchers)
+        ]
+
+    def _can_add(self, note):
+        key = (note["modelName"], note["fields"].get("item_id", ""))
+        return bool(key[1]) and not self.first_field.get(key)
+
+    def _add(self, note):
+        if not self._can_add(note):
+            raise AnkiConnectError("cannot create note because it is a duplicate")
+        return self.add_note(
+            note["fields"],
+            note.get("tags", ()),
+            model_name=note["modelName"],
+            deck_name=note["deckName"],
+        )
+
+    def _update_fields(self, note_id, fields):
+        note = self.notes[note_id]
+        key = (note["modelName"], note["fields"]["item_id"])
+        self.first_field[key].discard(note_id)
+        note["fields"].update(fields)
+        key = (note["modelName"], note["fields"]["item_id"])
+        self.first_field[key].add(note_id)
+        self._touch_note(note_id)
+
+    def invoke(self, action, params):
+        if action == "multi":
+            results = []
+            for a in params["actions"]:
+                try:
+                    result = self.invoke(a["action"], a.get("params") or dict())
+                    results.append({"result": result, "error": None})
+                except (AnkiConnectError, KeyError) as e:
+                    results.append({"result": None, "error": str(e)})
+            return results
+        if action == "version":
+            return 6
+        if action == "sync":
+            return None
+        if action == "findNotes":
+            return sorted(
+                set(self.cards[c]["note"] for c in self._search_cards(params["query"]))
+            )
+        if action == "findCards":
+            return sorted(self._search_cards(params["query"]))
+        if action == "notesInfo":
+            return [self._note_info(note_id) for note_id in params["notes"]]
+        if action == "cardsInfo":
+            return [self._card_info(card_id) for card_id in params["cards"]]
+        if action == "notesModTime":
+            return [
+                {"noteId": note_id, "mod": self.notes[note_id]["mod"]}
+                for note_id in params["notes"]
+                if note_id in self.notes
+            ]
+        if action == "cardsModTime":
+            return [
+                {"cardId": card_id, "mod": self.cards[card_id]["mod"]}
+                for card_id in params["cards"]
+                if card_id in self.cards
+            ]
+        if action == "canAddNotes":
+            return [self._can_add(note) for note in params["notes"]]
+        if action == "addNote":
+            return self._add(params["note"])
+        if action == "addNotes":
+            results = []
+            for note in params["notes"]:
+                try:
+                    results.append(self._add(note))
+                except AnkiConnectError:
+                    results.append(None)
+            return results
+        if action == "updateNoteFields":
+            self._update_fields(params["note"]["id"], params["note"]["fields"])
+            return None
+        if action == "updateNoteTags":
+            note_id = params["note"]
+            self.notes[note_id]["tags"] = sorted(set(params["tags"]))
+            self._touch_note(note_id)
+            return None
+        if action in ("addTags", "removeTags"):
+            tags = set(params["tags"].split())
+            for note_id in params["notes"]:
+                note = self.notes[note_id]
+                if action == "addTags":
+                    note["tags"] = sorted(set(note["tags"]) | tags)
+                else:
+                    note["tags"] = sorted(set(note["tags"]) - tags)
+                self._touch_note(note_id)
+            return None
+        if action == "setSpecificValueOfCard":
+            card = self.cards[params["card"]]
+            for key, value in zip(params["keys"], params["newValues"]):
+                card[key] = value
+            card["mod"] = int(time.time())
+            return [True] * len(params["keys"])
+        raise AnkiConnectError(f"unsupported action {action}")
+
+
+class FakeAnkiConnect:
+    """HTTP server answering AnkiConnect requests from a `FakeCollection`.
+
+    Each request is delayed by `latency` seconds before it is handled.
+    Requests are handled one at a time, like in Anki, but their latencies
+    overlap.
+    """
+
+    def __init__(self, collection, latency=0.0):
+        self.collection = collection
+        self.latency = latency
+        self.requests = 0
+        # Number of actions of each kind, counting those inside `multi`.
+        self.actions = collections.Counter()
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _count(self, action, params):
+        self.actions[action] += 1
+        if action == "multi":
+            for a in params.get("actions", []):
+                self._count(a["action"], a.get("params") or dict())
+
+    def handle(self, body):
+        if self.latency:
+            time.sleep(self.latency)
+        request = json.loads(body)
+        action = request["action"]
+        params = request.get("params") or dict()
+        with self._lock:
+            self.requests += 1
+            self._count(action, params)
+            try:
+                return {"result": self.collection.invoke(action, params), "error": None}
+            except (AnkiConnectError, KeyError) as e:
+                return {"result": None, "error": str(e)}
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # The headers and the body are written separately; without this,
+            # small responses on a kept-alive connection wait for the
+            # client's delayed ACK.
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                data = json.dumps(fake.handle(body)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
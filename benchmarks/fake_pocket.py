@@ -0,0 +1,140 @@
+"""Stub of `pocket.Pocket` that answers API requests locally.
+
+`install` replaces `pocket.Pocket` with `FakePocket`, so that code creating
+a Pocket client afterwards talks to an in-memory list of items instead of
+getpocket.com.
+"""
+
+import collections
+import json
+import threading
+import time
+
+import pocket
+import requests
+
+
+class FakePocket(pocket.Pocket):
+    # Shared by all instances, since `_post_request` is called on the class
+    # by `pocket.Pocket._make_request`.
+    items = dict()
+    latency = 0.0
+    request_count = 0
+    actions = collections.Counter()
+    _lock = threading.Lock()
+    _next_item_id = 1 << 40
+
+    @classmethod
+    def _post_request(cls, url, payload, headers):
+        if cls.latency:
+            time.sleep(cls.latency)
+        if isinstance(payload, (str, bytes)):
+            payload = json.loads(payload)
+        endpoint = url.rsplit("/", 1)[-1]
+        with cls._lock:
+            cls.request_count += 1
+            if endpoint == "send":
+                body = cls._send(payload["actions"])
+            elif endpoint == "get":
+                body = cls._get(payload)
+            else:
+                body = {"status": 0, "error": f"unsupported endpoint {endpoint}"}
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["Content-Type"] = "application/json"
+        response._content = json.dumps(body).encode()
+        return response
+
+    @classmethod
+    def _send(cls, actions):
+        now = str(int(time.time()))
+        results = []
+        for action in actions:
+            cls.actions[action["action"]] += 1
+            if action["action"] == "add":
+                cls._next_item_id += 1
+                item = {
+                    "item_id": str(cls._next_item_id),
+                    "given_url": action["url"],
+                    "given_title": action.get("title", ""),
+                    "resolved_url": action["url"],
+                    "title": action.get("title", ""),
+                    "time_added": now,
+                    "time_updated": now,
+                    "favorite": "0",
+                    "status": "0",
+                    "authors": [],
+                    "tags": dict(
+                        (tag, {"item_id": str(cls._next_item_id), "tag": tag})
+                        for tag in action.get("tags", "").split(",")
+                        if tag
+                    ),
+                }
+                cls.items[item["item_id"]] = item
+                results.append(item)
+                continue
+            item = cls.items.get(str(action.get("item_id")))
+            if item is None:
+                # Items are only tracked if given to `install`; accept
+                # actions on all others.
+                results.append(True)
+                continue
+            item["time_updated"] = now
+            tags = [tag for tag in action.get("tags", "").split(",") if tag]
+            if action["action"] == "archive":
+                item["status"] = "1"
+            elif action["action"] == "readd":
+                item["status"] = "0"
+            elif action["action"] == "favorite":
+                item["favorite"] = "1"
+                item["time_favorited"] = now
+            elif action["action"] == "unfavorite":
+                item["favorite"] = "0"
+                item["time_favorited"] = now
+            elif action["action"] == "tags_replace":
+                item["tags"] = dict((tag, {"tag": tag}) for tag in tags)
+            elif action["action"] == "tags_add":
+                item.setdefault("tags", dict()).update(
+                    (tag, {"tag": tag}) for tag in tags
+                )
+            elif action["action"] == "tags_remove":
+                for tag in tags:
+                    item.get("tags", dict()).pop(tag, None)
+            results.append(True)
+        return {
+            "status": 1,
+            "action_results": results,
+            "action_errors": [None] * len(results),
+        }
+
+    @classmethod
+    def _get(cls, params):
+        cls.actions["get"] += 1
+        since = int(params.get("since") or 0)
+        items = [
+            item
+            for item in cls.items.values()
+            if int(item.get("time_updated", 0)) >= since
+        ]
+        offset = int(params.get("offset") or 0)
+        count = params.get("count")
+        if count:
+            items = items[offset : offset + int(count)]
+        else:
+            items = items[offset:]
+        return {
+            "status": 1,
+            "complete": 1,
+            "list": dict((item["item_id"], item) for item in items),
+            "error": None,
+            "since": int(time.time()),
+        }
+
+
+def install(items=None, latency=0.0):
+    """Replace `pocket.Pocket` with `FakePocket` serving `items`, a dict of
+    Pocket items keyed by item ID.
+    """
+    FakePocket.items = items if items is not None else dict()
+    FakePocket.latency = latency
+    pocket.Pocket = FakePocket
@@ -0,0 +1,60 @@
+"""Run one sync against the fake Pocket API and report its peak RSS.
+
+Run by `bench.py` in a separate process, so that the peak RSS measured is
+that of the sync alone. Usage:
+
+    sync_child.py REPORT_PATH POCKET_LATENCY_SECS -- SYNC_ARGS...
+
+`POCKEXPORT_TO_ANKI_ANKICONNECT_URL` must point to the fake AnkiConnect
+server, and `HOME` to a directory with a `.config/pockexport/secrets.py`. If
+`BENCH_POCKET_ITEMS` is set, the fake Pocket API serves the items of that
+pockexport data file.
+"""
+
+import json
+import os
+import resource
+import sys
+
+import fake_pocket
+
+
+def main():
+    report_path, pocket_latency, sep, *sync_args = sys.argv[1:]
+    assert sep == "--"
+    # Unless the sync reads them from the Pocket API, items are not loaded
+    # into the fake, so that they don't count towards the peak RSS of the
+    # sync.
+    items = None
+    if os.environ.get("BENCH_POCKET_ITEMS"):
+        with open(os.environ["BENCH_POCKET_ITEMS"]) as f:
+            items = json.load(f)["list"]
+    fake_pocket.install(items, latency=float(pocket_latency))
+
+    import pockexport_to_anki
+
+    sys.argv = ["pockexport-to-anki"] + sync_args
+    exit_code = 0
+    try:
+        pockexport_to_anki.main()
+    except SystemExit as e:
+        exit_code = e.code or 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        # Linux reports kilobytes, macOS bytes.
+        max_rss *= 1024
+    with open(report_path, "w") as f:
+        json.dump(
+            {
+                "exit_code": exit_code,
+                "peak_rss_bytes": max_rss,
+                "pocket_requests": fake_pocket.FakePocket.request_count,
+                "pocket_actions": dict(fake_pocket.FakePocket.actions),
+            },
+            f,
+        )
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
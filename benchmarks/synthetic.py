@@ -0,0 +1,155 @@
+"""Synthetic pockexport data and a matching Anki collection."""
+
+import json
+import random
+import time
+
+from fake_ankiconnect import CARD_TYPE_NEW, CARD_TYPE_REVIEW, QUEUE_SUSPENDED
+
+TAGS = ("python", "anki", "science", "history", "longread", "todo", "math")
+AUTHORS = ("Ada Lovelace", "Alan Turing", "Grace Hopper", "Claude Shannon")
+
+
+def make_items(n, seed=0):
+    """Return a dict of `n` random Pocket items, keyed by item ID."""
+    rng = random.Random(seed)
+    now = int(time.time())
+    items = dict()
+    for i in range(n):
+        item_id = str(1000000 + i)
+        time_added = now - rng.randint(86400, 5 * 365 * 86400)
+        time_updated = time_added + rng.randint(0, 86400)
+        favorite = rng.random() < 0.1
+        tags = rng.sample(TAGS, rng.randint(0, 3))
+        authors = rng.sample(AUTHORS, rng.randint(0, 2))
+        url = f"https://example.com/{i}/article-{rng.getrandbits(32):08x}"
+        items[item_id] = {
+            "item_id": item_id,
+            "resolved_id": item_id,
+            "given_url": url,
+            "given_title": f"Article {i}",
+            "favorite": "1" if favorite else "0",
+            "status": "1" if rng.random() < 0.6 else "0",
+            "time_added": str(time_added),
+            "time_updated": str(time_updated),
+            "time_read": "0",
+            "time_favorited": str(time_updated) if favorite else "0",
+            "sort_id": i,
+            "resolved_title": f"Article {i}: A Synthetic Story",
+            "resolved_url": url,
+            "excerpt": " ".join(rng.choice(TAGS) for _ in range(40)),
+            "is_article": "1",
+            "is_index": "0",
+            "has_video": "0",
+            "has_image": "1",
+            "word_count": str(rng.randint(100, 10000)),
+            "lang": "en",
+            "time_to_read": rng.randint(1, 40),
+            "top_image_url": f"https://example.com/{i}/image.jpg",
+            "tags": dict(
+                (tag, {"item_id": item_id, "tag": tag}) for tag in sorted(tags)
+            ),
+            "authors": dict(
+                (
+                    str(j),
+                    {
+                        "item_id": item_id,
+                        "author_id": str(j),
+                        "name": name,
+                        "url": "",
+                    },
+                )
+                for j, name in enumerate(authors)
+            ),
+            "image": {"item_id": item_id, "src": "", "width": "0", "height": "0"},
+            "listen_duration_estimate": rng.randint(60, 3000),
+        }
+    return items
+
+
+def write_export(path, items):
+    """Write `items` to `path` in the format of pockexport."""
+    data = {
+        "status": 1,
+        "complete": 1,
+        "list": items,
+        "error": None,
+        "search_meta": {"search_type": "normal"},
+        "since": int(time.time()),
+    }
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+def mutate_items(items, fraction, seed=0):
+    """Return a copy of `items` with `fraction` of them changed."""
+    rng = random.Random(seed)
+    items = dict(items)
+    now = str(int(time.time()))
+    for item_id in rng.sample(sorted(items), int(len(items) * fraction)):
+        item = dict(items[item_id])
+        item["time_updated"] = now
+        if rng.random() < 0.5:
+            item["favorite"] = "0" if item["favorite"] == "1" else "1"
+            item["time_favorited"] = now
+        else:
+            item["status"] = "0" if item["status"] == "1" else "1"
+        items[item_id] = item
+    return items
+
+
+def populate_collection(collection, items, fraction=0.9, anki_only=0.01, seed=0):
+    """Add notes to `collection` for `fraction` of `items`.
+
+    About 5% of the notes get a stale title and different tags, so that the
+    sync has fields and tags to update. `anki_only` times as many notes as
+    there are items are added without an item ID, as if created in Anki, so
+    that the sync has items to add to Pocket.
+    """
+    rng = random.Random(seed)
+    synced = str(int(time.time()) - 3600)
+    for item in items.values():
+        if rng.random() >= fraction:
+            continue
+        tags = list(item["tags"])
+        if item["favorite"] == "1":
+            tags.append("marked")
+        title = item["given_title"]
+        if rng.random() < 0.05:
+            title += " (old)"
+            tags = rng.sample(TAGS, rng.randint(0, 2))
+        r = rng.random()
+        if r < 0.6:
+            card_type, queue = CARD_TYPE_NEW, 0
+        elif r < 0.9:
+            card_type, queue = CARD_TYPE_REVIEW, 2
+        else:
+            card_type, queue = CARD_TYPE_REVIEW, QUEUE_SUSPENDED
+        collection.add_note(
+            {
+                "item_id": item["item_id"],
+                "given_url": item["given_url"],
+                "given_title": title,
+                "resolved_url": item["resolved_url"],
+                "resolved_title": item["resolved_title"],
+                "time_added": item["time_added"],
+                "word_count": item["word_count"],
+                "time_to_read": str(item["time_to_read"]),
+                "excerpt": item["excerpt"],
+                "authors": ", ".join(
+                    sorted(author["name"] for author in item["authors"].values())
+                ),
+                "time_last_synced": synced,
+            },
+            tags,
+            card_type=card_type,
+            queue=queue,
+        )
+    for i in range(int(len(items) * anki_only)):
+        collection.add_note(
+            {
+                "given_url": f"https://example.org/anki/{i}",
+                "given_title": f"Added in Anki {i}",
+            },
+            ["todo"],
+        )
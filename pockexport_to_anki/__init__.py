@@ -1,24 +1,94 @@
 import argparse
-import copy
+import itertools
 import json
 import logging
 import os
 import os.path
 import pathlib
-import pdb
-import pocket
-import pprint
-import random
-import re
-import requests
 import sys
+import threading
 import time
-import traceback
 
 import importlib.machinery
 import importlib.util
 
-from itertools import islice
+# Only modules that are cheap to import are imported here. `requests`,
+# `pocket`, `asyncio`, `sqlite3` and the like are imported where they are
+# first needed, so that importing this package and `--help` stay fast.
+from pockexport_to_anki.ankiconnect import AnkiConnect, AnkiWriteBuffer
+from pockexport_to_anki.metrics import metrics
+from pockexport_to_anki.execute import (
+    apply_card_order,
+    apply_field_updates,
+    apply_note_updates,
+    apply_pocket_actions,
+    apply_pocket_adds,
+    create_notes,
+    failed_items,
+    find_notes_without_items,
+)
+from pockexport_to_anki.export import iter_changed_items, iter_export_items
+from pockexport_to_anki.mapping import (
+    DEFAULT_DECK,
+    DEFAULT_NOTE_TYPE,
+    FieldMap,
+    NoteMapping,
+)
+from pockexport_to_anki.model import AnkiCard, AnkiNote, CardStates, PocketItem, _int
+from pockexport_to_anki.plan import (
+    ANKI_SUSPENDED_TAG,
+    FAVORITE_TAG,
+    FAVORITE_TAG_ID,
+    ItemPlan,
+    SyncPlan,
+    plan_item,
+    plan_pocket_adds,
+    plan_sync,
+    reconcile_note,
+)
+from pockexport_to_anki.reorder import (
+    DEFAULT_STRATEGY,
+    RECENT_FRACTION,
+    STRATEGIES,
+    due_updates,
+    make_rng,
+    order_new_cards,
+)
+
+__all__ = [
+    "ANKI_SUSPENDED_TAG",
+    "FAVORITE_TAG",
+    "AnkiCard",
+    "AnkiNote",
+    "CardStates",
+    "FieldMap",
+    "ItemPlan",
+    "NoteMapping",
+    "PocketItem",
+    "SyncPlan",
+    "apply_card_order",
+    "apply_field_updates",
+    "apply_note_updates",
+    "apply_pocket_actions",
+    "apply_pocket_adds",
+    "create_notes",
+    "due_updates",
+    "find_notes_without_items",
+    "get_anki",
+    "get_anki_writes",
+    "get_pocket_client",
+    "get_secrets",
+    "main",
+    "make_rng",
+    "order_new_cards",
+    "plan_item",
+    "plan_pocket_adds",
+    "plan_sync",
+    "reconcile_note",
+    "sync",
+    "use_collection",
+    "use_read_cache",
+]
 
 # Create logger that logs to standard error
 logger = logging.getLogger("pockexport-to-anki")
@@ -44,52 +114,173 @@ handler.setFormatter(formatter)
 # Add handler to the logger
 logger.addHandler(handler)
 
-# Load secrets from pockexport for use by pocket module.
-loader = importlib.machinery.SourceFileLoader(
-    "secrets", os.path.expanduser("~/.config/pockexport/secrets.py")
-)
-spec = importlib.util.spec_from_loader("secrets", loader)
-secrets = importlib.util.module_from_spec(spec)
-loader.exec_module(secrets)
-
-ANKI_SUSPENDED_TAG = "anki:suspend"
-FAVORITE_TAG = "marked"
+SECRETS_PATH = "~/.config/pockexport/secrets.py"
 ankiconnect_url_default = "http://localhost:8765"
 ankiconnect_url = os.environ.get(
     "POCKEXPORT_TO_ANKI_ANKICONNECT_URL", ankiconnect_url_default
 )
-ankiconnect_version = 6
-
-
-def batched(iterable, n):
-    "Batch data into tuples of length n. The last batch may be shorter."
-    # batched('ABCDEFG', 3) --> ABC DEF G
-    if n < 1:
-        raise ValueError("n must be at least one")
-    it = iter(iterable)
-    while batch := tuple(islice(it, n)):
-        yield batch
-
 
-def ankiconnect_request(payload):
-    payload["version"] = ankiconnect_version
-    logger.debug("payload = %s", payload)
-    response = json.loads(requests.post(ankiconnect_url, json=payload).text)
-    logger.debug("response = %s", response)
-    if response["error"] is not None:
-        logger.warning("payload %s had response error: %s", payload, response)
-    return response
+# Secrets and clients, created on first use by the functions below.
+_secrets = None
+_anki = None
+_anki_writes = None
+_pocket = None
+_lazy_lock = threading.Lock()
+
+
+def get_secrets():
+    """Load the secrets of pockexport, for use by the pocket module."""
+    global _secrets
+    with _lazy_lock:
+        if _secrets is None:
+            loader = importlib.machinery.SourceFileLoader(
+                "secrets", os.path.expanduser(SECRETS_PATH)
+            )
+            spec = importlib.util.spec_from_loader("secrets", loader)
+            secrets = importlib.util.module_from_spec(spec)
+            loader.exec_module(secrets)
+            _secrets = secrets
+    return _secrets
+
+
+def use_collection(path, write=False):
+    """Make `get_anki` return an `AnkiCollection` for the collection file
+    `path` instead of an AnkiConnect client.
+    """
+    from pockexport_to_anki.collection import AnkiCollection
+
+    global _anki
+    with _lazy_lock:
+        _anki = AnkiCollection(path, write)
+
+
+def use_read_cache(path=None, size_mb=None):
+    """Put a `CachedAnki` read cache in front of the Anki client returned by
+    `get_anki`, also keeping note and card infos in the SQLite file `path`, of
+    at most `size_mb` MiB, if given. Returns the `CachedAnki`.
+    """
+    from pockexport_to_anki.cache import READ_CACHE_SIZE_MB, CachedAnki, ReadCacheStore
+
+    global _anki, _anki_writes
+    anki = get_anki()
+    if isinstance(anki, CachedAnki):
+        anki = anki.client
+    store = None
+    if path is not None:
+        store = ReadCacheStore(path, (size_mb or READ_CACHE_SIZE_MB) * 1024 * 1024)
+    with _lazy_lock:
+        _anki = CachedAnki(anki, store)
+        # Writes must go through the cache, so that they invalidate it.
+        _anki_writes = None
+    return _anki
+
+
+def get_anki():
+    """Return the AnkiConnect client, or the `AnkiCollection` set by
+    `use_collection`.
+    """
+    global _anki
+    with _lazy_lock:
+        if _anki is None:
+            _anki = AnkiConnect(ankiconnect_url)
+    return _anki
+
+
+def get_anki_writes():
+    """Return the buffer that all Anki mutations go through."""
+    global _anki_writes
+    anki = get_anki()
+    with _lazy_lock:
+        if _anki_writes is None:
+            _anki_writes = AnkiWriteBuffer(anki)
+    return _anki_writes
+
+
+def get_pocket_client():
+    import pocket
+
+    global _pocket
+    secrets = get_secrets()
+    with _lazy_lock:
+        if _pocket is None:
+            _pocket = pocket.Pocket(secrets.consumer_key, secrets.access_token)
+    return _pocket
+
+
+def __getattr__(name):
+    # Keep `anki`, `anki_writes` and `secrets` available as module
+    # attributes, created on first access.
+    if name == "anki":
+        return get_anki()
+    if name == "anki_writes":
+        return get_anki_writes()
+    if name == "secrets":
+        return get_secrets()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def item_unchanged(item, snapshot, state):
+    """Return whether neither `item` nor its Anki note changed since the last
+    sync recorded in `state`.
+    """
+    item_state = state.items.get(item.item_id)
+    return (
+        item_state is not None
+        and item_state.note_id in snapshot.unchanged
+        and snapshot.note_by_item_id.get(item.item_id) == item_state.note_id
+        and item_state.time_updated == _int(item.time_updated)
+        and item_state.field_hash == snapshot.mapping.item_fingerprint(item)
+    )
 
 
-BATCH_SIZE = 100
+def skip_unchanged(items, snapshot, state, new_card_tags):
+    """Yield the items in `items` that changed since the last sync recorded in
+    `state`. For the others, map the IDs of the new cards of their notes to
+    the tag IDs of the note in `new_card_tags`, so that those cards are still
+    ordered along with the new cards of the changed items.
+    """
+    new_card_ids = snapshot.card_states.new
+    for item in items:
+        if not item_unchanged(item, snapshot, state):
+            yield item
+            continue
+        item_state = state.items[item.item_id]
+        # Like `plan_item`, leave out notes not edited recently.
+        if item_state.note_id not in snapshot.recently_edited:
+            continue
+        # The last sync left the note with the tags of the item, and marked
+        # if the item is a favorite.
+        tags = item.tags | {FAVORITE_TAG_ID} if item.favorite == "1" else item.tags
+        for card_id in item_state.card_ids:
+            if card_id in new_card_ids:
+                new_card_tags[card_id] = tags
+
+
+def with_new_items(items, new_items):
+    """Yield `items`, with the Pocket items in `new_items` (a dict mapping Anki
+    note ID to Pocket item) substituted for the items with the same ID, and
+    yield the remaining new items at the end.
+    """
+    new_items_by_id = dict(
+        (item["item_id"], PocketItem.from_dict(item)) for item in new_items.values()
+    )
+    for item in items:
+        yield new_items_by_id.pop(item.item_id, item)
+    yield from new_items_by_id.values()
 
 
-def pocket_batch(collection, f_per_item, f_commit):
-    if collection:
-        for batch in batched(collection, BATCH_SIZE):
-            for x in batch:
-                f_per_item(x)
-            f_commit()
+def tag_quota(value):
+    """Parse a `TAG=SHARE` argument of `--tag-quota`."""
+    tag, sep, share = value.rpartition("=")
+    try:
+        share = float(share)
+    except ValueError:
+        share = -1
+    if not sep or not tag or not 0 <= share <= 1:
+        raise argparse.ArgumentTypeError(
+            f"expected TAG=SHARE with SHARE between 0 and 1, got {value!r}"
+        )
+    return tag, share
 
 
 def main():
@@ -98,6 +289,9 @@ def main():
     except Exception:
         debug = os.environ.get("POCKEXPORT_TO_ANKI_DEBUG", None)
         if debug and debug != "0":
+            import pdb
+            import traceback
+
             extype, value, tb = sys.exc_info()
             traceback.print_exc()
             pdb.post_mortem(tb)
@@ -106,6 +300,13 @@ def main():
 
 
 def _main():
+    from pockexport_to_anki.cache import READ_CACHE_SIZE_MB, default_read_cache_path
+    from pockexport_to_anki.journal import JournalError, default_journal_path
+    from pockexport_to_anki.mapping import DEFAULT_FIELDS, load_field_map
+    from pockexport_to_anki.pocket_source import default_mirror_path
+    from pockexport_to_anki.state import default_state_db_path
+    from pockexport_to_anki.watch import WATCH_INTERVAL, WATCH_MAX_MEMORY_MB
+
     parser = argparse.ArgumentParser(
         prog="pockexport-to-anki",
         description="""Sync articles between Pocket and Anki.
@@ -127,544 +328,652 @@ Anki must be running
     parser.add_argument(
         "pockexport_data_file",
         type=pathlib.Path,
-        help="The JSON data file exported by pockexport to read the current Pocket items from.",
+        nargs="?",
+        default=None,
+        help="The JSON data file exported by pockexport to read the current Pocket items from. Not needed with --from-pocket.",
     )
     parser.add_argument(
         "pockexport_data_file_old",
         type=pathlib.Path,
         nargs="?",
         default=None,
-        help="Optional. Previous version of the JSON data file exported by pockexport. If present, only process items that are different between this and `pockexport_data_file`.",
+        help="Optional. Previous version of the JSON data file exported by pockexport. If present, only process items that were added to `pockexport_data_file` since this version, or whose synced fields (tags, favorite, status, title, URL, etc.) changed.",
+    )
+    parser.add_argument(
+        "--from-pocket",
+        action="store_true",
+        help="Read the Pocket items from the Pocket API instead of a "
+        "pockexport data file. Only the items changed since the last run "
+        "with --from-pocket are requested, into the --pocket-mirror file.",
+    )
+    parser.add_argument(
+        "--pocket-mirror",
+        type=pathlib.Path,
+        default=pathlib.Path(default_mirror_path()),
+        metavar="PATH",
+        help="With --from-pocket, the SQLite database keeping a copy of the "
+        "Pocket items between runs. Delete it to read all items again. "
+        "Default: %(default)s",
+    )
+    parser.add_argument(
+        "--all-items",
+        action="store_true",
+        help="With --from-pocket, sync all the items of the --pocket-mirror, "
+        "not only those changed since the last sync, so that notes edited in "
+        "Anki are also brought back in line.",
     )
     parser.add_argument(
         "--edited",
         type=int,
         help="Only examine Anki notes modified in the past N days.",
     )
-    args = parser.parse_args()
-    payload = {
-        "action": "sync",
-    }
-    logger.info(payload)
-    response = ankiconnect_request(payload)
-
-    # First, find notes added to Anki but not yet to Pocket and add them to
-    # Pocket.
-    deck_name = "Articles"
-    note_type = "Pocket Article"
-    response = ankiconnect_request(
-        {
-            "action": "findNotes",
-            "params": {
-                # Find notes with `given_url` and `given_title` not empty, but
-                # `item_id` empty.
-                "query": f'"note:{note_type}" given_url:_* given_title:_* item_id:'
-            },
-        }
+    parser.add_argument(
+        "--deck",
+        default=DEFAULT_DECK,
+        help="The Anki deck to create the notes in. Default: %(default)s",
     )
-    note_ids = response["result"]
-    response = ankiconnect_request(
-        {
-            "action": "notesInfo",
-            "params": {
-                "notes": note_ids,
-            },
-        }
+    parser.add_argument(
+        "--note-type",
+        default=DEFAULT_NOTE_TYPE,
+        help="The Anki note type of the notes of Pocket items. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--field-map",
+        type=pathlib.Path,
+        default=None,
+        metavar="PATH",
+        help="JSON file mapping each field of the --note-type to the Pocket "
+        "field synced to it, as a field name or a [field, normalizer] pair, "
+        "instead of the default fields. See the README.",
+    )
+    parser.add_argument(
+        "--collection",
+        type=pathlib.Path,
+        default=None,
+        help="Read the Anki collection file (collection.anki2 in the Anki "
+        "profile folder) directly instead of going through AnkiConnect. Anki "
+        "must be closed. The file is only read, so this needs --dry-run "
+        "unless --collection-write is given.",
+    )
+    parser.add_argument(
+        "--collection-write",
+        action="store_true",
+        help="With --collection, also write the changes to the collection "
+        "file, for syncing without Anki running, e.g. on a headless server. "
+        "Sync the collection with AnkiWeb from Anki afterwards.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Send up to N requests each to AnkiConnect and Pocket "
+        "concurrently. Default: 1 (serial).",
+    )
+    parser.add_argument(
+        "--plan-workers",
+        type=int,
+        default=1,
+        help="Plan the sync of the Pocket items in N worker processes, for "
+        "very large exports. The plan is the same as with a single process. "
+        "Default: 1 (in the main process).",
+    )
+    parser.add_argument(
+        "--state-db",
+        type=pathlib.Path,
+        nargs="?",
+        const=pathlib.Path(default_state_db_path()),
+        default=None,
+        help="Record the state of each item after syncing it in this SQLite "
+        "database, and skip items that changed in neither Pocket nor Anki "
+        f"since. Default if given without a path: {default_state_db_path()}",
+    )
+    parser.add_argument(
+        "--read-cache",
+        type=pathlib.Path,
+        nargs="?",
+        const=pathlib.Path(default_read_cache_path()),
+        default=None,
+        help="Cache the Anki notes and cards read, within the run and in this "
+        "SQLite database, and reuse those not modified since in later runs, "
+        "instead of fetching them from AnkiConnect again. Default if given "
+        "without a path: "
+        f"{default_read_cache_path()}",
+    )
+    parser.add_argument(
+        "--read-cache-size",
+        type=int,
+        default=READ_CACHE_SIZE_MB,
+        metavar="MB",
+        help="Evict the least recently used entries of the --read-cache "
+        "database once it grows past this size. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--metrics-out",
+        type=pathlib.Path,
+        default=None,
+        help="Write a JSON report of the wall time of each phase of the sync "
+        "and of the requests made to AnkiConnect and Pocket to this file.",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running, and sync again whenever the pockexport data file "
+        "(or, with --from-pocket, the Pocket list) or the Anki notes change. "
+        "Implies --state-db.",
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=WATCH_INTERVAL,
+        metavar="SECONDS",
+        help="With --watch, how often to check for changes. Default: %(default)s",
     )
-    note_infos = response["result"]
-    if args.edited:
-        response = ankiconnect_request(
-            {
-                "action": "findNotes",
-                "params": {
-                    # Find notes with `given_url` and `given_title` not empty, but
-                    # `item_id` empty.
-                    "query": f'"note:{note_type}" given_url:_* given_title:_* item_id:'
-                    f" edited:{args.edited}",
-                },
-            }
+    parser.add_argument(
+        "--watch-max-memory",
+        type=int,
+        default=WATCH_MAX_MEMORY_MB,
+        metavar="MB",
+        help="With --watch, drop the items and notes kept in memory between "
+        "syncs when the process uses more than this. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--health-port",
+        type=int,
+        default=None,
+        metavar="PORT",
+        help="With --watch, serve the status of the last sync at "
+        "http://127.0.0.1:PORT/health and the metrics at /metrics.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only plan the sync: print the planned changes to Anki and Pocket "
+        "as JSON (or write them to the --plan-out file), without making them. "
+        "Anki notes not in Pocket yet are listed in `pocket_adds`, but their "
+        "items are only planned once they have been added.",
+    )
+    parser.add_argument(
+        "--plan-out",
+        type=pathlib.Path,
+        default=None,
+        help="Write the planned changes to this file as JSON.",
+    )
+    parser.add_argument(
+        "--journal",
+        type=pathlib.Path,
+        nargs="?",
+        const=pathlib.Path(default_journal_path()),
+        default=None,
+        help="Record the progress of the sync in this journal file, so that "
+        "it can be resumed with --resume if it is interrupted. The journal is "
+        f"removed when the sync finishes. Default if given without a path: "
+        f"{default_journal_path()}",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the interrupted sync recorded in the --journal file "
+        "(the default journal file if --journal is not given), skipping the "
+        "items and stages it completed. The pockexport data files and "
+        "--edited must be the same as for the interrupted sync.",
+    )
+    parser.add_argument(
+        "--card-order",
+        choices=sorted(STRATEGIES),
+        default=DEFAULT_STRATEGY,
+        help="How to order the new cards for review: most recently added to "
+        "Pocket first (recency), at random (random), recency with a fraction "
+        "of the cards moved to random positions (mixed), at random weighted "
+        "towards recent cards (age-weighted), or interleaving the cards of "
+        "the --tag-quota tags (tag-quota). Default: %(default)s",
+    )
+    parser.add_argument(
+        "--card-order-seed",
+        type=int,
+        default=None,
+        help="Seed the random numbers used to order the new cards.",
+    )
+    parser.add_argument(
+        "--recent-fraction",
+        type=float,
+        default=RECENT_FRACTION,
+        help="Fraction of the new cards left in recency order by the mixed "
+        "and tag-quota orders. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--tag-quota",
+        type=tag_quota,
+        action="append",
+        metavar="TAG=SHARE",
+        help="With --card-order tag-quota, give the new cards tagged TAG this "
+        "share (between 0 and 1) of the order. Can be repeated.",
+    )
+    args = parser.parse_args()
+    if args.from_pocket and args.pockexport_data_file:
+        parser.error("give either a pockexport data file or --from-pocket")
+    if not (args.from_pocket or args.pockexport_data_file):
+        parser.error("a pockexport data file or --from-pocket is required")
+    try:
+        fields = load_field_map(args.field_map) if args.field_map else DEFAULT_FIELDS
+        args.mapping = NoteMapping(args.deck, args.note_type, fields)
+    except (OSError, ValueError) as e:
+        parser.error(f"--field-map: {e}")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.plan_workers < 1:
+        parser.error("--plan-workers must be at least 1")
+    if not 0 <= args.recent_fraction <= 1:
+        parser.error("--recent-fraction must be between 0 and 1")
+    if args.collection_write and not args.collection:
+        parser.error("--collection-write needs --collection")
+    if args.collection and not (args.collection_write or args.dry_run):
+        parser.error("--collection needs --dry-run or --collection-write")
+    if args.collection:
+        from pockexport_to_anki.collection import AnkiCollectionError
+
+        try:
+            use_collection(args.collection, write=args.collection_write)
+        except AnkiCollectionError as e:
+            parser.error(str(e))
+    if args.read_cache_size < 1:
+        parser.error("--read-cache-size must be at least 1")
+    if args.read_cache and args.collection:
+        parser.error("--read-cache is for AnkiConnect, not --collection")
+    read_cache = None
+    if args.read_cache:
+        read_cache = use_read_cache(args.read_cache, args.read_cache_size)
+    if args.resume and not args.journal:
+        args.journal = pathlib.Path(default_journal_path())
+    if args.watch:
+        if args.pockexport_data_file_old:
+            parser.error(
+                "--watch finds the changed items itself, without a previous data file"
+            )
+        if args.dry_run:
+            parser.error("--watch cannot be used with --dry-run")
+        if args.watch_interval <= 0:
+            parser.error("--watch-interval must be positive")
+        if args.state_db is None:
+            args.state_db = pathlib.Path(default_state_db_path())
+    elif args.health_port is not None:
+        parser.error("--health-port needs --watch")
+    if args.all_items and not args.from_pocket:
+        parser.error("--all-items needs --from-pocket")
+    get_anki().set_max_in_flight(args.concurrency)
+    try:
+        if args.watch:
+            from pockexport_to_anki.watch import watch
+
+            watch(args)
+        else:
+            sync(args)
+    except JournalError as e:
+        parser.error(str(e))
+    finally:
+        if read_cache is not None:
+            read_cache.close()
+        metrics.end_phase()
+        metrics.log_summary()
+        if args.metrics_out:
+            metrics.write(args.metrics_out)
+
+
+def sync(
+    args,
+    state=None,
+    source=None,
+    initial_sync=True,
+    all_items=False,
+    should_stop=None,
+    snapshot=None,
+):
+    """Run the sync with the arguments `args`. See `run_sync` for the other
+    arguments.
+    """
+    from pockexport_to_anki.journal import Journal, journal_header
+
+    journal = None
+    resumed = None
+    if args.journal and not args.dry_run:
+        journal = Journal(args.journal)
+        if args.resume:
+            resumed = journal.resume(journal_header(args))
+        else:
+            journal.start(journal_header(args))
+    try:
+        run_sync(
+            args,
+            journal,
+            resumed,
+            state,
+            source,
+            initial_sync,
+            all_items,
+            should_stop,
+            snapshot,
         )
-        note_ids_recently_edited = response["result"]
-    else:
-        note_ids_recently_edited = copy.deepcopy(note_ids)
+    finally:
+        if journal is not None:
+            journal.close()
+
+
+def run_sync(
+    args,
+    journal=None,
+    resumed=None,
+    state=None,
+    source=None,
+    initial_sync=True,
+    all_items=False,
+    should_stop=None,
+    snapshot=None,
+):
+    """Run the sync, recording its progress in `journal` if given, and
+    skipping the stages completed by the `ResumedRun` `resumed` if given.
+
+    `state`, a `SyncState`, and `source`, which yields the Pocket items from
+    its `items` method, are opened from `args` unless given, and only closed
+    then. Anki is synced with AnkiWeb at the start of the sync unless
+    `initial_sync` is false, and always at the end. With `--from-pocket`,
+    all the items of the mirror are synced if `all_items` is true, as with
+    `--all-items`. Planning stops early, as on Ctrl-C, once `should_stop`,
+    if given, returns true. If `snapshot`, an `AnkiSnapshot`, is given, it is
+    refreshed and used rather than fetching a new one.
+    """
+    import pprint
+
+    from pockexport_to_anki.pocket_writer import PocketWriter
+    from pockexport_to_anki.snapshot import record_synced_items
+    from pockexport_to_anki.state import SyncState
+
+    anki = get_anki()
+    anki_writes = get_anki_writes()
+    mapping = args.mapping
+    own_source = source is None and args.from_pocket
+    if own_source:
+        from pockexport_to_anki.pocket_source import PocketSource
+
+        source = PocketSource(
+            get_pocket_client(), args.pocket_mirror, dry_run=args.dry_run
+        )
+    done = resumed.stages if resumed is not None else set()
+    # IDs of the items whose writes failed, which are synced again next time.
+    failed = set(resumed.failed_items) if resumed is not None else set()
+
+    def finish(stage, stage_failed=()):
+        failed.update(stage_failed)
+        if journal is not None:
+            journal.stage(stage, stage_failed)
+
+    if initial_sync and not args.dry_run:
+        metrics.start_phase("initial_sync")
+        payload = {
+            "action": "sync",
+        }
+        logger.info(payload)
+        anki.request(payload)
 
-    pocket_client = pocket.Pocket(secrets.consumer_key, secrets.access_token)
+    # First, find notes added to Anki but not yet to Pocket and add them to
+    # Pocket.
+    metrics.start_phase("anki_to_pocket")
+    plan = resumed.plan if resumed is not None else SyncPlan()
+    note_infos, recently_edited = find_notes_without_items(anki, mapping, args.edited)
+    plan.pocket_adds = plan_pocket_adds(note_infos, recently_edited, mapping)
     # Map Anki note ID to Pocket item info returned from API.
     pocket_new_items = dict()
-    if note_infos:
-        for batch in batched(note_infos, BATCH_SIZE):
-            for ni in batch:
-                logger.info(f"ni = {ni}")
-                if ni["noteId"] not in note_ids_recently_edited:
-                    logger.info(f"{ni['noteId']}: skipping because not recently edited")
-                    continue
-                title = ni["fields"]["given_title"]["value"].strip()
-                url = ni["fields"]["given_url"]["value"].strip()
-                match = re.match(r'<a href="?(.*?)"?>(.*)</a>', url)
-                if match:
-                    url = match[1]
-                pocket_client.bulk_add(
-                    0,
-                    url=url,
-                    title=title,
-                    tags=",".join(sorted(ni["tags"])),
-                    wait=True,
-                )
-            result = pocket_client.commit()
-            for ni, res, err in zip(
-                batch, result[0]["action_results"], result[0]["action_errors"]
-            ):
-                if err is None:
-                    res["given_title"] = title
-                    res["given_url"] = url
-                    pocket_new_items[ni["noteId"]] = res
-                else:
-                    logger.error(
-                        f"note_id {ni['noteId']}: Error when adding new Pocket item: {err}"
-                    )
-    logger.info(f"pocket_new_items = {pprint.pformat(pocket_new_items)}")
-
-    incremental_ids = None
-    with open(args.pockexport_data_file) as f:
-        data = json.load(f)
-    incremental_mode = False
-    if args.pockexport_data_file_old:
-        incremental_mode = True
-    if incremental_mode:
-        data_old = data
-        with open(args.pockexport_data_file_old) as f:
-            data = json.load(f)
-
-    # Augment `data` with any Anki items added to Pocket above just now; these
-    # Anki items are to be handled as normal Pocket items by the rest of the
-    # script.
-    actions = []
-    for note_id, item in pocket_new_items.items():
-        data["list"][item["item_id"]] = item
-        actions.append(
-            {
-                "action": "updateNoteFields",
-                "params": {
-                    "note": {
-                        "id": note_id,
-                        "fields": {
-                            "item_id": item["item_id"],
-                            "given_title": item["given_title"],
-                            "given_url": item["given_url"],
-                        },
-                    },
-                },
-            }
+    if not args.dry_run:
+        pocket_writer = PocketWriter(
+            get_pocket_client(), max_in_flight=args.concurrency
         )
-    if actions:
-        for batch in batched(actions, BATCH_SIZE):
-            response = ankiconnect_request(
-                {
-                    "action": "multi",
-                    "params": {"actions": actions},
-                }
-            )
-    # Now that `data` has been augmented, check in incremental mode for new
-    # Pocket items, and exit now if there are none.
-    if incremental_mode:
-        incremental_ids = frozenset(data["list"].keys()) - frozenset(
-            data_old["list"].keys()
+        # Update the Anki notes for any Anki items added to Pocket just now;
+        # these Anki items are to be handled as normal Pocket items by the
+        # rest of the script.
+        pocket_new_items = apply_pocket_adds(
+            pocket_writer, anki_writes, plan.pocket_adds, mapping
         )
-        if not incremental_ids:
-            logger.info("No new Pocket items, exiting")
-            sys.exit(0)
-
-    archive_items = set()
-    readd_items = set()
-    favorite_items = set()
-    unfavorite_items = set()
-    card_to_time_added = list()
-    tag_updated_notes = dict()
-    tag_updated_items = dict()
-    note_info_old = dict()
-    note_ids_recently_edited = ankiconnect_request(
-        {
-            "action": "findNotes",
-            "params": {
-                # Find notes with `given_url` and `given_title` not empty, but
-                # `item_id` empty.
-                "query": f'"note:{note_type}"'
-                + (f" edited:{args.edited}" if args.edited else "")
-            },
-        }
-    )["result"]
-    try:
-        nitem = len(data["list"])
-        for i, item in enumerate(data["list"].values()):
-            item_id = item["item_id"]
-            if incremental_ids is not None and item_id not in incremental_ids:
-                logger.debug(f"Skipping old item {item_id} in incremental mode")
-                continue
-            logger.debug(f"ITERATION {i}/{nitem}")
-            try:
-                pocket_tags = set(item["tags"].keys())
-            except KeyError:
-                pocket_tags = set()
-            # Pockexport produces `authors` as a dictionary, but the Pocket add
-            # API returns an empty list if there are no authors. Weird!
-            # Standardize on dictionary.
-            if "authors" in item and isinstance(item["authors"], list):
-                item["authors"] = dict()
-            fields = {
-                "item_id": item_id,
-                "given_url": item.get("given_url", ""),
-                "given_title": item.get("given_title", ""),
-                "resolved_url": item.get("resolved_url", ""),
-                "resolved_title": item.get("resolved_title", ""),
-                "time_added": item.get("time_added", ""),
-                "word_count": item.get("word_count", ""),
-                "time_to_read": str(item.get("time_to_read", "")),
-                "excerpt": item.get("excerpt", ""),
-                "authors": ", ".join(
-                    sorted(
-                        list(
-                            author["name"]
-                            for author in item.get("authors", dict()).values()
-                        )
-                    )
-                ),
-            }
-
-            response = ankiconnect_request(
-                {
-                    "action": "findNotes",
-                    "params": {
-                        "query": f"item_id:{item_id}",
-                    },
-                }
-            )
-            notes_existing = response["result"]
-            note_id = None
-            mod_time = 0
-            note_last_sync_time = 0
-            if notes_existing:
-                note_id = notes_existing[0]
-                if note_id not in note_ids_recently_edited:
-                    logger.info(f"{note_id}: skipping because not recently edited")
-                    continue
-                response = ankiconnect_request(
-                    {
-                        "action": "notesInfo",
-                        "params": {
-                            "notes": [note_id],
-                        },
-                    }
-                )
-                note_info = response["result"][0]
-                ni = copy.deepcopy(note_info)
-                ni["cards"].sort()
-                ni["tags"].sort()
-                note_info_old[note_id] = ni
-                existing_pocket_fields = dict(
-                    (k, v["value"]) for k, v in ni["fields"].items() if k in fields
-                )
-                cards = note_info["cards"]
-                response = ankiconnect_request(
-                    {
-                        "action": "cardsModTime",
-                        "params": {
-                            "cards": cards,
-                        },
-                    }
+        logger.info(f"Added {len(pocket_new_items)} Anki notes to Pocket")
+        if journal is not None:
+            journal.pocket_adds(pocket_new_items)
+        if resumed is not None:
+            # Also sync the items added by the resumed run.
+            pocket_new_items = dict(
+                itertools.chain(
+                    resumed.pocket_new_items.items(), pocket_new_items.items()
                 )
-                mod_time = max(x["mod"] for x in response["result"])
-                try:
-                    note_last_sync_time = int(
-                        note_info["fields"]["time_last_synced"]["value"]
-                    )
-                except (KeyError, ValueError):
-                    note_last_sync_time = 0
-
-                if existing_pocket_fields != fields:
-                    response = ankiconnect_request(
-                        {
-                            "action": "updateNoteFields",
-                            "params": {
-                                "note": {
-                                    "id": note_id,
-                                    "fields": fields,
-                                }
-                            },
-                        }
-                    )
-
-            else:
-                payload = {
-                    "action": "addNote",
-                    "params": {
-                        "note": {
-                            "deckName": deck_name,
-                            "modelName": note_type,
-                            "fields": fields,
-                            "tags": list(pocket_tags),
-                        }
-                    },
-                }
-                response = ankiconnect_request(payload)
-                if (
-                    response["error"] is not None
-                    and response["error"]
-                    != "cannot create note because it is a duplicate"
-                ):
-                    logger.warning(
-                        "payload %s had response error: %s", payload, response
-                    )
-                    continue
-                note_id = response["result"]
-                if note_id:
-                    note_info_old[note_id] = dict()
-
-            response = ankiconnect_request(
-                {
-                    "action": "notesInfo",
-                    "params": {
-                        "notes": [note_id],
-                    },
-                }
             )
-            note_info = response["result"][0]
-            cards = note_info.get("cards", None)
-            if cards is None:
-                logger.warning(response)
-                continue
-            note_tags = set(note_info["tags"])
-            note_favorited = FAVORITE_TAG in note_tags
-            should_favorite = note_favorited
-            if note_favorited and item.get("favorite", None) == "0":
-                if int(item.get("time_favorited", "0")) > mod_time:
-                    should_favorite = False
-                else:
-                    should_favorite = True
-            elif not note_favorited and item.get("favorite", None) == "1":
-                if int(item.get("time_favorited", "0")) > mod_time:
-                    should_favorite = True
-                else:
-                    should_favorite = False
-            note_tags -= {FAVORITE_TAG, ANKI_SUSPENDED_TAG}
-            merged_tags = note_tags - {FAVORITE_TAG, ANKI_SUSPENDED_TAG}
-            if note_tags != pocket_tags:
-                # Overwrite `pocket_tags` only if Pocket for sure has not been
-                # updated since the last sync. Otherwise, merge `pocket_tags` into
-                # the existing note tags.
-                if not (
-                    mod_time > note_last_sync_time
-                    and note_last_sync_time > int(item.get("time_updated", "0"))
-                ):
-                    merged_tags |= pocket_tags
-            if should_favorite:
-                merged_tags |= {FAVORITE_TAG}
-                if item.get("favorite", None) == "0":
-                    favorite_items |= {item_id}
-                    unfavorite_items -= {item_id}
-            else:
-                merged_tags -= {FAVORITE_TAG}
-                if item.get("favorite", None) == "1":
-                    favorite_items -= {item_id}
-                    unfavorite_items |= {item_id}
-            response = ankiconnect_request(
-                {
-                    "action": "cardsInfo",
-                    "params": {
-                        "cards": cards,
-                    },
-                }
-            )
-            for cardInfo in response["result"]:
-                # `cardInfo` field meanings taken from
-                # https://github.com/ankidroid/Anki-Android/wiki/Database-Structure#cards
-                card_reviewed = cardInfo["type"] == 2
-                if card_reviewed and item.get("status", "0") == "0":
-                    archive_items |= {item_id}
-                # TODO: uncomment the below if I ever get through my backlog.
-                # elif not card_reviewed and item.get('status', '0') == '1':
-                #   readd_items |= {item_id}
-                # Sync suspended status to tags, mostly for easier viewing in
-                # Pocket interface.
-                card_new = cardInfo["type"] == 0 and cardInfo["queue"] == 0
-                card_suspended = cardInfo["queue"] == -1
-                if card_suspended:
-                    merged_tags |= {ANKI_SUSPENDED_TAG}
-                    if item.get("status", "0") == "0":
-                        archive_items |= {item_id}
-                else:
-                    merged_tags -= {ANKI_SUSPENDED_TAG}
-                if card_new and not card_suspended:
-                    try:
-                        time_added = int(cardInfo["fields"]["time_added"]["value"])
-                    except (KeyError, ValueError):
-                        time_added = 0
-                    card_to_time_added.append((cardInfo["cardId"], time_added))
-            if merged_tags != note_tags:
-                logger.debug(
-                    f"tag_updated_notes[{note_id}]: merged_tags {merged_tags} note_tags {note_tags}"
-                )
-                tag_updated_notes[note_id] = merged_tags
-            # FAVORITE_TAG not added to Pocket since Pocket has separate Favorite
-            # status.
-            if (merged_tags - {FAVORITE_TAG}) != pocket_tags:
-                logger.debug(
-                    f"tag_updated_items[{item_id}]: merged_tags {merged_tags - {FAVORITE_TAG}} pocket_tags {pocket_tags}"
-                )
-                tag_updated_items[item_id] = merged_tags - {FAVORITE_TAG}
-
-    except KeyboardInterrupt:
-        logger.info("Received KeyboardInterrupt - finishing sync")
-        pass
-
-    logger.info("Pocket API")
-    logger.info(f"tag_updated_items: {tag_updated_items}")
-    pocket_batch(
-        list(tag_updated_items.items()),
-        lambda x: print(x)
-        or pocket_client.tags_replace(int(x[0]), ",".join(sorted(x[1]))),
-        lambda: pocket_client.commit(),
-    )
-    logger.info(f"favorite_items: {favorite_items}")
-    pocket_batch(
-        favorite_items,
-        lambda item_id: pocket_client.favorite(int(item_id)),
-        lambda: pocket_client.commit(),
-    )
-    logger.info(f"unfavorite_items: {unfavorite_items}")
-    pocket_batch(
-        unfavorite_items,
-        lambda item_id: pocket_client.unfavorite(int(item_id)),
-        lambda: pocket_client.commit(),
-    )
-    logger.info(f"archive_items: {archive_items}")
-    pocket_batch(
-        archive_items,
-        lambda item_id: pocket_client.archive(int(item_id)),
-        lambda: pocket_client.commit(),
-    )
-    logger.info(f"readd_items: {readd_items}")
-    pocket_batch(
-        readd_items,
-        lambda item_id: pocket_client.readd(int(item_id)),
-        lambda: pocket_client.commit(),
-    )
-
-    # Adjust new card order - generally I'd like to review the most recent
-    # additions to Pocket first, but mix in some older material as well - 70%
-    # recent, 30% randomly selected.
-    # First sort most recent to least recent time_added.
-    card_to_time_added.sort(key=(lambda x: x[1]), reverse=True)
-    # Next, shuffle 30% of the entries to random positions.
-    for i in range(len(card_to_time_added) - 1):
-        if random.random() < 0.7:
-            continue
-        j = random.randint(i, len(card_to_time_added) - 1)
-        card_to_time_added[i], card_to_time_added[j] = (
-            card_to_time_added[j],
-            card_to_time_added[i],
+        logger.debug(f"pocket_new_items = {pprint.pformat(pocket_new_items)}")
+
+    own_state = state is None
+    if (
+        own_state
+        and args.state_db
+        and not (args.dry_run and not args.state_db.exists())
+    ):
+        state = SyncState(args.state_db)
+    if "plan" in done:
+        logger.info("Items already planned by the resumed run")
+    else:
+        planned = plan_items(
+            args,
+            anki,
+            plan,
+            state,
+            pocket_new_items,
+            source,
+            journal,
+            resumed,
+            all_items,
+            should_stop,
+            snapshot,
         )
-    # Finally, write back to Anki
-    logger.debug(f"card_to_time_added = {pprint.pformat(card_to_time_added)}")
-    due = 0
-    for batch in batched(card_to_time_added, BATCH_SIZE):
-        actions = []
-        for card_id, time_added in batch:
-            actions.append(
-                {
-                    "action": "setSpecificValueOfCard",
-                    "params": {
-                        "card": card_id,
-                        "keys": ["due"],
-                        "newValues": [due],
-                    },
-                }
-            )
-            due += 1
-
-        response = ankiconnect_request(
-            {
-                "action": "multi",
-                "params": {"actions": actions},
-            }
+        if not planned:
+            if own_state and state is not None:
+                state.close()
+            if own_source:
+                source.close()
+            return
+        finish("plan")
+
+    if "field_writes" not in done:
+        metrics.start_phase("field_writes")
+        failures = apply_field_updates(anki_writes, plan)
+        finish("field_writes", failed_items(plan, anki_failures=failures))
+
+    if "pocket_writes" not in done:
+        metrics.start_phase("pocket_writes")
+        logger.info(
+            f"Pocket API: {len(plan.tag_updated_items)} tag updates,"
+            f" {len(plan.favorite_items)} favorites,"
+            f" {len(plan.unfavorite_items)} unfavorites,"
+            f" {len(plan.archive_items)} archives, {len(plan.readd_items)} re-adds"
         )
+        logger.debug(f"tag_updated_items: {plan.tag_updated_items}")
+        logger.debug(f"favorite_items: {plan.favorite_items}")
+        logger.debug(f"unfavorite_items: {plan.unfavorite_items}")
+        logger.debug(f"archive_items: {plan.archive_items}")
+        logger.debug(f"readd_items: {plan.readd_items}")
+        outcomes = apply_pocket_actions(pocket_writer, plan)
+        finish("pocket_writes", failed_items(plan, pocket_outcomes=outcomes))
+
+    if "due_reordering" not in done:
+        metrics.start_phase("due_reordering")
+        if resumed is not None and resumed.card_updates is not None:
+            # Keep the order decided by the resumed run.
+            card_updates = resumed.card_updates
+        else:
+            card_order = order_new_cards(
+                plan.new_cards,
+                make_rng(args.card_order_seed),
+                args.card_order,
+                recent_fraction=args.recent_fraction,
+                seed=args.card_order_seed,
+                tag_quotas=dict(args.tag_quota or []),
+            )
+            card_updates = due_updates(card_order)
+            logger.info(
+                f"Reordering {len(card_order)} new cards: {len(card_updates)} to move"
+            )
+            if journal is not None:
+                journal.card_updates(card_updates)
+        logger.debug(f"card_updates = {pprint.pformat(card_updates)}")
+        apply_card_order(anki_writes, card_updates)
+        finish("due_reordering")
 
     payload = {
         "action": "findCards",
         "params": {
-            "query": 'deck:Articles note:"Pocket article" is:new -is:suspended',
+            "query": f'"deck:{mapping.deck_name}" "note:{mapping.note_type}"'
+            " is:new -is:suspended",
         },
     }
     logger.info(payload)
 
-    # script_sync_time has to be updated at the end so that we can tell if
-    # Pocket was updated *after* this script ran, which is important for tags.
-    script_sync_time = int(time.time())
-    if note_info_old:
-        for batch in batched(list(note_info_old.keys()), BATCH_SIZE):
-            actions = []
-            response = ankiconnect_request(
-                {
-                    "action": "notesInfo",
-                    "params": {
-                        "notes": batch,
-                    },
-                }
-            )
-            nis = response["result"]
-            note_info_new = dict()
-            for ni in nis:
-                if not ni:
-                    continue
-                ni["tags"].sort()
-                ni["cards"].sort()
-                note_info_new[ni["noteId"]] = ni
-            note_ids_updated = (
-                set(tag_updated_notes.keys())
-                | set(
-                    note_id
-                    for note_id in batch
-                    if note_id in note_info_old
-                    and note_id in note_info_new
-                    and note_info_old[note_id] != note_info_new[note_id]
+    if "final_tag_writes" not in done:
+        metrics.start_phase("final_tag_writes")
+        # script_sync_time has to be updated at the end so that we can tell
+        # if Pocket was updated *after* this script ran, which is important
+        # for tags.
+        script_sync_time = int(time.time())
+        failures = apply_note_updates(anki, anki_writes, plan, script_sync_time)
+        finish("final_tag_writes", failed_items(plan, anki_failures=failures))
+
+    if state is not None:
+        if "record_state" not in done:
+            metrics.start_phase("record_state")
+            if failed:
+                logger.warning(
+                    f"Writes failed for {len(failed)} items, to be synced again"
                 )
-                if note_info_old and note_info_new
-                else set()
-            )
-            for note_id in note_ids_updated:
-                actions.append(
-                    {
-                        "action": "updateNoteFields",
-                        "params": {
-                            "note": {
-                                "id": note_id,
-                                "fields": {
-                                    "time_last_synced": str(script_sync_time),
-                                },
-                            },
-                        },
-                    }
-                )
-                if note_id in tag_updated_notes:
-                    actions.append(
-                        {
-                            "action": "updateNoteTags",
-                            "params": {
-                                "note": note_id,
-                                "tags": list(tag_updated_notes[note_id]),
-                            },
-                        }
-                    )
-
-            response = ankiconnect_request(
-                {
-                    "action": "multi",
-                    "params": {"actions": actions},
-                }
-            )
+            record_synced_items(anki, state, plan.synced_items, failed)
+            finish("record_state")
+        if own_state:
+            state.close()
 
+    metrics.start_phase("final_sync")
     payload = {
         "action": "sync",
     }
     logger.info(payload)
-    response = ankiconnect_request(payload)
+    anki.request(payload)
+    metrics.end_phase()
+    if args.from_pocket:
+        if plan.interrupted:
+            # The items not planned must still be synced by the next run.
+            logger.info("Planning was interrupted, the Pocket items stay changed")
+        else:
+            source.done(failed)
+    if own_source:
+        source.close()
+    if journal is not None:
+        journal.remove()
     logger.info("Finished successfully")
+
+
+def plan_items(
+    args,
+    anki,
+    plan,
+    state,
+    pocket_new_items,
+    source=None,
+    journal=None,
+    resumed=None,
+    all_items=False,
+    should_stop=None,
+    snapshot=None,
+):
+    """Plan the sync of the items of the pockexport data files, or of
+    `source` if given, into `plan`, then create the notes of new items unless
+    this is a dry run. See `run_sync` for `all_items`, `should_stop` and
+    `snapshot`.
+
+    Items already planned by `resumed` are skipped. Returns False if the
+    sync should stop here.
+    """
+    from pockexport_to_anki.snapshot import (
+        prefetch_anki_snapshot,
+        refresh_anki_snapshot,
+    )
+
+    # Stream the items from the pockexport data files rather than loading
+    # them whole, so that memory usage does not grow with the export size.
+    # Reading the files, and loading the notes of unchanged items, overlap
+    # with planning, so their time is reported separately as `export_load`
+    # and `note_load`.
+    metrics.start_phase("export_load")
+    if args.from_pocket:
+        items = source.items(full=all_items or args.all_items)
+    elif source is not None:
+        items = source.items()
+    elif args.pockexport_data_file_old:
+        items = iter_changed_items(
+            args.pockexport_data_file, args.pockexport_data_file_old
+        )
+    else:
+        items = iter_export_items(args.pockexport_data_file)
+    items = with_new_items(items, pocket_new_items)
+    if args.pockexport_data_file_old:
+        # Check in incremental mode for new or changed Pocket items, and exit
+        # now if there are none.
+        first = next(items, None)
+        if first is None:
+            logger.info("No new or changed Pocket items, exiting")
+            if args.dry_run:
+                write_plan(plan, args.plan_out)
+            if journal is not None:
+                journal.remove()
+            return False
+        items = itertools.chain([first], items)
+    items = metrics.timed_iter("export_load", items)
+    if resumed is not None:
+        items = (item for item in items if item.item_id not in resumed.item_ids)
+
+    metrics.start_phase("prefetch")
+    if snapshot is None:
+        snapshot = prefetch_anki_snapshot(anki, args.mapping, args.edited, state)
+    else:
+        refresh_anki_snapshot(snapshot, args.edited, state)
+    # Map the new cards of notes skipped as unchanged to the tags of the
+    # note.
+    new_card_tags = dict()
+    if state is not None:
+        items = skip_unchanged(items, snapshot, state, new_card_tags)
+        items = metrics.timed_iter("note_load", snapshot.iter_loaded(items))
+
+    metrics.start_phase("plan")
+    plan_sync(items, snapshot, plan, journal, args.plan_workers, should_stop)
+    # Also order the new cards of the notes skipped as unchanged. The new
+    # cards of notes not edited recently, or whose items are not in the
+    # export, keep their due positions.
+    if new_card_tags:
+        unchanged_cards = snapshot.new_cards(new_card_tags)
+        plan.new_cards.extend(unchanged_cards)
+        if journal is not None:
+            journal.unchanged_cards(unchanged_cards)
+    logger.info(
+        f"Planned {len(plan.field_updates)} note field updates,"
+        f" {len(plan.new_notes)} new notes, {len(plan.tag_updated_notes)} note"
+        f" tag updates and {len(plan.pocket_actions())} Pocket actions"
+    )
+    if args.plan_out or args.dry_run:
+        write_plan(plan, args.plan_out)
+    if args.dry_run:
+        return False
+
+    metrics.start_phase("create_notes")
+    created = create_notes(anki, plan, args.mapping)
+    if journal is not None:
+        for item_plan in created:
+            journal.add(item_plan)
+    return True
+
+
+def write_plan(plan, path=None):
+    """Write `plan` as JSON to `path`, or to standard output."""
+    if path is None:
+        json.dump(plan.to_dict(), sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(path, "w") as f:
+            json.dump(plan.to_dict(), f, indent=2)
+            f.write("\n")
@@ -0,0 +1,298 @@
+import logging
+import threading
+import time
+
+from itertools import islice
+
+from pockexport_to_anki.metrics import metrics
+
+logger = logging.getLogger("pockexport-to-anki")
+
+ANKICONNECT_VERSION = 6
+# Maximum number of actions packed into a single `multi` request.
+MULTI_BATCH_SIZE = 100
+# Maximum number of notes per `addTags` or `removeTags` action.
+TAG_BATCH_SIZE = 1000
+
+
+def batched(iterable, n):
+    "Batch data into tuples of length n. The last batch may be shorter."
+    # batched('ABCDEFG', 3) --> ABC DEF G
+    if n < 1:
+        raise ValueError("n must be at least one")
+    it = iter(iterable)
+    while batch := tuple(islice(it, n)):
+        yield batch
+
+
+class AnkiConnect:
+    """Client for the AnkiConnect add-on.
+
+    All requests go through one pooled keep-alive `requests.Session`.
+    """
+
+    def __init__(
+        self,
+        url,
+        version=ANKICONNECT_VERSION,
+        batch_size=MULTI_BATCH_SIZE,
+        max_in_flight=1,
+    ):
+        # `requests` is slow to import, so only import it once a client is
+        # created.
+        import requests
+
+        self.url = url
+        self.version = version
+        self.batch_size = batch_size
+        self.session = requests.Session()
+        self.set_max_in_flight(max_in_flight)
+
+    def set_max_in_flight(self, max_in_flight):
+        """Allow up to `max_in_flight` concurrent requests from threads."""
+        import requests.adapters
+
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_in_flight
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.max_in_flight = max_in_flight
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def _post(self, payload):
+        payload["version"] = self.version
+        logger.debug("payload = %s", payload)
+        start = time.perf_counter()
+        with self._in_flight:
+            http_response = self.session.post(self.url, json=payload)
+        metrics.record_request(
+            "ankiconnect",
+            payload["action"],
+            time.perf_counter() - start,
+            len(http_response.request.body or b""),
+            len(http_response.content),
+            len(payload["params"]["actions"]) if payload["action"] == "multi" else 1,
+        )
+        http_response.raise_for_status()
+        response = http_response.json()
+        logger.debug("response = %s", response)
+        return response
+
+    def request(self, payload):
+        """Send `payload` immediately and return the full response.
+
+        Response errors are logged, not raised, and left in the returned
+        response for the caller to inspect.
+        """
+        response = self._post(payload)
+        if response["error"] is not None:
+            logger.warning("payload %s had response error: %s", payload, response)
+        return response
+
+    def invoke(self, action, **params):
+        """Send a single action immediately and return its result."""
+        payload = {"action": action}
+        if params:
+            payload["params"] = params
+        return self.request(payload)["result"]
+
+    def stream(self, payloads, batch_size=None):
+        """Send `payloads` packed into `multi` requests.
+
+        Yields the response of each payload, in order, as soon as the `multi`
+        request containing it has completed. Up to `max_in_flight` requests
+        are sent at a time.
+        """
+        batches = batched(payloads, batch_size or self.batch_size)
+        if self.max_in_flight == 1:
+            for batch in batches:
+                yield from self._multi(batch)
+            return
+        import collections
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(self.max_in_flight) as executor:
+            pending = collections.deque()
+            for batch in batches:
+                pending.append(executor.submit(self._multi, batch))
+                if len(pending) >= self.max_in_flight:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def _multi(self, payloads):
+        if len(payloads) == 1:
+            return [self.request(dict(payloads[0]))]
+        response = self.request(
+            {
+                "action": "multi",
+                "params": {"actions": list(payloads)},
+            }
+        )
+        results = response["result"]
+        if results is None:
+            return [{"result": None, "error": response["error"]} for _ in payloads]
+        responses = []
+        for payload, result in zip(payloads, results):
+            # Older AnkiConnect versions return bare results inside `multi`.
+            if not (isinstance(result, dict) and "error" in result):
+                result = {"result": result, "error": None}
+            if result["error"] is not None:
+                logger.warning("payload %s had response error: %s", payload, result)
+            responses.append(result)
+        return responses
+
+
+class AnkiWriteBuffer:
+    """Write-behind buffer for Anki mutations.
+
+    Mutations are buffered per note and card, so that repeated writes to the
+    same note are merged into one action, and sent by `flush` as `multi`
+    requests of at most `batch_size` actions. Tags added to or removed from
+    notes are buffered per tag instead, and sent as one `addTags` or
+    `removeTags` action per tag for all its notes. The buffer flushes itself
+    once it holds `max_pending` notes, cards and tag changes.
+    """
+
+    def __init__(self, client, batch_size=MULTI_BATCH_SIZE, max_pending=10000):
+        self.client = client
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        # Map note ID to the fields to update.
+        self._fields = dict()
+        # Map note ID to the full new list of tags.
+        self._tags = dict()
+        # Map tag to the IDs of the notes to add it to, or remove it from.
+        self._added_tags = dict()
+        self._removed_tags = dict()
+        # Map card ID to a dict of card attributes to set.
+        self._card_values = dict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return (
+            len(self._fields)
+            + len(self._tags)
+            + len(self._card_values)
+            + sum(len(note_ids) for note_ids in self._added_tags.values())
+            + sum(len(note_ids) for note_ids in self._removed_tags.values())
+        )
+
+    def update_note_fields(self, note_id, fields):
+        with self._lock:
+            self._fields.setdefault(note_id, dict()).update(fields)
+            self._maybe_flush()
+
+    def update_note_tags(self, note_id, tags):
+        with self._lock:
+            self._tags[note_id] = sorted(tags)
+            for note_ids in self._added_tags.values():
+                note_ids.discard(note_id)
+            for note_ids in self._removed_tags.values():
+                note_ids.discard(note_id)
+            self._maybe_flush()
+
+    def add_tags(self, note_id, tags):
+        """Add `tags` to the note, leaving its other tags as they are."""
+        with self._lock:
+            if note_id in self._tags:
+                self._tags[note_id] = sorted(set(self._tags[note_id]) | set(tags))
+                return
+            for tag in tags:
+                self._removed_tags.get(tag, set()).discard(note_id)
+                self._added_tags.setdefault(tag, set()).add(note_id)
+            self._maybe_flush()
+
+    def remove_tags(self, note_id, tags):
+        """Remove `tags` from the note, leaving its other tags as they are."""
+        with self._lock:
+            if note_id in self._tags:
+                self._tags[note_id] = sorted(set(self._tags[note_id]) - set(tags))
+                return
+            for tag in tags:
+                self._added_tags.get(tag, set()).discard(note_id)
+                self._removed_tags.setdefault(tag, set()).add(note_id)
+            self._maybe_flush()
+
+    def set_card_values(self, card_id, values):
+        with self._lock:
+            self._card_values.setdefault(card_id, dict()).update(values)
+            self._maybe_flush()
+
+    def discard(self):
+        """Drop the buffered mutations without sending them."""
+        with self._lock:
+            self._fields = dict()
+            self._tags = dict()
+            self._added_tags = dict()
+            self._removed_tags = dict()
+            self._card_values = dict()
+
+    def _maybe_flush(self):
+        if len(self) >= self.max_pending:
+            self.flush()
+
+    def _tag_payloads(self, action, notes_by_tag):
+        for tag, note_ids in sorted(notes_by_tag.items()):
+            for batch in batched(sorted(note_ids), TAG_BATCH_SIZE):
+                yield {
+                    "action": action,
+                    "params": {"notes": list(batch), "tags": tag},
+                }
+
+    def _payloads(self):
+        for note_id, fields in self._fields.items():
+            yield {
+                "action": "updateNoteFields",
+                "params": {"note": {"id": note_id, "fields": fields}},
+            }
+        for note_id, tags in self._tags.items():
+            yield {
+                "action": "updateNoteTags",
+                "params": {"note": note_id, "tags": tags},
+            }
+        yield from self._tag_payloads("addTags", self._added_tags)
+        for card_id, values in self._card_values.items():
+            yield {
+                "action": "setSpecificValueOfCard",
+                "params": {
+                    "card": card_id,
+                    "keys": list(values.keys()),
+                    "newValues": list(values.values()),
+                },
+            }
+
+    def flush(self):
+        """Send all buffered mutations.
+
+        Returns a list of `(payload, error)` for the actions that failed; each
+        failure is also logged.
+        """
+        with self._lock:
+            # Remove tags before adding any: Anki removes tags regardless of
+            # case, so a tag whose case changed would otherwise be removed
+            # right after being added.
+            stages = [
+                list(self._tag_payloads("removeTags", self._removed_tags)),
+                list(self._payloads()),
+            ]
+            self._fields = dict()
+            self._tags = dict()
+            self._added_tags = dict()
+            self._removed_tags = dict()
+            self._card_values = dict()
+            payloads = list()
+            failures = list()
+            for stage in stages:
+                payloads.extend(stage)
+                failures.extend(
+                    (payload, response["error"])
+                    for payload, response in zip(
+                        stage, self.client.stream(stage, self.batch_size)
+                    )
+                    if response["error"] is not None
+                )
+        if failures:
+            logger.warning(f"{len(failures)} of {len(payloads)} Anki writes failed")
+        return failures
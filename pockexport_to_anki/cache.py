@@ -0,0 +1,514 @@
+"""Read-through cache in front of the AnkiConnect client.
+
+`CachedAnki` answers repeated reads of the same notes and cards within a run
+from memory: `notesInfo`, `cardsInfo`, `notesModTime` and `cardsModTime` are
+cached per note and card, and `findNotes` and `findCards` per query. Our own
+writes to a note or card drop its entries, and any write drops the cached
+queries. `sync` drops everything but the note infos, which are only used
+again once `notesModTime` shows that the note did not change.
+
+With a `ReadCacheStore`, note and card infos are also kept on disk for later
+runs. An entry from disk is only used once `notesModTime` or `cardsModTime`
+shows that the note or card has not been modified since it was stored; the
+modification times are small and cheap to fetch compared to the infos.
+"""
+
+import collections
+import json
+import logging
+import os
+import os.path
+import sqlite3
+import threading
+
+from pockexport_to_anki.ankiconnect import batched
+from pockexport_to_anki.metrics import metrics
+from pockexport_to_anki.state import default_state_db_path
+
+logger = logging.getLogger("pockexport-to-anki")
+
+# Default maximum size of the on-disk cache, in MiB.
+READ_CACHE_SIZE_MB = 64
+# Number of IDs per query to the on-disk cache.
+STORE_BATCH_SIZE = 500
+
+# Actions answered per note or card: the action, the parameter holding the
+# IDs, the ID key of each result and the kind of entry.
+ENTITY_ACTIONS = {
+    "notesInfo": ("notes", "noteId", "note"),
+    "cardsInfo": ("cards", "cardId", "card"),
+    "notesModTime": ("notes", "noteId", "note_mod"),
+    "cardsModTime": ("cards", "cardId", "card_mod"),
+}
+QUERY_ACTIONS = ("findNotes", "findCards")
+# Writes, and the parameter holding the ID of the note or card they modify.
+NOTE_WRITES = {
+    "updateNoteFields": lambda params: params["note"]["id"],
+    "updateNoteTags": lambda params: params["note"],
+    "addTags": None,
+    "removeTags": None,
+}
+CARD_WRITES = {
+    "setSpecificValueOfCard": lambda params: params["card"],
+}
+
+
+def default_read_cache_path():
+    return os.path.join(os.path.dirname(default_state_db_path()), "read_cache.sqlite3")
+
+
+class ReadCacheStore:
+    """SQLite file holding note and card infos between runs, evicting the
+    least recently used entries once it grows past `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes=READ_CACHE_SIZE_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    kind TEXT NOT NULL,
+                    id INTEGER NOT NULL,
+                    mod INTEGER NOT NULL,
+                    note INTEGER NOT NULL,
+                    note_mod INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    used INTEGER NOT NULL,
+                    PRIMARY KEY (kind, id)
+                )
+                """
+            )
+        # Entries used in this run are stamped with one more than the most
+        # recent stamp, so that eviction removes those unused the longest.
+        (last_used,) = self._conn.execute(
+            "SELECT COALESCE(MAX(used), 0) FROM entries"
+        ).fetchone()
+        self._run = last_used + 1
+        # Map `(kind, id)` to the row to write at the next `commit`, or None
+        # to delete the entry.
+        self._pending = dict()
+        self._used = set()
+
+    def get(self, kind, ids):
+        """Return a dict mapping each ID in `ids` stored as `kind` to its
+        `(mod, note, note_mod, data)`: for cards, `note` and `note_mod` are
+        the ID and modification time of the note when the card was stored.
+        """
+        entries = dict()
+        with self._lock:
+            for batch in batched(ids, STORE_BATCH_SIZE):
+                for id, *entry in self._conn.execute(
+                    "SELECT id, mod, note, note_mod, data FROM entries WHERE kind = ?"
+                    f" AND id IN ({','.join('?' * len(batch))})",
+                    (kind, *batch),
+                ):
+                    entries[id] = tuple(entry)
+            for id in ids:
+                row = self._pending.get((kind, id), False)
+                if row is None:
+                    entries.pop(id, None)
+                elif row:
+                    entries[id] = row[2:6]
+        return entries
+
+    def used(self, kind, ids):
+        with self._lock:
+            self._used.update((kind, id) for id in ids)
+
+    def put(self, kind, id, mod, note, note_mod, data):
+        with self._lock:
+            self._pending[(kind, id)] = (kind, id, mod, note, note_mod, data, self._run)
+
+    def delete(self, kind, ids):
+        with self._lock:
+            for id in ids:
+                self._pending[(kind, id)] = None
+
+    def commit(self):
+        """Write the pending changes, then evict entries until the cache fits
+        in `max_bytes`.
+        """
+        with self._lock, self._conn:
+            pending, self._pending = self._pending, dict()
+            used, self._used = self._used, set()
+            self._conn.executemany(
+                "DELETE FROM entries WHERE kind = ? AND id = ?",
+                [key for key, row in pending.items() if row is None],
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [row for row in pending.values() if row is not None],
+            )
+            self._conn.executemany(
+                "UPDATE entries SET used = ? WHERE kind = ? AND id = ?",
+                [(self._run, kind, id) for kind, id in used],
+            )
+            (size,) = self._conn.execute(
+                "SELECT COALESCE(SUM(LENGTH(data)), 0) FROM entries"
+            ).fetchone()
+            if size <= self.max_bytes:
+                return
+            evict = list()
+            for kind, id, length in self._conn.execute(
+                "SELECT kind, id, LENGTH(data) FROM entries ORDER BY used, id"
+            ):
+                if size <= self.max_bytes:
+                    break
+                evict.append((kind, id))
+                size -= length
+            self._conn.executemany(
+                "DELETE FROM entries WHERE kind = ? AND id = ?", evict
+            )
+            logger.info(f"Evicted {len(evict)} entries from the read cache")
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+
+class _Read:
+    """A read being answered by `CachedAnki`: the entries found in the cache,
+    and the payload to send for the rest, if any.
+    """
+
+    __slots__ = ("payload", "cached", "forward", "generation")
+
+    def __init__(self, payload, cached, forward, generation):
+        self.payload = payload
+        self.cached = cached
+        self.forward = forward
+        self.generation = generation
+
+
+class CachedAnki:
+    """Read-through cache in front of the AnkiConnect client `client`, with
+    the same `request`, `invoke` and `stream` methods.
+
+    If `store` (a `ReadCacheStore`) is given, note and card infos are also
+    looked up in and saved to it.
+    """
+
+    def __init__(self, client, store=None):
+        self.client = client
+        self.store = store
+        # Map kind of entry to a dict mapping note or card ID to its cached
+        # value, for the kinds in `ENTITY_ACTIONS`: `(mod, data)` for note
+        # and card infos, with `data` the info as JSON, and the modification
+        # time for `note_mod` and `card_mod`.
+        self._entries = dict((kind, dict()) for _, _, kind in ENTITY_ACTIONS.values())
+        # Map note ID to the IDs of its cached card infos.
+        self._note_cards = dict()
+        # Note infos cached before the last `sync`, as in `_entries`, to be
+        # checked against their modification time before use.
+        self._expired = dict()
+        # Map `(action, params)` to the result of a query.
+        self._queries = dict()
+        # Incremented on every write, so that results read before a write
+        # completed are not cached.
+        self._generation = 0
+        self._lock = threading.RLock()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    @property
+    def max_in_flight(self):
+        return self.client.max_in_flight
+
+    def set_max_in_flight(self, max_in_flight):
+        self.client.set_max_in_flight(max_in_flight)
+
+    def request(self, payload):
+        if payload["action"] == "multi":
+            return {
+                "result": list(self.stream(payload["params"]["actions"])),
+                "error": None,
+            }
+        read = self._prepare(payload)
+        if read is None:
+            return self.client.request(payload)
+        if read.forward is None:
+            return self._finish(read, None)
+        return self._finish(read, self.client.request(read.forward))
+
+    def invoke(self, action, **params):
+        payload = {"action": action}
+        if params:
+            payload["params"] = params
+        return self.request(payload)["result"]
+
+    def stream(self, payloads, batch_size=None):
+        """Like `AnkiConnect.stream`, sending only the reads that are not
+        cached.
+        """
+        reads = collections.deque()
+
+        def forward():
+            for payload in payloads:
+                read = self._prepare(payload)
+                if read is None:
+                    read = _Read(payload, None, payload, None)
+                reads.append(read)
+                if read.forward is not None:
+                    yield read.forward
+
+        for response in self.client.stream(forward(), batch_size):
+            while True:
+                read = reads.popleft()
+                if read.forward is None:
+                    yield self._finish(read, None)
+                    continue
+                yield self._finish(read, response)
+                break
+        while reads:
+            yield self._finish(reads.popleft(), None)
+
+    def _prepare(self, payload):
+        """Return a `_Read` for `payload`, or None if it is not cached."""
+        action = payload["action"]
+        params = payload.get("params") or dict()
+        with self._lock:
+            if action in ENTITY_ACTIONS and ENTITY_ACTIONS[action][0] in params:
+                key, _, kind = ENTITY_ACTIONS[action]
+                ids = params[key]
+                cached = self._lookup(kind, ids)
+                self.hits[kind] += len(cached)
+                missing = [id for id in ids if id not in cached]
+                self.misses[kind] += len(missing)
+                forward = (
+                    dict(payload, params=dict(params, **{key: missing}))
+                    if missing
+                    else None
+                )
+                return _Read(payload, cached, forward, self._generation)
+            if action in QUERY_ACTIONS:
+                query = (action, json.dumps(params, sort_keys=True))
+                if query in self._queries:
+                    self.hits["query"] += 1
+                    return _Read(payload, self._queries[query], None, None)
+                self.misses["query"] += 1
+                return _Read(payload, None, payload, self._generation)
+            if action == "sync":
+                self._expire()
+            elif action in NOTE_WRITES or action in CARD_WRITES:
+                self._invalidate(action, params)
+            elif action in ("addNote", "addNotes", "deleteNotes"):
+                self._generation += 1
+                self._queries.clear()
+            return None
+
+    def _finish(self, read, response):
+        """Return the response to `read.payload`, from the cached entries and
+        `response` to `read.forward`, and cache the results in `response`.
+        """
+        if read.cached is None:
+            if response is not None and read.generation is not None:
+                self._cache_query(read, response)
+            return response
+        action = read.payload["action"]
+        params = read.payload.get("params") or dict()
+        if action in QUERY_ACTIONS:
+            return {"result": read.cached, "error": None}
+        key, id_key, kind = ENTITY_ACTIONS[action]
+        if kind in ("note", "card"):
+            results = dict((id, json.loads(data)) for id, data in read.cached.items())
+        else:
+            results = dict(
+                (id, {id_key: id, "mod": mod}) for id, mod in read.cached.items()
+            )
+        if response is not None:
+            if response["error"] is not None:
+                return response
+            fetched = [x for x in response["result"] or [] if x]
+            with self._lock:
+                if read.generation == self._generation:
+                    self._cache(kind, fetched)
+            results.update((x[id_key], x) for x in fetched)
+        if kind in ("note", "card"):
+            # Like AnkiConnect, give an empty result for missing notes or
+            # cards.
+            result = [results.get(id, dict()) for id in params[key]]
+        else:
+            result = [results[id] for id in params[key] if id in results]
+        return {"result": result, "error": None}
+
+    def _cache_query(self, read, response):
+        params = read.payload.get("params") or dict()
+        if response["error"] is None and read.payload["action"] in QUERY_ACTIONS:
+            with self._lock:
+                if read.generation == self._generation:
+                    query = (read.payload["action"], json.dumps(params, sort_keys=True))
+                    self._queries[query] = response["result"]
+
+    def _lookup(self, kind, ids):
+        """Return a dict mapping the IDs in `ids` that are cached as `kind` to
+        their cached value, checking the entries from the store against the
+        current modification times.
+        """
+        entries = self._entries[kind]
+        if kind in ("note", "card"):
+            cached = dict((id, entries[id][1]) for id in ids if id in entries)
+        else:
+            cached = dict((id, entries[id]) for id in ids if id in entries)
+        if kind == "note" and self._expired:
+            expired = dict(
+                (id, self._expired.pop(id))
+                for id in ids
+                if id not in cached and id in self._expired
+            )
+            if expired:
+                self._fetch_mods("note_mod", list(expired))
+                mods = self._entries["note_mod"]
+                for id, (mod, data) in expired.items():
+                    if mods.get(id) == mod:
+                        entries[id] = (mod, data)
+                        cached[id] = data
+        if self.store is None or kind not in ("note", "card"):
+            return cached
+        stored = self.store.get(kind, [id for id in ids if id not in cached])
+        if not stored:
+            return cached
+        mod_kind = kind + "_mod"
+        self._fetch_mods(mod_kind, list(stored))
+        if kind == "card":
+            self._fetch_mods(
+                "note_mod", list(set(note for _, note, _, _ in stored.values()))
+            )
+        mods = self._entries[mod_kind]
+        note_mods = self._entries["note_mod"]
+        valid = list()
+        for id, (mod, note, note_mod, data) in stored.items():
+            if mods.get(id) != mod:
+                continue
+            # Card infos include the fields of their note.
+            if kind == "card":
+                if note_mods.get(note) != note_mod:
+                    continue
+                self._note_cards.setdefault(note, set()).add(id)
+            entries[id] = (mod, data)
+            cached[id] = data
+            valid.append(id)
+        self.store.used(kind, valid)
+        return cached
+
+    def _fetch_mods(self, mod_kind, ids):
+        """Fetch the modification times of the notes or cards in `ids` that
+        are not cached yet.
+        """
+        action = "notesModTime" if mod_kind == "note_mod" else "cardsModTime"
+        key, id_key, _ = ENTITY_ACTIONS[action]
+        ids = [id for id in ids if id not in self._entries[mod_kind]]
+        if not ids:
+            return
+        payloads = [
+            {"action": action, "params": {key: list(batch)}}
+            for batch in batched(ids, STORE_BATCH_SIZE)
+        ]
+        for response in self.client.stream(payloads):
+            self._cache(mod_kind, [x for x in response["result"] or [] if x])
+
+    def _cache(self, kind, results):
+        entries = self._entries[kind]
+        if kind in ("note_mod", "card_mod"):
+            # A changed modification time means that the note or card was
+            # modified outside of this run.
+            info_kind = kind[:-4]
+            id_key = "noteId" if kind == "note_mod" else "cardId"
+            for x in results:
+                id = x[id_key]
+                entry = self._entries[info_kind].get(id)
+                if entry is not None and entry[0] != x["mod"]:
+                    if kind == "note_mod":
+                        self._drop_notes([id])
+                    else:
+                        self._drop("card", [id])
+                entries[id] = x["mod"]
+            return
+        # Infos are kept as JSON, which takes a fraction of the memory of
+        # the decoded dicts.
+        if kind == "card" and self.store is None:
+            # Card infos are not read again within a run, so only cache them
+            # to keep them for later runs.
+            return
+        for x in results:
+            mod = x.get("mod")
+            data = json.dumps(x, separators=(",", ":"))
+            if kind == "note":
+                entries[x["noteId"]] = (mod, data)
+                if self.store is not None and mod is not None:
+                    self.store.put(kind, x["noteId"], mod, 0, 0, data)
+                continue
+            entries[x["cardId"]] = (mod, data)
+            self._note_cards.setdefault(x["note"], set()).add(x["cardId"])
+            note = self._entries["note"].get(x["note"])
+            if (
+                self.store is not None
+                and mod is not None
+                and note is not None
+                and note[0] is not None
+            ):
+                self.store.put(kind, x["cardId"], mod, x["note"], note[0], data)
+
+    def _drop(self, kind, ids):
+        entries = self._entries[kind]
+        for id in ids:
+            entries.pop(id, None)
+        if self.store is not None and kind in ("note", "card"):
+            self.store.delete(kind, ids)
+
+    def _drop_notes(self, note_ids):
+        self._drop("note", note_ids)
+        # Card infos include the fields of their note.
+        self._drop(
+            "card",
+            [
+                card_id
+                for note_id in note_ids
+                for card_id in self._note_cards.pop(note_id, ())
+            ],
+        )
+
+    def _invalidate(self, action, params):
+        self._generation += 1
+        self._queries.clear()
+        if action in CARD_WRITES:
+            card_ids = [CARD_WRITES[action](params)]
+            self._drop("card", card_ids)
+            self._drop("card_mod", card_ids)
+            return
+        if NOTE_WRITES[action] is not None:
+            note_ids = [NOTE_WRITES[action](params)]
+        else:
+            note_ids = params.get("notes", [])
+        self._drop_notes(note_ids)
+        self._drop("note_mod", note_ids)
+
+    def _expire(self):
+        # A sync with AnkiWeb may have changed any note or card. Keep the
+        # note infos to check later, since most notes did not change.
+        with self._lock:
+            expired = dict(self._expired)
+            expired.update(self._entries["note"])
+            self.clear()
+            self._expired = expired
+
+    def clear(self):
+        """Drop everything cached in memory."""
+        with self._lock:
+            self._generation += 1
+            self._queries.clear()
+            self._note_cards.clear()
+            self._expired.clear()
+            for entries in self._entries.values():
+                entries.clear()
+
+    def close(self):
+        metrics.record_cache(self.hits, self.misses)
+        if self.store is not None:
+            self.store.close()
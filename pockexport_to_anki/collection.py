@@ -0,0 +1,702 @@
+"""Direct access to an Anki collection file, in place of AnkiConnect.
+
+`AnkiCollection` answers the AnkiConnect actions used by the sync by reading
+and writing the `collection.anki2` SQLite database itself, so neither Anki
+nor AnkiConnect need to be running. Both the legacy schema (note types and
+decks as JSON in the `col` table) and the current one (`notetypes`,
+`fields`, `templates` and `decks` tables) are supported.
+
+Anki locks the collection while it is open, so Anki must be closed while
+the sync runs. Changes are marked for the next AnkiWeb sync, which has to
+be done from Anki.
+"""
+
+import hashlib
+import html
+import json
+import logging
+import random
+import re
+import sqlite3
+import string
+import threading
+import time
+import urllib.parse
+
+from pockexport_to_anki.ankiconnect import batched
+from pockexport_to_anki.metrics import metrics
+
+logger = logging.getLogger("pockexport-to-anki")
+
+# Maximum number of IDs per `IN (...)` query.
+SQL_BATCH_SIZE = 500
+# Card columns that `setSpecificValueOfCard` may set.
+CARD_COLUMNS = {
+    "did",
+    "due",
+    "type",
+    "queue",
+    "ivl",
+    "factor",
+    "reps",
+    "lapses",
+    "left",
+    "odue",
+    "odid",
+    "flags",
+}
+# SQL conditions for the `is:` searches.
+CARD_STATES = {
+    "new": "c.type = 0",
+    "learn": "c.queue IN (1, 3)",
+    "review": "c.type IN (2, 3)",
+    "suspended": "c.queue = -1",
+    "buried": "c.queue IN (-2, -3)",
+}
+# Field number of `sort_field_idx` in the `Notetype.Config` protobuf
+# message stored in `notetypes.config`.
+NOTETYPE_SORT_FIELD = 2
+# Separator of the fields of a note in `notes.flds`.
+FIELD_SEPARATOR = "\x1f"
+_GUID_CHARS = string.ascii_letters + string.digits + "!#$%&()*+,-./:;<=>?@[]^_`{|}~"
+_TAG_RE = re.compile(r"<[^>]*>")
+# Separate from the `random` module, so that adding notes does not change the
+# random order of new cards.
+_guid_random = random.Random()
+
+
+class AnkiCollectionError(Exception):
+    pass
+
+
+def strip_html(text):
+    return html.unescape(_TAG_RE.sub("", text)).strip()
+
+
+def field_checksum(text):
+    """Return the checksum Anki stores in `notes.csum` for the first field."""
+    return int(hashlib.sha1(strip_html(text).encode()).hexdigest()[:8], 16)
+
+
+def _varint(data, i):
+    """Return the protobuf varint at `i` in `data`, and the index after it."""
+    value = shift = 0
+    while True:
+        byte = data[i]
+        i += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, i
+
+
+def _protobuf_int(data, number):
+    """Return the integer field `number` of the protobuf message `data`, or 0,
+    its default, if it is not set.
+    """
+    i = 0
+    while i < len(data):
+        key, i = _varint(data, i)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, i = _varint(data, i)
+            if key >> 3 == number:
+                return value
+        elif wire_type == 1:
+            i += 8
+        elif wire_type == 2:
+            length, i = _varint(data, i)
+            i += length
+        elif wire_type == 5:
+            i += 4
+        else:
+            raise AnkiCollectionError(f"unsupported protobuf wire type {wire_type}")
+    return 0
+
+
+def new_guid():
+    n = _guid_random.getrandbits(64)
+    chars = list()
+    while n:
+        n, rem = divmod(n, len(_GUID_CHARS))
+        chars.append(_GUID_CHARS[rem])
+    return "".join(reversed(chars)) or _GUID_CHARS[0]
+
+
+def _unicase(a, b):
+    a, b = a.casefold(), b.casefold()
+    return (a > b) - (a < b)
+
+
+class NoteType:
+    def __init__(self, id, name, fields, template_ords, cloze, sort_field=0):
+        self.id = id
+        self.name = name
+        # Field names, in order.
+        self.fields = fields
+        self.template_ords = template_ords
+        self.cloze = cloze
+        self.sort_field = sort_field
+
+
+class AnkiCollection:
+    """Stand-in for `AnkiConnect` backed by a collection file.
+
+    The collection is opened read-only unless `write` is true, in which case
+    Anki must not have it open. Offers the `request`, `invoke` and
+    `stream` methods of `AnkiConnect`, for the actions used by the sync.
+    """
+
+    def __init__(self, path, write=False):
+        self.path = path
+        self.write = write
+        self.max_in_flight = 1
+        mode = "rw" if write else "ro"
+        try:
+            self._db = sqlite3.connect(
+                f"file:{urllib.parse.quote(str(path))}?mode={mode}",
+                uri=True,
+                check_same_thread=False,
+            )
+        except sqlite3.Error as e:
+            raise AnkiCollectionError(f"cannot open {path}: {e}") from None
+        # Anki's tables use this collation for tag and deck names.
+        self._db.create_collation("unicase", _unicase)
+        self._lock = threading.RLock()
+        self._changed = False
+        self._last_id = 0
+        self._actions = {
+            "findNotes": self.find_notes,
+            "findCards": self.find_cards,
+            "notesInfo": self.notes_info,
+            "cardsInfo": self.cards_info,
+            "notesModTime": self.notes_mod_time,
+            "cardsModTime": self.cards_mod_time,
+            "canAddNotes": self.can_add_notes,
+            "addNotes": self.add_notes,
+            "updateNoteFields": self.update_note_fields,
+            "updateNoteTags": self.update_note_tags,
+            "addTags": self.add_tags,
+            "removeTags": self.remove_tags,
+            "setSpecificValueOfCard": self.set_specific_value_of_card,
+            "sync": self.sync,
+        }
+        try:
+            self._load_schema()
+        except sqlite3.Error as e:
+            # Anki holds a lock on the collection while it is open.
+            raise AnkiCollectionError(
+                f"cannot read {path}: {e}; is Anki running?"
+            ) from None
+
+    def _has_table(self, name):
+        return (
+            self._db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                (name,),
+            ).fetchone()
+            is not None
+        )
+
+    def _load_schema(self):
+        self.legacy = not self._has_table("notetypes")
+        self.note_types = dict()
+        self.decks = dict()
+        if self.legacy:
+            models_json, decks_json = self._db.execute(
+                "SELECT models, decks FROM col"
+            ).fetchone()
+            for model in json.loads(models_json).values():
+                self.note_types[model["name"]] = NoteType(
+                    int(model["id"]),
+                    model["name"],
+                    [f["name"] for f in sorted(model["flds"], key=lambda f: f["ord"])],
+                    [t["ord"] for t in model["tmpls"]],
+                    model.get("type") == 1,
+                    model.get("sortf", 0),
+                )
+            for deck in json.loads(decks_json).values():
+                self.decks[deck["name"]] = int(deck["id"])
+        else:
+            fields = dict()
+            for ntid, name in self._db.execute(
+                "SELECT ntid, name FROM fields ORDER BY ntid, ord"
+            ):
+                fields.setdefault(ntid, list()).append(name)
+            templates = dict()
+            cloze = set()
+            for ntid, ord, config in self._db.execute(
+                "SELECT ntid, ord, config FROM templates ORDER BY ntid, ord"
+            ):
+                templates.setdefault(ntid, list()).append(ord)
+                # The template config is a protobuf message holding the
+                # template text; cloze note types use `{{cloze:`.
+                if b"{{cloze:" in (config or b""):
+                    cloze.add(ntid)
+            for ntid, name, config in self._db.execute(
+                "SELECT id, name, config FROM notetypes"
+            ):
+                self.note_types[name] = NoteType(
+                    ntid,
+                    name,
+                    fields.get(ntid, []),
+                    templates.get(ntid, []),
+                    ntid in cloze,
+                    _protobuf_int(config or b"", NOTETYPE_SORT_FIELD),
+                )
+            for did, name in self._db.execute("SELECT id, name FROM decks"):
+                self.decks[name.replace("\x1f", "::")] = did
+        self.note_types_by_id = dict((nt.id, nt) for nt in self.note_types.values())
+
+    # The `AnkiConnect` interface.
+
+    def set_max_in_flight(self, max_in_flight):
+        # SQLite access is serialized anyway.
+        pass
+
+    def request(self, payload):
+        start = time.perf_counter()
+        action = payload["action"]
+        params = payload.get("params") or dict()
+        with self._lock:
+            if action == "multi":
+                result = [
+                    self._call(p["action"], p.get("params")) for p in params["actions"]
+                ]
+                response = {"result": result, "error": None}
+            else:
+                response = self._call(action, params)
+            self._commit()
+        metrics.record_request(
+            "collection",
+            action,
+            time.perf_counter() - start,
+            actions=len(params["actions"]) if action == "multi" else 1,
+        )
+        if response["error"] is not None:
+            logger.warning("payload %s had response error: %s", payload, response)
+        return response
+
+    def invoke(self, action, **params):
+        payload = {"action": action}
+        if params:
+            payload["params"] = params
+        return self.request(payload)["result"]
+
+    def stream(self, payloads, batch_size=None):
+        for batch in batched(payloads, batch_size or SQL_BATCH_SIZE):
+            for payload, response in zip(
+                batch,
+                self.request({"action": "multi", "params": {"actions": list(batch)}})[
+                    "result"
+                ],
+            ):
+                if response["error"] is not None:
+                    logger.warning(
+                        "payload %s had response error: %s", payload, response
+                    )
+                yield response
+
+    def _call(self, action, params):
+        try:
+            f = self._actions[action]
+        except KeyError:
+            return {"result": None, "error": f"unsupported action {action}"}
+        try:
+            return {"result": f(**(params or dict())), "error": None}
+        except (AnkiCollectionError, sqlite3.Error, KeyError, ValueError) as e:
+            return {"result": None, "error": str(e)}
+
+    def _commit(self):
+        if self._db.in_transaction:
+            if self._changed:
+                self._db.execute("UPDATE col SET mod = ?", (int(time.time() * 1000),))
+                self._changed = False
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._db.close()
+
+    # Searches.
+
+    def _search(self, query, cards):
+        """Return the IDs of the notes, or the cards if `cards`, matching
+        `query`. Supports the subset of the Anki search syntax used by the
+        sync: `note:`, `deck:`, `edited:`, `is:new`, `is:learn`,
+        `is:review`, `is:suspended`, `is:buried`, `field:value` with `*` and
+        `_` wildcards, and `-` negation.
+        """
+        clauses = list()
+        params = list()
+        field_tests = list()
+        join_cards = cards
+        for token in re.findall(r'-?"[^"]*"|-?\S+:"[^"]*"|\S+', query):
+            negate = token.startswith("-")
+            if negate:
+                token = token[1:]
+            token = token.replace('"', "")
+            key, sep, value = token.partition(":")
+            if not sep:
+                raise AnkiCollectionError(f"unsupported search term {token!r}")
+            key = key.lower()
+            if key == "note":
+                mids = [
+                    str(note_type.id)
+                    for name, note_type in self.note_types.items()
+                    if name.lower() == value.lower()
+                ]
+                clause = f"n.mid IN ({','.join(mids) or 'NULL'})"
+            elif key == "deck":
+                dids = [
+                    str(did)
+                    for name, did in self.decks.items()
+                    if name.lower() == value.lower()
+                    or name.lower().startswith(value.lower() + "::")
+                ]
+                clause = f"c.did IN ({','.join(dids) or 'NULL'})"
+                join_cards = True
+            elif key == "edited":
+                clause = "n.mod > ?"
+                params.append(int(time.time()) - int(value) * 86400)
+            elif key == "is" and value in CARD_STATES:
+                clause = CARD_STATES[value]
+                join_cards = True
+            else:
+                field_tests.append((key, _value_pattern(value), negate))
+                continue
+            clauses.append(f"NOT ({clause})" if negate else clause)
+        if join_cards:
+            sql = (
+                f"SELECT DISTINCT {'c' if cards else 'n'}.id, n.mid, n.flds"
+                " FROM cards c JOIN notes n ON c.nid = n.id"
+            )
+        else:
+            sql = "SELECT n.id, n.mid, n.flds FROM notes n"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY 1"
+        ids = list()
+        for id, mid, flds in self._db.execute(sql, params):
+            if field_tests and not self._fields_match(mid, flds, field_tests):
+                continue
+            ids.append(id)
+        return ids
+
+    def _fields_match(self, mid, flds, field_tests):
+        note_type = self.note_types_by_id.get(mid)
+        if note_type is None:
+            return False
+        values = dict(zip(note_type.fields, flds.split(FIELD_SEPARATOR)))
+        for name, pattern, negate in field_tests:
+            value = next((v for k, v in values.items() if k.lower() == name), None)
+            matched = value is not None and pattern.fullmatch(value) is not None
+            if matched == negate:
+                return False
+        return True
+
+    def find_notes(self, query):
+        return self._search(query, cards=False)
+
+    def find_cards(self, query):
+        return self._search(query, cards=True)
+
+    # Reads.
+
+    def _rows(self, sql, ids):
+        """Yield the rows of `sql`, with `%s` replaced by placeholders for
+        each batch of `ids`."""
+        for batch in batched(ids, SQL_BATCH_SIZE):
+            yield from self._db.execute(sql % ",".join("?" * len(batch)), batch)
+
+    def _fields_info(self, note_type, flds):
+        return dict(
+            (name, {"value": value, "order": i})
+            for i, (name, value) in enumerate(
+                zip(note_type.fields, flds.split(FIELD_SEPARATOR))
+            )
+        )
+
+    def notes_info(self, notes):
+        notes = [int(n) for n in notes]
+        card_ids = dict()
+        for nid, cid in self._rows(
+            "SELECT nid, id FROM cards WHERE nid IN (%s) ORDER BY nid, ord", notes
+        ):
+            card_ids.setdefault(nid, list()).append(cid)
+        infos = dict()
+        for nid, mid, mod, tags, flds in self._rows(
+            "SELECT id, mid, mod, tags, flds FROM notes WHERE id IN (%s)", notes
+        ):
+            note_type = self.note_types_by_id[mid]
+            infos[nid] = {
+                "noteId": nid,
+                "modelName": note_type.name,
+                "tags": tags.split(),
+                "fields": self._fields_info(note_type, flds),
+                "cards": card_ids.get(nid, []),
+                "mod": mod,
+            }
+        return [infos.get(nid, dict()) for nid in notes]
+
+    def cards_info(self, cards):
+        cards = [int(c) for c in cards]
+        deck_names = dict((did, name) for name, did in self.decks.items())
+        infos = dict()
+        for row in self._rows(
+            "SELECT c.id, c.nid, c.did, c.ord, c.mod, c.type, c.queue, c.due,"
+            " c.ivl, c.factor, c.reps, c.lapses, c.left, n.mid, n.flds"
+            " FROM cards c JOIN notes n ON c.nid = n.id WHERE c.id IN (%s)",
+            cards,
+        ):
+            cid, nid, did, ord, mod, type, queue, due = row[:8]
+            ivl, factor, reps, lapses, left, mid, flds = row[8:]
+            note_type = self.note_types_by_id[mid]
+            infos[cid] = {
+                "cardId": cid,
+                "note": nid,
+                "deckName": deck_names.get(did, ""),
+                "modelName": note_type.name,
+                "ord": ord,
+                "fieldOrder": ord,
+                "fields": self._fields_info(note_type, flds),
+                "type": type,
+                "queue": queue,
+                "due": due,
+                "interval": ivl,
+                "factor": factor,
+                "reps": reps,
+                "lapses": lapses,
+                "left": left,
+                "mod": mod,
+            }
+        return [infos.get(cid, dict()) for cid in cards]
+
+    def notes_mod_time(self, notes):
+        mods = dict(self._rows("SELECT id, mod FROM notes WHERE id IN (%s)", notes))
+        return [{"noteId": nid, "mod": mods[nid]} for nid in notes if nid in mods]
+
+    def cards_mod_time(self, cards):
+        mods = dict(self._rows("SELECT id, mod FROM cards WHERE id IN (%s)", cards))
+        return [{"cardId": cid, "mod": mods[cid]} for cid in cards if cid in mods]
+
+    # Writes.
+
+    def _check_writable(self):
+        if not self.write:
+            raise AnkiCollectionError("the collection is opened read-only")
+        self._changed = True
+
+    def _new_id(self):
+        """Return a new ID for `table`, from the current time in
+        milliseconds like Anki does.
+        """
+        if not self._last_id:
+            self._last_id = max(
+                self._db.execute("SELECT max(id) FROM notes").fetchone()[0] or 0,
+                self._db.execute("SELECT max(id) FROM cards").fetchone()[0] or 0,
+            )
+        self._last_id = max(int(time.time() * 1000), self._last_id + 1)
+        return self._last_id
+
+    def _write_note(self, nid, note_type, values, mod):
+        sort_value = values[note_type.sort_field] if values else ""
+        self._db.execute(
+            "UPDATE notes SET flds = ?, sfld = ?, csum = ?, mod = ?, usn = -1"
+            " WHERE id = ?",
+            (
+                FIELD_SEPARATOR.join(values),
+                strip_html(sort_value),
+                field_checksum(values[0] if values else ""),
+                mod,
+                nid,
+            ),
+        )
+
+    def update_note_fields(self, note):
+        self._check_writable()
+        nid = int(note["id"])
+        row = self._db.execute(
+            "SELECT mid, flds FROM notes WHERE id = ?", (nid,)
+        ).fetchone()
+        if row is None:
+            raise AnkiCollectionError(f"note was not found: {nid}")
+        note_type = self.note_types_by_id[row[0]]
+        values = row[1].split(FIELD_SEPARATOR)
+        for i, name in enumerate(note_type.fields):
+            if name in note["fields"]:
+                values[i] = str(note["fields"][name])
+        self._write_note(nid, note_type, values, int(time.time()))
+
+    def update_note_tags(self, note, tags):
+        self._check_writable()
+        tags = sorted(set(tags))
+        cursor = self._db.execute(
+            "UPDATE notes SET tags = ?, mod = ?, usn = -1 WHERE id = ?",
+            (f" {' '.join(tags)} " if tags else "", int(time.time()), int(note)),
+        )
+        if cursor.rowcount == 0:
+            raise AnkiCollectionError(f"note was not found: {note}")
+        self._register_tags(tags)
+
+    def add_tags(self, notes, tags):
+        tags = tags.split()
+
+        def change(note_tags):
+            known = set(tag.casefold() for tag in note_tags)
+            return note_tags + [tag for tag in tags if tag.casefold() not in known]
+
+        self._change_tags(notes, change)
+
+    def remove_tags(self, notes, tags):
+        removed = set(tag.casefold() for tag in tags.split())
+        self._change_tags(
+            notes,
+            lambda note_tags: [
+                tag for tag in note_tags if tag.casefold() not in removed
+            ],
+        )
+
+    def _change_tags(self, notes, change):
+        """Set the tags of each note in `notes` that `change`, a function of
+        the list of its tags, changes.
+        """
+        self._check_writable()
+        rows = list(self._rows("SELECT id, tags FROM notes WHERE id IN (%s)", notes))
+        for nid, note_tags in rows:
+            note_tags = note_tags.split()
+            tags = change(note_tags)
+            if tags != note_tags:
+                self.update_note_tags(nid, tags)
+
+    def _register_tags(self, tags):
+        if self.legacy:
+            (tags_json,) = self._db.execute("SELECT tags FROM col").fetchone()
+            known = json.loads(tags_json or "{}")
+            new = [tag for tag in tags if tag not in known]
+            if new:
+                known.update((tag, -1) for tag in new)
+                self._db.execute("UPDATE col SET tags = ?", (json.dumps(known),))
+        else:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO tags (tag, usn, collapsed) VALUES (?, -1, 0)",
+                [(tag,) for tag in tags],
+            )
+
+    def set_specific_value_of_card(self, card, keys, newValues):
+        self._check_writable()
+        for key in keys:
+            if key not in CARD_COLUMNS:
+                raise AnkiCollectionError(f"cannot set card attribute {key!r}")
+        assignments = ", ".join(f"{key} = ?" for key in keys)
+        cursor = self._db.execute(
+            f"UPDATE cards SET {assignments}, mod = ?, usn = -1 WHERE id = ?",
+            (*newValues, int(time.time()), int(card)),
+        )
+        if cursor.rowcount == 0:
+            raise AnkiCollectionError(f"card was not found: {card}")
+        return [True] * len(keys)
+
+    def _can_add(self, note):
+        """Return the note type and deck ID of `note`, or raise
+        `AnkiCollectionError` if it cannot be added.
+        """
+        note_type = self.note_types.get(note["modelName"])
+        if note_type is None:
+            raise AnkiCollectionError(f"model was not found: {note['modelName']}")
+        if note_type.cloze:
+            raise AnkiCollectionError("cloze note types are not supported")
+        did = self.decks.get(note["deckName"])
+        if did is None:
+            raise AnkiCollectionError(f"deck was not found: {note['deckName']}")
+        first = str(note["fields"].get(note_type.fields[0], ""))
+        if not strip_html(first):
+            raise AnkiCollectionError("cannot create note because it is empty")
+        for (flds,) in self._db.execute(
+            "SELECT flds FROM notes WHERE mid = ? AND csum = ?",
+            (note_type.id, field_checksum(first)),
+        ):
+            if strip_html(flds.split(FIELD_SEPARATOR)[0]) == strip_html(first):
+                raise AnkiCollectionError(
+                    "cannot create note because it is a duplicate"
+                )
+        return note_type, did
+
+    def can_add_notes(self, notes):
+        result = list()
+        for note in notes:
+            try:
+                self._can_add(note)
+            except AnkiCollectionError:
+                result.append(False)
+            else:
+                result.append(True)
+        return result
+
+    def add_notes(self, notes):
+        self._check_writable()
+        return [self._add_note(note) for note in notes]
+
+    def _add_note(self, note):
+        try:
+            note_type, did = self._can_add(note)
+        except AnkiCollectionError as e:
+            logger.warning(f"cannot add note: {e}")
+            return None
+        values = [str(note["fields"].get(name, "")) for name in note_type.fields]
+        tags = sorted(set(note.get("tags", [])))
+        now = int(time.time())
+        nid = self._new_id()
+        self._db.execute(
+            "INSERT INTO notes (id, guid, mid, mod, usn, tags, flds, sfld, csum,"
+            " flags, data) VALUES (?, ?, ?, ?, -1, ?, '', '', 0, 0, '')",
+            (nid, new_guid(), note_type.id, now, f" {' '.join(tags)} " if tags else ""),
+        )
+        self._write_note(nid, note_type, values, now)
+        self._register_tags(tags)
+        due = self._next_position()
+        # One card per template: conditional templates that would render an
+        # empty front are not evaluated.
+        for ord in note_type.template_ords:
+            self._db.execute(
+                "INSERT INTO cards (id, nid, did, ord, mod, usn, type, queue, due,"
+                " ivl, factor, reps, lapses, left, odue, odid, flags, data)"
+                " VALUES (?, ?, ?, ?, ?, -1, 0, 0, ?, 0, 0, 0, 0, 0, 0, 0, 0, '')",
+                (self._new_id(), nid, did, ord, now, due),
+            )
+        return nid
+
+    def _next_position(self):
+        """Return the due position for the next new note, and advance it."""
+        if self.legacy:
+            (conf_json,) = self._db.execute("SELECT conf FROM col").fetchone()
+            conf = json.loads(conf_json)
+            position = conf.get("nextPos", 1)
+            conf["nextPos"] = position + 1
+            self._db.execute("UPDATE col SET conf = ?", (json.dumps(conf),))
+            return position
+        row = self._db.execute(
+            "SELECT val FROM config WHERE KEY = 'nextPos'"
+        ).fetchone()
+        position = json.loads(row[0]) if row else 1
+        self._db.execute(
+            "INSERT OR REPLACE INTO config (KEY, usn, mtime_secs, val)"
+            " VALUES ('nextPos', -1, ?, ?)",
+            (int(time.time()), json.dumps(position + 1).encode()),
+        )
+        return position
+
+    def sync(self):
+        logger.info("Not syncing the collection with AnkiWeb; sync it from Anki later")
+        return None
+
+
+def _value_pattern(value):
+    """Compile the value of an Anki `field:value` search, where `*` matches
+    any text and `_` any single character, to a regular expression.
+    """
+    pattern = "".join(
+        ".*" if c == "*" else "." if c == "_" else re.escape(c) for c in value
+    )
+    return re.compile(pattern, re.IGNORECASE | re.DOTALL)
@@ -0,0 +1,232 @@
+import logging
+
+from pockexport_to_anki.ankiconnect import batched
+from pockexport_to_anki.mapping import DEFAULT_MAPPING, SYNC_TIME_FIELD
+from pockexport_to_anki.model import note_info_hash, tag_table
+from pockexport_to_anki.plan import reconcile_note, tag_changes
+
+logger = logging.getLogger("pockexport-to-anki")
+
+BATCH_SIZE = 100
+
+
+def find_notes_without_items(anki, mapping, edited=None):
+    """Return the note infos of the Anki notes of the note type of `mapping`,
+    a `NoteMapping`, not added to Pocket yet, and the IDs of those of them
+    edited in the past `edited` days.
+    """
+    # Find notes with `given_url` and `given_title` not empty, but `item_id`
+    # empty.
+    query = (
+        f'"note:{mapping.note_type}" "{mapping.url_field}:_*"'
+        f' "{mapping.title_field}:_*" "{mapping.item_id_field}:"'
+    )
+    note_ids = anki.invoke("findNotes", query=query)
+    note_infos = anki.invoke("notesInfo", notes=note_ids)
+    if edited:
+        recently_edited = anki.invoke("findNotes", query=f"{query} edited:{edited}")
+    else:
+        recently_edited = list(note_ids)
+    return note_infos, set(recently_edited)
+
+
+def apply_pocket_adds(pocket_writer, anki_writes, adds, mapping=DEFAULT_MAPPING):
+    """Add the Anki notes in `adds` (see `plan_pocket_adds`) to Pocket, and
+    record the new item IDs in the notes, in the fields of `mapping`.
+
+    Returns a dict mapping Anki note ID to the Pocket item added for it.
+    """
+    for add in adds:
+        pocket_writer.add(
+            "add", item_id=0, url=add["url"], title=add["title"], tags=add["tags"]
+        )
+    new_items = dict()
+    for add, (res, err) in zip(adds, pocket_writer.flush()):
+        if err is None:
+            res["given_title"] = add["title"]
+            res["given_url"] = add["url"]
+            new_items[add["note_id"]] = res
+        else:
+            logger.error(
+                f"note_id {add['note_id']}: Error when adding new Pocket item: {err}"
+            )
+    for note_id, item in new_items.items():
+        anki_writes.update_note_fields(
+            note_id,
+            {
+                mapping.item_id_field: item["item_id"],
+                mapping.title_field: item["given_title"],
+                mapping.url_field: item["given_url"],
+            },
+        )
+    anki_writes.flush()
+    return new_items
+
+
+def create_notes(anki, plan, mapping=DEFAULT_MAPPING):
+    """Create the notes of `plan.new_notes` in bulk, then merge the plans for
+    their items into `plan`. The notes are read back with `mapping`.
+
+    Returns the merged `ItemPlan`s.
+    """
+    from pockexport_to_anki.snapshot import AnkiSnapshot
+
+    pending, plan.new_notes = plan.new_notes, list()
+    batches = list(batched(pending, BATCH_SIZE))
+    # Use `canAddNotes` to filter out duplicates up front, since `addNotes`
+    # fails as a whole if any note cannot be added.
+    payloads = [
+        {
+            "action": "canAddNotes",
+            "params": {"notes": [item_plan.new_note for item_plan in batch]},
+        }
+        for batch in batches
+    ]
+    addable = list()
+    for batch, response in zip(batches, anki.stream(payloads)):
+        for item_plan, can_add in zip(batch, response["result"] or []):
+            if can_add:
+                addable.append(item_plan)
+            else:
+                logger.warning(
+                    f"item {item_plan.item_id}: cannot create note, probably a duplicate"
+                )
+    note_ids = list()
+    for batch in batched(addable, BATCH_SIZE):
+        response = anki.request(
+            {
+                "action": "addNotes",
+                "params": {"notes": [item_plan.new_note for item_plan in batch]},
+            }
+        )
+        note_ids.extend(response["result"] or [None] * len(batch))
+    added = list()
+    for item_plan, note_id in zip(addable, note_ids):
+        if note_id:
+            item_plan.note_id = note_id
+            item_plan.note_hash = None
+            added.append(item_plan)
+        else:
+            logger.warning(f"item {item_plan.item_id}: failed to create note")
+    snapshot = AnkiSnapshot(anki, mapping)
+    snapshot.load_notes(
+        [item_plan.note_id for item_plan in added],
+        [item_plan.note_id for item_plan in added],
+    )
+    merged = list()
+    for item_plan in added:
+        note = snapshot.notes.get(item_plan.note_id)
+        if note is None:
+            logger.warning(f"note {item_plan.note_id}: failed to load new note")
+            continue
+        reconcile_note(
+            item_plan.item,
+            item_plan,
+            note,
+            snapshot.card_states,
+            snapshot.note_cards(note),
+            0,
+            0,
+        )
+        item_plan.new_note = None
+        item_plan.item = None
+        plan.merge(item_plan)
+        merged.append(item_plan)
+    return merged
+
+
+def apply_field_updates(anki_writes, plan):
+    for note_id, fields in plan.field_updates.items():
+        anki_writes.update_note_fields(note_id, fields)
+    return anki_writes.flush()
+
+
+def apply_pocket_actions(pocket_writer, plan):
+    for action, params in plan.pocket_actions():
+        pocket_writer.add(action, **params)
+    return pocket_writer.flush()
+
+
+def failed_items(plan, anki_failures=(), pocket_outcomes=()):
+    """Return the IDs of the items of `plan` whose writes failed, from the
+    failed Anki actions `anki_failures` returned by `AnkiWriteBuffer.flush`,
+    and the outcomes of `plan.pocket_actions()` returned by
+    `apply_pocket_actions`.
+    """
+    note_ids = set()
+    for payload, _ in anki_failures:
+        params = payload["params"]
+        if "notes" in params:
+            note_ids.update(params["notes"])
+        elif isinstance(params.get("note"), dict):
+            note_ids.add(params["note"]["id"])
+        elif "note" in params:
+            note_ids.add(params["note"])
+    item_ids = set(
+        item_id
+        for item_id, (note_id, _, _) in plan.synced_items.items()
+        if note_id in note_ids
+    )
+    item_ids.update(
+        str(params["item_id"])
+        for (_, params), (_, error) in zip(plan.pocket_actions(), pocket_outcomes)
+        if error is not None
+    )
+    return item_ids
+
+
+def apply_card_order(anki_writes, due_updates):
+    """Set the due position of the new cards, as `(card_id, due)` pairs from
+    `reorder.due_updates`.
+    """
+    for card_id, due in due_updates:
+        anki_writes.set_card_values(card_id, {"due": due})
+    anki_writes.flush()
+
+
+def apply_note_updates(anki, anki_writes, plan, sync_time):
+    """Write the new tags of the notes in `plan`, and set `time_last_synced`
+    to `sync_time` on every note changed by the sync.
+
+    Only the tags added and removed are written, as `addTags` and
+    `removeTags` for many notes at once, except for notes whose tags before
+    the sync are not known, whose tags are replaced. Returns the failed
+    writes, as `AnkiWriteBuffer.flush` does.
+    """
+    note_hashes = plan.note_hashes
+    tag_updated_notes = plan.tag_updated_notes
+    old_note_tags = plan.old_note_tags
+    if not note_hashes:
+        return list()
+    for batch in batched(list(note_hashes.keys()), BATCH_SIZE):
+        hashes_new = dict()
+        for ni in anki.invoke("notesInfo", notes=batch) or []:
+            if ni:
+                hashes_new[ni["noteId"]] = note_info_hash(ni)
+        note_ids_updated = (
+            set(note_id for note_id in batch if note_id in tag_updated_notes)
+            | set(
+                note_id
+                for note_id in batch
+                if note_id in hashes_new
+                and (
+                    note_hashes[note_id] is None
+                    or note_hashes[note_id] != hashes_new[note_id]
+                )
+            )
+            if hashes_new
+            else set()
+        )
+        for note_id in note_ids_updated:
+            anki_writes.update_note_fields(note_id, {SYNC_TIME_FIELD: str(sync_time)})
+            if note_id in old_note_tags:
+                added, removed = tag_changes(
+                    tag_updated_notes[note_id], old_note_tags[note_id]
+                )
+                anki_writes.remove_tags(note_id, removed)
+                anki_writes.add_tags(note_id, added)
+            elif note_id in tag_updated_notes:
+                anki_writes.update_note_tags(
+                    note_id, tag_table.names(tag_updated_notes[note_id])
+                )
+    return anki_writes.flush()
@@ -0,0 +1,138 @@
+import json
+
+from pockexport_to_anki.model import PocketItem
+
+CHUNK_SIZE = 1 << 16
+WHITESPACE = " \t\n\r"
+
+
+class _JSONStream:
+    """Incremental reader of JSON values from a text file.
+
+    Only as much of the file as is needed to decode the next value is kept
+    in memory.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError(f"{self.f.name}: unexpected end of JSON data")
+
+    def expect(self, ch):
+        found = self.peek()
+        if found != ch:
+            raise ValueError(f"{self.f.name}: expected {ch!r} but found {found!r}")
+        self.pos += 1
+
+    def value(self):
+        """Decode and return the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next
+            # chunk.
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_export_items(path):
+    """Yield the items in the `list` of a pockexport JSON data file, or of an
+    export store (see `pockexport_to_anki.store`).
+
+    The file is parsed incrementally, so memory usage is bounded by the size
+    of the largest item rather than the size of the file. Items are returned
+    in file order, as `PocketItem`s.
+    """
+    from pockexport_to_anki.store import ExportStore, is_export_store
+
+    if is_export_store(path):
+        with ExportStore(path) as store:
+            yield from store.items()
+        return
+    with open(path) as f:
+        stream = _JSONStream(f)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.value()
+            stream.expect(":")
+            if key != "list":
+                stream.value()
+            elif stream.peek() == "[":
+                # Pocket returns an empty array rather than an object for an
+                # empty list.
+                for item in stream.value():
+                    yield PocketItem.from_dict(item)
+            else:
+                stream.expect("{")
+                if stream.peek() != "}":
+                    while True:
+                        stream.value()
+                        stream.expect(":")
+                        yield PocketItem.from_dict(stream.value())
+                        if stream.peek() != ",":
+                            break
+                        stream.expect(",")
+                stream.expect("}")
+            if stream.peek() != ",":
+                break
+            stream.expect(",")
+        stream.expect("}")
+
+
+def iter_changed_items(path, old_path):
+    """Yield the items of `path` that were added or changed since `old_path`.
+
+    Each file is read once. Only the fingerprint of each item of `old_path`
+    is kept in memory, not the item itself. If both are export stores, only
+    their indexes are compared.
+    """
+    from pockexport_to_anki.store import ExportStore, is_export_store
+
+    if is_export_store(old_path):
+        with ExportStore(old_path) as old:
+            if is_export_store(path):
+                with ExportStore(path) as store:
+                    yield from store.changed_since(old)
+                return
+            old_fingerprints = dict(
+                (str(item_id), fingerprint) for item_id, fingerprint in old.index()
+            )
+    else:
+        old_fingerprints = dict(
+            (item.item_id, item.fingerprint()) for item in iter_export_items(old_path)
+        )
+    for item in iter_export_items(path):
+        if old_fingerprints.get(item.item_id) != item.fingerprint():
+            yield item
@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import os.path
+import time
+
+from pockexport_to_anki.model import NewCard, tag_table
+from pockexport_to_anki.plan import ItemPlan, SyncPlan
+from pockexport_to_anki.state import default_state_db_path
+
+logger = logging.getLogger("pockexport-to-anki")
+
+JOURNAL_VERSION = 1
+# Write a checkpoint after this many planned items, or this many seconds.
+CHECKPOINT_ITEMS = 1000
+CHECKPOINT_SECONDS = 30
+
+
+def default_journal_path():
+    return os.path.join(os.path.dirname(default_state_db_path()), "journal.jsonl")
+
+
+class JournalError(Exception):
+    pass
+
+
+class ResumedRun:
+    """What a previous, unfinished run recorded in its journal."""
+
+    def __init__(self):
+        self.plan = SyncPlan()
+        # IDs of the items already planned.
+        self.item_ids = set()
+        # Names of the stages completed.
+        self.stages = set()
+        # IDs of the items whose writes failed in the stages completed.
+        self.failed_items = set()
+        # `(card_id, due)` pairs decided by the due reordering stage.
+        self.card_updates = None
+        # `NewCard`s of the notes skipped as unchanged when planning.
+        self.unchanged_cards = list()
+        # Pocket items added for Anki notes, as returned by
+        # `apply_pocket_adds`.
+        self.pocket_new_items = dict()
+
+
+class Journal:
+    """Append-only log of the progress of a sync, so that a run that dies
+    partway can be resumed with `--resume`.
+
+    Each line is a JSON record: a `start` header describing the run, the
+    `pocket_adds` made for Anki notes, batches of `items` holding the
+    `ItemPlan`s of planned items, the `unchanged_cards` of the notes skipped
+    as unchanged, `card_updates` holding the new due positions, and a
+    `stage` record for each completed stage of the sync. Every action of a
+    stage is idempotent, so a stage that was interrupted is simply run
+    again. The journal is removed once the sync finishes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._pending = list()
+        self._last_checkpoint = time.monotonic()
+
+    def start(self, header):
+        """Start a new journal for the run described by the dict `header`."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.path):
+            logger.warning(
+                f"Discarding the journal of an unfinished run at {self.path};"
+                " use --resume to resume it instead"
+            )
+        self._file = open(self.path, "w")
+        self._write(dict(header, type="start", version=JOURNAL_VERSION))
+
+    def resume(self, header):
+        """Return a `ResumedRun` from the journal, and append to it from now
+        on. Starts a new journal and returns None if there is none.
+
+        Raises `JournalError` if the journal is for a different run than the
+        one described by `header`.
+        """
+        if not os.path.exists(self.path):
+            logger.info(f"No journal at {self.path}, starting a new sync")
+            self.start(header)
+            return None
+        resumed = ResumedRun()
+        with open(self.path) as f:
+            lines = f.read().split("\n")
+        for n, line in enumerate(lines):
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last record may have been cut short by the crash.
+                if n >= len(lines) - 2:
+                    break
+                raise JournalError(f"{self.path}:{n + 1}: corrupt journal record")
+            kind = record.pop("type")
+            if kind == "start":
+                if record != dict(header, version=JOURNAL_VERSION):
+                    raise JournalError(
+                        f"The journal at {self.path} is for a different export"
+                        " or options; run without --resume to start over"
+                    )
+            elif kind == "items":
+                for item_plan in record["plans"]:
+                    item_plan = ItemPlan.from_journal(item_plan)
+                    resumed.item_ids.add(item_plan.item_id)
+                    resumed.plan.merge(item_plan)
+            elif kind == "pocket_adds":
+                resumed.pocket_new_items.update(record["items"])
+            elif kind == "card_updates":
+                resumed.card_updates = [tuple(x) for x in record["updates"]]
+            elif kind == "unchanged_cards":
+                # Written again by each run that planned, so keep the last.
+                resumed.unchanged_cards = [
+                    NewCard(card_id, time_added, due, tag_table.ids(tags))
+                    for card_id, time_added, due, tags in record["cards"]
+                ]
+            elif kind == "stage":
+                resumed.stages.add(record["stage"])
+                resumed.failed_items.update(record.get("failed_items", ()))
+        # Unless planning completed, the resumed run collects these again.
+        if "plan" in resumed.stages:
+            resumed.plan.new_cards.extend(resumed.unchanged_cards)
+        logger.info(
+            f"Resuming from {self.path}: {len(resumed.item_ids)} items planned,"
+            f" stages done: {', '.join(sorted(resumed.stages)) or 'none'}"
+        )
+        self._file = open(self.path, "a")
+        return resumed
+
+    def add(self, item_plan):
+        """Record a planned item. Written at the next checkpoint."""
+        self._pending.append(item_plan.to_journal())
+        if (
+            len(self._pending) >= CHECKPOINT_ITEMS
+            or time.monotonic() - self._last_checkpoint >= CHECKPOINT_SECONDS
+        ):
+            self.checkpoint()
+
+    def checkpoint(self):
+        if self._pending:
+            self._write({"type": "items", "plans": self._pending})
+            self._pending = list()
+        self._last_checkpoint = time.monotonic()
+
+    def pocket_adds(self, new_items):
+        """Record the Pocket items added for Anki notes, as returned by
+        `apply_pocket_adds`. They are not in the pockexport data files, so
+        a resumed run would not sync them otherwise.
+        """
+        if new_items:
+            self._write({"type": "pocket_adds", "items": list(new_items.items())})
+
+    def unchanged_cards(self, cards):
+        """Record the `NewCard`s of the notes skipped as unchanged, which are
+        ordered with those of the planned items.
+        """
+        self._write(
+            {
+                "type": "unchanged_cards",
+                "cards": [
+                    [
+                        card.card_id,
+                        card.time_added,
+                        card.due,
+                        tag_table.names(card.tags),
+                    ]
+                    for card in cards
+                ],
+            }
+        )
+
+    def card_updates(self, updates):
+        self._write({"type": "card_updates", "updates": updates})
+
+    def stage(self, name, failed_items=()):
+        """Record that the stage `name` is complete, with the IDs of the
+        items whose writes failed in it.
+        """
+        self.checkpoint()
+        record = {"type": "stage", "stage": name}
+        if failed_items:
+            record["failed_items"] = sorted(failed_items)
+        self._write(record)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self.checkpoint()
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """Close and delete the journal, once the sync is complete."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._pending = list()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def journal_header(args):
+    """Return the `Journal` header for a run with the arguments `args`."""
+    header = dict(edited=args.edited, mapping=args.mapping.to_dict())
+    for key, path in [
+        ("export", args.pockexport_data_file),
+        ("export_old", args.pockexport_data_file_old),
+    ]:
+        if path is None:
+            header[key] = None
+            continue
+        st = os.stat(path)
+        header[key] = [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+    # With --from-pocket, the mirror is updated before planning, so a resumed
+    # run reads the same items plus any changed since.
+    header["pocket_mirror"] = (
+        os.path.abspath(args.pocket_mirror) if args.from_pocket else None
+    )
+    return header
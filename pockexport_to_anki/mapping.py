@@ -0,0 +1,225 @@
+"""How Pocket items map to Anki notes.
+
+A `NoteMapping` holds the deck and note type of the notes, and a list of
+`FieldMap`s declaring which attribute of a `PocketItem` each Anki field is
+synced from, and how the value is normalized. The mapping is compiled once
+into a function returning the canonical field values of an item as a tuple,
+and a 64-bit hash of those values, so that a note whose fields are up to date
+is recognized with a single integer comparison.
+"""
+
+import collections
+import hashlib
+import json
+import operator
+
+from pockexport_to_anki.model import PocketItem
+
+DEFAULT_DECK = "Articles"
+DEFAULT_NOTE_TYPE = "Pocket Article"
+# Field of the note type holding the time of the last sync of the note. Set by
+# the sync itself, not mapped from Pocket.
+SYNC_TIME_FIELD = "time_last_synced"
+
+# The Anki field `anki` is synced from the `PocketItem` attribute `pocket`,
+# normalized by the function `normalizer`, a name in `NORMALIZERS`.
+FieldMap = collections.namedtuple("FieldMap", ["anki", "pocket", "normalizer"])
+
+DEFAULT_FIELDS = (
+    FieldMap("item_id", "item_id", "text"),
+    FieldMap("given_url", "given_url", "text"),
+    FieldMap("given_title", "given_title", "text"),
+    FieldMap("resolved_url", "resolved_url", "text"),
+    FieldMap("resolved_title", "resolved_title", "text"),
+    FieldMap("time_added", "time_added", "text"),
+    FieldMap("word_count", "word_count", "text"),
+    FieldMap("time_to_read", "time_to_read", "text"),
+    FieldMap("excerpt", "excerpt", "text"),
+    FieldMap("authors", "authors", "names"),
+)
+# Pocket attributes the sync itself relies on, which must be mapped.
+REQUIRED_POCKET_FIELDS = ("item_id", "given_url", "given_title", "time_added")
+
+
+def unwrap_link(value):
+    """Return the target of the first HTML link in `value`, as Anki makes of
+    URLs pasted into a field, or `value` itself if it has no link.
+    """
+    if "<" not in value:
+        return value
+    import html.parser
+
+    class LinkParser(html.parser.HTMLParser):
+        href = None
+
+        def handle_starttag(self, tag, attrs):
+            if tag == "a" and self.href is None:
+                self.href = dict(attrs).get("href")
+
+    parser = LinkParser()
+    parser.feed(value)
+    parser.close()
+    return parser.href.strip() if parser.href else value
+
+
+def _text(value):
+    return value if isinstance(value, str) else "" if value is None else str(value)
+
+
+def _names(value):
+    return ", ".join(sorted(value))
+
+
+NORMALIZERS = {
+    "text": _text,
+    "names": _names,
+    "link": lambda value: unwrap_link(_text(value)),
+}
+
+
+def _hash(value):
+    digest = hashlib.blake2b(
+        json.dumps(value, separators=(",", ":")).encode(), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "big")
+
+
+class NoteMapping:
+    """The deck, note type and fields of the Anki notes of Pocket items.
+
+    Raises ValueError if `fields` maps unknown Pocket attributes, uses unknown
+    normalizers, or leaves out one of `REQUIRED_POCKET_FIELDS`.
+    """
+
+    def __init__(
+        self, deck_name=DEFAULT_DECK, note_type=DEFAULT_NOTE_TYPE, fields=DEFAULT_FIELDS
+    ):
+        self.deck_name = deck_name
+        self.note_type = note_type
+        self.fields = tuple(FieldMap(*field) for field in fields)
+        anki_by_pocket = dict()
+        for field in self.fields:
+            if field.pocket not in PocketItem.__slots__ or field.pocket == "tags":
+                raise ValueError(f"unknown Pocket field {field.pocket!r}")
+            if field.normalizer not in NORMALIZERS:
+                raise ValueError(f"unknown field normalizer {field.normalizer!r}")
+            if field.anki == SYNC_TIME_FIELD:
+                raise ValueError(f"the {SYNC_TIME_FIELD} field is set by the sync")
+            anki_by_pocket.setdefault(field.pocket, field.anki)
+        missing = [k for k in REQUIRED_POCKET_FIELDS if k not in anki_by_pocket]
+        if missing:
+            raise ValueError(f"Pocket fields not mapped: {', '.join(missing)}")
+        self.anki_fields = tuple(field.anki for field in self.fields)
+        if len(set(self.anki_fields)) != len(self.anki_fields):
+            raise ValueError("Anki fields mapped more than once")
+        # Names of the Anki fields holding what the sync relies on.
+        self.item_id_field = anki_by_pocket["item_id"]
+        self.url_field = anki_by_pocket["given_url"]
+        self.title_field = anki_by_pocket["given_title"]
+        self.time_added_field = anki_by_pocket["time_added"]
+        self._compile()
+
+    def _compile(self):
+        # Read all the attributes of an item with one `attrgetter`, which
+        # returns a single value rather than a tuple for a single field.
+        attributes = operator.attrgetter(*(field.pocket for field in self.fields))
+        if len(self.fields) == 1:
+
+            def getter(item):
+                return (attributes(item),)
+
+        else:
+            getter = attributes
+        normalizers = tuple(NORMALIZERS[field.normalizer] for field in self.fields)
+
+        def item_values(item):
+            return tuple(
+                [
+                    normalize(value)
+                    for normalize, value in zip(normalizers, getter(item))
+                ]
+            )
+
+        self.item_values = item_values
+        # Identifies the mapping, so that items synced with another mapping
+        # are not taken as unchanged. Zero for the default mapping, so that
+        # the state recorded before mappings were configurable stays valid.
+        spec = (self.deck_name, self.note_type, self.fields)
+        self.key = (
+            0
+            if spec == (DEFAULT_DECK, DEFAULT_NOTE_TYPE, DEFAULT_FIELDS)
+            else _hash(spec)
+        )
+
+    # `item_values(item)` returns the canonical values of the Anki fields
+    # for `item`, a `PocketItem`, in the order of `anki_fields`. It is a
+    # closure, and not picklable, so compile it again when unpickling, for
+    # planning in worker processes.
+    def __getstate__(self):
+        return (self.deck_name, self.note_type, self.fields)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def item_fingerprint(self, item):
+        """Return the `PocketItem.fingerprint` of `item` for this mapping, as
+        recorded in `SyncState`.
+        """
+        return item.fingerprint() ^ self.key
+
+    def field_hash(self, values):
+        """Return a 64-bit hash of field values, from `item_values` or
+        `note_values`.
+        """
+        # The values are strings or None, for which `repr` is canonical, and
+        # faster than `json.dumps`.
+        digest = hashlib.blake2b(repr(values).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    def note_values(self, fields):
+        """Return the values of the Anki fields in `fields`, a `notesInfo`
+        fields dict, in the order of `anki_fields`; None for fields missing
+        from the note.
+        """
+        return tuple(
+            fields[k]["value"] if k in fields else None for k in self.anki_fields
+        )
+
+    def note_fields(self, values):
+        """Return `values` as a dict, for `addNotes` and `updateNoteFields`."""
+        return dict(zip(self.anki_fields, values))
+
+    def to_dict(self):
+        return {
+            "deck": self.deck_name,
+            "note_type": self.note_type,
+            "fields": dict(
+                (field.anki, [field.pocket, field.normalizer]) for field in self.fields
+            ),
+        }
+
+
+def load_field_map(path):
+    """Read the `FieldMap`s from the JSON file `path`: an object mapping each
+    Anki field to the Pocket field synced to it, or to a `[pocket_field,
+    normalizer]` pair.
+
+    Raises ValueError if the file is not valid.
+    """
+    with open(path) as f:
+        spec = json.load(f)
+    if not isinstance(spec, dict):
+        raise ValueError(f"{path}: expected a JSON object")
+    fields = list()
+    for anki, pocket in spec.items():
+        if isinstance(pocket, str):
+            normalizer = "names" if pocket == "authors" else "text"
+        elif isinstance(pocket, list) and len(pocket) == 2:
+            pocket, normalizer = pocket
+        else:
+            raise ValueError(f"{path}: invalid mapping for field {anki!r}")
+        fields.append(FieldMap(anki, pocket, normalizer))
+    return fields
+
+
+DEFAULT_MAPPING = NoteMapping()
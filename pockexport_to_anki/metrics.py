@@ -0,0 +1,175 @@
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger("pockexport-to-anki")
+
+# Upper bounds, in milliseconds, of the request latency histogram buckets.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # One count per bucket in LATENCY_BUCKETS_MS, plus one for slower
+        # requests.
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_seconds": self.total,
+            "mean_seconds": self.total / self.count if self.count else 0.0,
+            "max_seconds": self.max,
+            "buckets_ms": dict(
+                zip(
+                    [f"<={bound}" for bound in LATENCY_BUCKETS_MS] + ["inf"],
+                    self.buckets,
+                )
+            ),
+        }
+
+
+class BackendMetrics:
+    def __init__(self):
+        self.requests = 0
+        # Number of actions sent, counting each action inside a batch request.
+        self.actions = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = dict()
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "actions": self.actions,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "latency": dict(
+                (action, histogram.to_dict())
+                for action, histogram in sorted(self.latency.items())
+            ),
+        }
+
+
+class Metrics:
+    """Per-phase wall times and per-backend request statistics for a run."""
+
+    def __init__(self):
+        self.started = time.time()
+        # Map phase name to total wall time in seconds, in order of first use.
+        self.phases = dict()
+        self.backends = dict()
+        # Map kind of cached read to `[hits, misses]`.
+        self.cache = dict()
+        self._lock = threading.Lock()
+        # Name and start time of the phase started with `start_phase`.
+        self._current = None
+
+    def start_phase(self, name):
+        """End the current phase, if any, and start timing phase `name`."""
+        self.end_phase()
+        self._current = (name, time.perf_counter())
+
+    def end_phase(self):
+        if self._current is not None:
+            name, start = self._current
+            self._current = None
+            self.add_phase_time(name, time.perf_counter() - start)
+
+    def add_phase_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def timed_iter(self, name, iterable):
+        """Yield from `iterable`, counting the time spent producing each
+        element as part of phase `name`.
+        """
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                x = next(it)
+            except StopIteration:
+                return
+            finally:
+                self.add_phase_time(name, time.perf_counter() - start)
+            yield x
+
+    def record_request(
+        self, backend, action, seconds, bytes_sent=0, bytes_received=0, actions=1
+    ):
+        with self._lock:
+            b = self.backends.setdefault(backend, BackendMetrics())
+            b.requests += 1
+            b.actions += actions
+            b.bytes_sent += bytes_sent
+            b.bytes_received += bytes_received
+            b.latency.setdefault(action, LatencyHistogram()).add(seconds)
+
+    def record_cache(self, hits, misses):
+        """Add the counts of reads answered from the read cache, `hits`, and
+        sent to Anki, `misses`, each a dict mapping kind of read to count.
+        """
+        with self._lock:
+            for kind in set(hits) | set(misses):
+                counts = self.cache.setdefault(kind, [0, 0])
+                counts[0] += hits.get(kind, 0)
+                counts[1] += misses.get(kind, 0)
+
+    def to_dict(self):
+        with self._lock:
+            report = {
+                "started": self.started,
+                "wall_seconds": time.time() - self.started,
+                "phases": dict(self.phases),
+                "backends": dict(
+                    (name, backend.to_dict())
+                    for name, backend in sorted(self.backends.items())
+                ),
+            }
+            if self.cache:
+                report["read_cache"] = dict(
+                    (kind, {"hits": hits, "misses": misses})
+                    for kind, (hits, misses) in sorted(self.cache.items())
+                )
+            return report
+
+    def log_summary(self):
+        report = self.to_dict()
+        for name, seconds in report["phases"].items():
+            logger.info(f"phase {name}: {seconds:.2f}s")
+        for name, backend in report["backends"].items():
+            logger.info(
+                f"{name}: {backend['requests']} requests, {backend['actions']}"
+                f" actions, {backend['bytes_sent']} bytes sent,"
+                f" {backend['bytes_received']} bytes received"
+            )
+        for kind, counts in report.get("read_cache", dict()).items():
+            logger.info(
+                f"read cache, {kind}: {counts['hits']} hits, {counts['misses']} misses"
+            )
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write("\n")
+
+
+# Metrics of the current run, shared by all clients.
+metrics = Metrics()
@@ -0,0 +1,247 @@
+"""Compact in-memory records of Pocket items and Anki notes and cards.
+
+Pocket items and Anki notes are kept as slotted records rather than as the
+dicts decoded from pockexport and AnkiConnect, with tags interned into
+integer IDs by `tag_table`, and only the fields the sync uses.
+"""
+
+import collections
+import hashlib
+import json
+import threading
+
+# Fields compared between two exports to decide whether an item changed.
+FINGERPRINT_FIELDS = (
+    "given_url",
+    "given_title",
+    "resolved_url",
+    "resolved_title",
+    "time_added",
+    "time_updated",
+    "time_favorited",
+    "word_count",
+    "time_to_read",
+    "excerpt",
+    "favorite",
+    "status",
+)
+
+
+class TagTable:
+    """Interns tag names into small integer IDs."""
+
+    def __init__(self):
+        self._ids = dict()
+        self._names = list()
+        self._lock = threading.Lock()
+
+    def id(self, name):
+        tag_id = self._ids.get(name)
+        if tag_id is None:
+            with self._lock:
+                tag_id = self._ids.get(name)
+                if tag_id is None:
+                    tag_id = len(self._names)
+                    self._names.append(name)
+                    self._ids[name] = tag_id
+        return tag_id
+
+    def ids(self, names):
+        return frozenset(self.id(name) for name in names)
+
+    def name(self, tag_id):
+        return self._names[tag_id]
+
+    def names(self, tag_ids):
+        return sorted(self._names[tag_id] for tag_id in tag_ids)
+
+
+# Tag IDs shared by all records.
+tag_table = TagTable()
+
+
+def _int(value):
+    try:
+        return int(value or 0)
+    except ValueError:
+        return 0
+
+
+class PocketItem:
+    """A Pocket item, as read from pockexport or returned by the Pocket API."""
+
+    __slots__ = FINGERPRINT_FIELDS + ("item_id", "authors", "tags")
+
+    @classmethod
+    def from_dict(cls, item):
+        self = cls.__new__(cls)
+        self.item_id = item["item_id"]
+        for k in FINGERPRINT_FIELDS:
+            setattr(self, k, item.get(k, ""))
+        # Pockexport produces `authors` as a dictionary, but the Pocket add
+        # API returns an empty list if there are no authors.
+        authors = item.get("authors")
+        self.authors = (
+            tuple(author["name"] for author in authors.values())
+            if isinstance(authors, dict)
+            else ()
+        )
+        self.tags = tag_table.ids(item.get("tags") or ())
+        return self
+
+    def fingerprint(self):
+        """Return a 64-bit hash of the fields of the item that the sync uses."""
+        canonical = [
+            [getattr(self, k) for k in FINGERPRINT_FIELDS],
+            tag_table.names(self.tags),
+            sorted(self.authors),
+        ]
+        digest = hashlib.blake2b(
+            json.dumps(canonical, separators=(",", ":")).encode(), digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "big")
+
+    # Tag IDs are only meaningful within a process, so pickle tag names, for
+    # planning in worker processes.
+    def __getstate__(self):
+        state = dict((k, getattr(self, k)) for k in self.__slots__)
+        state["tags"] = tag_table.names(self.tags)
+        return state
+
+    def __setstate__(self, state):
+        state["tags"] = tag_table.ids(state["tags"])
+        for k, v in state.items():
+            setattr(self, k, v)
+
+
+def note_info_hash(note_info):
+    """Return a 64-bit hash of a `notesInfo` result, ignoring the order of
+    its tags and cards.
+    """
+    canonical = dict(
+        note_info, tags=sorted(note_info["tags"]), cards=sorted(note_info["cards"])
+    )
+    digest = hashlib.blake2b(
+        json.dumps(canonical, sort_keys=True, separators=(",", ":")).encode(),
+        digest_size=8,
+    ).digest()
+    return int.from_bytes(digest, "big")
+
+
+class AnkiNote:
+    """The parts of an Anki note of the Pocket note type that the sync uses."""
+
+    __slots__ = (
+        "note_id",
+        "item_id",
+        "field_hash",
+        "last_synced",
+        "tags",
+        "card_ids",
+        "info_hash",
+    )
+
+    def __init__(
+        self, note_id, item_id, field_hash, last_synced, tags, card_ids, info_hash
+    ):
+        self.note_id = note_id
+        self.item_id = item_id
+        # `mapping.field_hash` of the values of the mapped fields of the note.
+        self.field_hash = field_hash
+        self.last_synced = last_synced
+        self.tags = tags
+        self.card_ids = card_ids
+        # `note_info_hash` of the note info the record was built from.
+        self.info_hash = info_hash
+
+    @classmethod
+    def from_info(cls, note_info, mapping):
+        """Build the record from a `notesInfo` result, reading the fields
+        mapped by `mapping`, a `NoteMapping`.
+        """
+        fields = note_info["fields"]
+        values = mapping.note_values(fields)
+        item_id = fields.get(mapping.item_id_field)
+        return cls(
+            note_info["noteId"],
+            item_id["value"] if item_id else "",
+            mapping.field_hash(values),
+            _int(fields.get("time_last_synced", {}).get("value")),
+            tag_table.ids(note_info["tags"]),
+            tuple(note_info["cards"]),
+            note_info_hash(note_info),
+        )
+
+    # Tag IDs are only meaningful within a process, so pickle tag names, for
+    # planning in worker processes.
+    def __getstate__(self):
+        state = dict((k, getattr(self, k)) for k in self.__slots__)
+        state["tags"] = tag_table.names(self.tags)
+        return state
+
+    def __setstate__(self, state):
+        state["tags"] = tag_table.ids(state["tags"])
+        for k, v in state.items():
+            setattr(self, k, v)
+
+
+class AnkiCard:
+    """The parts of an Anki card that the sync uses."""
+
+    __slots__ = ("card_id", "note_id", "type", "queue", "due", "time_added")
+
+    def __init__(self, card_id, note_id, type, queue, due, time_added):
+        self.card_id = card_id
+        self.note_id = note_id
+        # See
+        # https://github.com/ankidroid/Anki-Android/wiki/Database-Structure#cards
+        self.type = type
+        self.queue = queue
+        self.due = due
+        self.time_added = time_added
+
+    @classmethod
+    def from_info(cls, card_info, time_added_field="time_added"):
+        return cls(
+            card_info["cardId"],
+            card_info["note"],
+            card_info["type"],
+            card_info["queue"],
+            card_info["due"],
+            _int(card_info["fields"].get(time_added_field, {}).get("value")),
+        )
+
+
+class CardStates:
+    """The IDs of the cards in each state the sync tells apart: reviewed,
+    suspended, and new and neither suspended nor buried, the cards ordered
+    for review. Filled in by `classify_cards` or with `add`.
+    """
+
+    __slots__ = ("review", "suspended", "new")
+
+    def __init__(self, review=(), suspended=(), new=()):
+        self.review = set(review)
+        self.suspended = set(suspended)
+        self.new = set(new)
+
+    def add(self, card):
+        """Classify `card`, an `AnkiCard`, by its type and queue."""
+        if card.type == 2:
+            self.review.add(card.card_id)
+        if card.queue == -1:
+            self.suspended.add(card.card_id)
+        if card.type == 0 and card.queue == 0:
+            self.new.add(card.card_id)
+
+    def subset(self, card_ids):
+        """Return the states of the cards in `card_ids` only."""
+        card_ids = set(card_ids)
+        return CardStates(
+            self.review & card_ids, self.suspended & card_ids, self.new & card_ids
+        )
+
+
+# A new, unsuspended card to order for review: its ID, the `time_added` of its
+# Pocket item, its current due position and the tag IDs of its note.
+NewCard = collections.namedtuple("NewCard", ["card_id", "time_added", "due", "tags"])
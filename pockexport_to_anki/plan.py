@@ -0,0 +1,479 @@
+import logging
+
+from pockexport_to_anki.mapping import DEFAULT_MAPPING, unwrap_link
+from pockexport_to_anki.model import AnkiNote, CardStates, NewCard, _int, tag_table
+
+logger = logging.getLogger("pockexport-to-anki")
+
+ANKI_SUSPENDED_TAG = "anki:suspend"
+FAVORITE_TAG = "marked"
+# Interned IDs of the tags above; see `model.tag_table`.
+ANKI_SUSPENDED_TAG_ID = tag_table.id(ANKI_SUSPENDED_TAG)
+FAVORITE_TAG_ID = tag_table.id(FAVORITE_TAG)
+
+
+class ItemPlan:
+    """Changes to make for a single Pocket item, as decided by `plan_item`."""
+
+    def __init__(self, item_id):
+        self.item_id = item_id
+        self.note_id = None
+        # `note_info_hash` of the note before the sync, or None for a newly
+        # created note.
+        self.note_hash = None
+        # Note fields to update, or None if unchanged.
+        self.fields = None
+        # True to favorite the Pocket item, False to unfavorite it, None to
+        # leave it as is.
+        self.favorite = None
+        self.archive = False
+        self.readd = False
+        # `NewCard` for each new, unsuspended card of the note.
+        self.new_cards = []
+        # New tag IDs for the Anki note and the Pocket item, or None if
+        # unchanged.
+        self.note_tags = None
+        self.item_tags = None
+        # Tag IDs of the Anki note and the Pocket item before the sync, when
+        # their new tags are set, so that only the changes are written.
+        self.old_note_tags = None
+        self.old_item_tags = None
+        # Note to create for an item not in Anki yet, and the `PocketItem`
+        # itself.
+        self.new_note = None
+        self.item = None
+        # Fingerprint and `time_updated` of the Pocket item, for `SyncState`.
+        self.fingerprint = None
+        self.time_updated = 0
+
+    def to_dict(self):
+        return {
+            "item_id": self.item_id,
+            "note": self.new_note,
+            "note_tags": (
+                tag_table.names(self.note_tags) if self.note_tags is not None else None
+            ),
+            "item_tags": (
+                tag_table.names(self.item_tags) if self.item_tags is not None else None
+            ),
+            "favorite": self.favorite,
+            "archive": self.archive,
+            "readd": self.readd,
+        }
+
+    def to_journal(self):
+        """Return the plan as a JSON-serializable dict, without the note to
+        create and the item, for `Journal` and for planning in worker
+        processes.
+        """
+        return {
+            "item_id": self.item_id,
+            "note_id": self.note_id,
+            "note_hash": self.note_hash,
+            "fields": self.fields,
+            "favorite": self.favorite,
+            "archive": self.archive,
+            "readd": self.readd,
+            "new_cards": [
+                [card.card_id, card.time_added, card.due, tag_table.names(card.tags)]
+                for card in self.new_cards
+            ],
+            "note_tags": (
+                tag_table.names(self.note_tags) if self.note_tags is not None else None
+            ),
+            "item_tags": (
+                tag_table.names(self.item_tags) if self.item_tags is not None else None
+            ),
+            "old_note_tags": (
+                tag_table.names(self.old_note_tags)
+                if self.old_note_tags is not None
+                else None
+            ),
+            "old_item_tags": (
+                tag_table.names(self.old_item_tags)
+                if self.old_item_tags is not None
+                else None
+            ),
+            "fingerprint": self.fingerprint,
+            "time_updated": self.time_updated,
+        }
+
+    @classmethod
+    def from_journal(cls, record):
+        self = cls(record["item_id"])
+        self.note_id = record["note_id"]
+        self.note_hash = record["note_hash"]
+        self.fields = record["fields"]
+        self.favorite = record["favorite"]
+        self.archive = record["archive"]
+        self.readd = record["readd"]
+        self.new_cards = [
+            NewCard(card_id, time_added, due, tag_table.ids(tags))
+            for card_id, time_added, due, tags in record["new_cards"]
+        ]
+        if record["note_tags"] is not None:
+            self.note_tags = set(tag_table.ids(record["note_tags"]))
+        if record["item_tags"] is not None:
+            self.item_tags = set(tag_table.ids(record["item_tags"]))
+        # Journals written before tag changes were recorded have neither.
+        if record.get("old_note_tags") is not None:
+            self.old_note_tags = set(tag_table.ids(record["old_note_tags"]))
+        if record.get("old_item_tags") is not None:
+            self.old_item_tags = set(tag_table.ids(record["old_item_tags"]))
+        self.fingerprint = record["fingerprint"]
+        self.time_updated = record["time_updated"]
+        return self
+
+
+class SyncPlan:
+    """All the changes to make to Anki and Pocket in a sync.
+
+    Built by the planning functions of this module, which only look at the
+    Pocket export and at an `AnkiSnapshot`, and carried out by the functions
+    of `pockexport_to_anki.execute`.
+    """
+
+    def __init__(self):
+        # Anki notes to add to Pocket, as dicts with `note_id`, `url`,
+        # `title` and `tags` keys.
+        self.pocket_adds = list()
+        # Map note ID to the fields to update.
+        self.field_updates = dict()
+        # `ItemPlan`s of the items whose notes are to be created.
+        self.new_notes = list()
+        self.archive_items = set()
+        self.readd_items = set()
+        self.favorite_items = set()
+        self.unfavorite_items = set()
+        # `NewCard`s to reorder.
+        self.new_cards = list()
+        # Map note ID, or item ID, to the new full set of tag IDs.
+        self.tag_updated_notes = dict()
+        self.tag_updated_items = dict()
+        # Map note ID, or item ID, to its tag IDs before the sync, for those
+        # of the above for which they are known. Only the tags added and
+        # removed are written for these; see `tag_changes`.
+        self.old_note_tags = dict()
+        self.old_item_tags = dict()
+        # Map note ID to its `note_info_hash` before the sync (None for new
+        # notes), for the notes to check for changes at the end.
+        self.note_hashes = dict()
+        # Map item ID to `(note_id, fingerprint, time_updated)` for each item
+        # synced to a note.
+        self.synced_items = dict()
+        # Set if planning was cut short by Ctrl-C, so that only part of the
+        # items were planned.
+        self.interrupted = False
+
+    def merge(self, item_plan):
+        item_id = item_plan.item_id
+        if item_plan.new_note is not None:
+            self.new_notes.append(item_plan)
+            return
+        if item_plan.note_id:
+            self.synced_items[item_id] = (
+                item_plan.note_id,
+                item_plan.fingerprint,
+                item_plan.time_updated,
+            )
+            self.note_hashes[item_plan.note_id] = item_plan.note_hash
+        if item_plan.fields is not None:
+            self.field_updates[item_plan.note_id] = item_plan.fields
+        if item_plan.favorite is True:
+            self.favorite_items |= {item_id}
+            self.unfavorite_items -= {item_id}
+        elif item_plan.favorite is False:
+            self.favorite_items -= {item_id}
+            self.unfavorite_items |= {item_id}
+        if item_plan.archive:
+            self.archive_items |= {item_id}
+        if item_plan.readd:
+            self.readd_items |= {item_id}
+        self.new_cards.extend(item_plan.new_cards)
+        if item_plan.note_tags is not None:
+            self.tag_updated_notes[item_plan.note_id] = item_plan.note_tags
+            if item_plan.old_note_tags is not None:
+                self.old_note_tags[item_plan.note_id] = item_plan.old_note_tags
+        if item_plan.item_tags is not None:
+            self.tag_updated_items[item_id] = item_plan.item_tags
+            if item_plan.old_item_tags is not None:
+                self.old_item_tags[item_id] = item_plan.old_item_tags
+
+    def pocket_actions(self):
+        """Return the Pocket actions to send, as `(action, params)` pairs.
+
+        The actions are grouped by item, so that all the actions for an item
+        usually end up in the same batch.
+        """
+        actions = list()
+        for item_id in sorted(
+            set(self.tag_updated_items)
+            | self.favorite_items
+            | self.unfavorite_items
+            | self.archive_items
+            | self.readd_items
+        ):
+            if item_id in self.tag_updated_items:
+                tags = self.tag_updated_items[item_id]
+                if item_id in self.old_item_tags:
+                    added, removed = tag_changes(tags, self.old_item_tags[item_id])
+                    if removed:
+                        actions.append(
+                            (
+                                "tags_remove",
+                                {"item_id": int(item_id), "tags": ",".join(removed)},
+                            )
+                        )
+                    if added:
+                        actions.append(
+                            (
+                                "tags_add",
+                                {"item_id": int(item_id), "tags": ",".join(added)},
+                            )
+                        )
+                else:
+                    actions.append(
+                        (
+                            "tags_replace",
+                            {
+                                "item_id": int(item_id),
+                                "tags": ",".join(tag_table.names(tags)),
+                            },
+                        )
+                    )
+            for action, collection in [
+                ("favorite", self.favorite_items),
+                ("unfavorite", self.unfavorite_items),
+                ("archive", self.archive_items),
+                ("readd", self.readd_items),
+            ]:
+                if item_id in collection:
+                    actions.append((action, {"item_id": int(item_id)}))
+        return actions
+
+    def to_dict(self):
+        """Return the plan as a JSON-serializable dict."""
+        return {
+            "pocket_adds": self.pocket_adds,
+            "field_updates": dict(
+                (str(note_id), fields) for note_id, fields in self.field_updates.items()
+            ),
+            "new_notes": [item_plan.to_dict() for item_plan in self.new_notes],
+            "note_tag_updates": dict(
+                (str(note_id), tag_table.names(tags))
+                for note_id, tags in self.tag_updated_notes.items()
+            ),
+            "pocket_actions": [
+                dict(params, action=action) for action, params in self.pocket_actions()
+            ],
+            "new_cards": [[card.card_id, card.time_added] for card in self.new_cards],
+        }
+
+
+def tag_changes(tags, old_tags):
+    """Return the sorted names of the tags added and of those removed, going
+    from the tag IDs `old_tags` to `tags`.
+    """
+    return tag_table.names(tags - old_tags), tag_table.names(old_tags - tags)
+
+
+def plan_pocket_adds(note_infos, recently_edited, mapping=DEFAULT_MAPPING):
+    """Return the Pocket items to add for Anki notes without an item ID.
+
+    Only the notes in `recently_edited` are added. The URL and title are read
+    from the fields `mapping` maps `given_url` and `given_title` to.
+    """
+    adds = list()
+    for ni in note_infos or []:
+        logger.debug(f"ni = {ni}")
+        if ni["noteId"] not in recently_edited:
+            logger.info(f"{ni['noteId']}: skipping because not recently edited")
+            continue
+        title = ni["fields"][mapping.title_field]["value"].strip()
+        url = unwrap_link(ni["fields"][mapping.url_field]["value"].strip())
+        adds.append(
+            {
+                "note_id": ni["noteId"],
+                "url": url,
+                "title": title,
+                "tags": ",".join(sorted(ni["tags"])),
+            }
+        )
+    return adds
+
+
+def plan_item(item, snapshot):
+    """Reconcile a single `PocketItem` with its Anki note.
+
+    Returns an `ItemPlan` describing the changes to make to the note and to
+    the Pocket item, or None if the item was skipped. If the item has no note
+    yet, the plan also holds the note to create, in the deck and with the
+    note type and fields of `snapshot.mapping`.
+    """
+    mapping = snapshot.mapping
+    item_id = item.item_id
+    item_plan = ItemPlan(item_id)
+    item_plan.fingerprint = mapping.item_fingerprint(item)
+    item_plan.time_updated = _int(item.time_updated)
+    values = mapping.item_values(item)
+    field_hash = mapping.field_hash(values)
+
+    note_id = snapshot.note_by_item_id.get(item_id)
+    if note_id is not None and note_id not in snapshot.recently_edited:
+        logger.info(f"{note_id}: skipping because not recently edited")
+        return None
+    note = snapshot.note_for_item(item_id)
+    if note is not None:
+        item_plan.note_id = note.note_id
+        item_plan.note_hash = note.info_hash
+        if note.field_hash != field_hash:
+            item_plan.fields = mapping.note_fields(values)
+        reconcile_note(
+            item,
+            item_plan,
+            note,
+            snapshot.card_states,
+            snapshot.note_cards(note),
+            snapshot.mod_time(note),
+            note.last_synced,
+        )
+    else:
+        item_plan.new_note = {
+            "deckName": mapping.deck_name,
+            "modelName": mapping.note_type,
+            "fields": mapping.note_fields(values),
+            "tags": tag_table.names(item.tags),
+        }
+        item_plan.item = item
+        # Plan against the note as it will be created. `create_notes`
+        # reconciles the item again with the created note and its cards.
+        reconcile_note(
+            item,
+            item_plan,
+            AnkiNote(None, item_id, field_hash, 0, item.tags, (), None),
+            CardStates(),
+            [],
+            0,
+            0,
+        )
+    return item_plan
+
+
+def reconcile_note(item, item_plan, note, states, cards, mod_time, note_last_sync_time):
+    """Work out the tag, favorite, archive and card order changes for `item`
+    and its `AnkiNote`, and record them in `item_plan`.
+
+    `states` holds the `CardStates` of the cards of the note, and `cards`
+    the loaded `AnkiCard`s of it, of which those new in `states` are ordered
+    for review.
+    """
+    item_id = item.item_id
+    note_id = note.note_id
+    pocket_tags = set(item.tags)
+    note_tags = set(note.tags)
+    note_favorited = FAVORITE_TAG_ID in note_tags
+    item_unread = (item.status or "0") == "0"
+    should_favorite = note_favorited
+    if note_favorited and item.favorite == "0":
+        if _int(item.time_favorited) > mod_time:
+            should_favorite = False
+        else:
+            should_favorite = True
+    elif not note_favorited and item.favorite == "1":
+        if _int(item.time_favorited) > mod_time:
+            should_favorite = True
+        else:
+            should_favorite = False
+    note_tags -= {FAVORITE_TAG_ID, ANKI_SUSPENDED_TAG_ID}
+    merged_tags = note_tags - {FAVORITE_TAG_ID, ANKI_SUSPENDED_TAG_ID}
+    if note_tags != pocket_tags:
+        # Overwrite `pocket_tags` only if Pocket for sure has not been
+        # updated since the last sync. Otherwise, merge `pocket_tags` into
+        # the existing note tags.
+        if not (
+            mod_time > note_last_sync_time
+            and note_last_sync_time > _int(item.time_updated)
+        ):
+            merged_tags |= pocket_tags
+    if should_favorite:
+        merged_tags |= {FAVORITE_TAG_ID}
+        if item.favorite == "0":
+            item_plan.favorite = True
+    else:
+        merged_tags -= {FAVORITE_TAG_ID}
+        if item.favorite == "1":
+            item_plan.favorite = False
+    card_ids = set(note.card_ids)
+    reviewed = not states.review.isdisjoint(card_ids)
+    suspended = not states.suspended.isdisjoint(card_ids)
+    if item_unread and (reviewed or suspended):
+        item_plan.archive = True
+    # TODO: uncomment the below if I ever get through my backlog.
+    # elif not reviewed and not item_unread:
+    #   item_plan.readd = True
+    # Sync suspended status to tags, mostly for easier viewing in Pocket
+    # interface.
+    if suspended:
+        merged_tags |= {ANKI_SUSPENDED_TAG_ID}
+    else:
+        merged_tags -= {ANKI_SUSPENDED_TAG_ID}
+    item_plan.new_cards = [
+        NewCard(card.card_id, card.time_added, card.due, frozenset(merged_tags))
+        for card in cards
+        if card.card_id in states.new
+    ]
+    if merged_tags != note_tags:
+        logger.debug(
+            f"tag_updated_notes[{note_id}]: merged_tags {tag_table.names(merged_tags)} note_tags {tag_table.names(note_tags)}"
+        )
+        item_plan.note_tags = merged_tags
+        item_plan.old_note_tags = set(note.tags)
+    # FAVORITE_TAG not added to Pocket since Pocket has separate Favorite
+    # status.
+    if (merged_tags - {FAVORITE_TAG_ID}) != pocket_tags:
+        logger.debug(
+            f"tag_updated_items[{item_id}]: merged_tags {tag_table.names(merged_tags - {FAVORITE_TAG_ID})} pocket_tags {tag_table.names(pocket_tags)}"
+        )
+        item_plan.item_tags = merged_tags - {FAVORITE_TAG_ID}
+        item_plan.old_item_tags = pocket_tags
+
+
+def plan_sync(items, snapshot, plan=None, journal=None, workers=1, should_stop=None):
+    """Plan the sync of each `PocketItem` in `items` with `snapshot`.
+
+    Returns `plan`, or a new `SyncPlan`, with the changes for `items` merged
+    in. Makes no requests, as long as the notes of `items` are loaded in
+    `snapshot`; see `AnkiSnapshot.iter_loaded`. On KeyboardInterrupt, the
+    plan for the items seen so far is returned, with `interrupted` set, as it
+    is once `should_stop`, if given, returns true. The plans of items with a
+    note are also recorded in `journal`, if given; those of new notes are
+    recorded by the caller once the notes are created.
+
+    With `workers` above 1, the items are planned in that many worker
+    processes; see `pockexport_to_anki.shard`.
+    """
+    if workers > 1:
+        from pockexport_to_anki.shard import plan_sync_sharded
+
+        return plan_sync_sharded(
+            items, snapshot, workers, plan, journal, should_stop=should_stop
+        )
+    if plan is None:
+        plan = SyncPlan()
+    try:
+        for i, item in enumerate(items):
+            if should_stop is not None and should_stop():
+                logger.info("Stop requested - finishing sync")
+                plan.interrupted = True
+                break
+            logger.debug(f"ITERATION {i}")
+            item_plan = plan_item(item, snapshot)
+            if item_plan is None:
+                continue
+            plan.merge(item_plan)
+            if journal is not None and item_plan.new_note is None:
+                journal.add(item_plan)
+    except KeyboardInterrupt:
+        logger.info("Received KeyboardInterrupt - finishing sync")
+        plan.interrupted = True
+    return plan
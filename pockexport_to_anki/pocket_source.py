@@ -0,0 +1,302 @@
+"""Reading Pocket items from the Pocket API, as an alternative to pockexport
+data files.
+
+`PocketSource` keeps a local copy of the Pocket list, the mirror, in a
+SQLite file. Each run only asks the `get` (retrieve) endpoint for the items
+changed since the previous one, and yields the items changed since the last
+sync that completed them. All the items of the mirror are yielded on
+request, so that the sync also sees the items whose notes changed in Anki.
+"""
+
+import json
+import logging
+import os
+import os.path
+import sqlite3
+import time
+
+from pockexport_to_anki.metrics import metrics
+from pockexport_to_anki.model import PocketItem
+from pockexport_to_anki.state import default_state_db_path
+
+logger = logging.getLogger("pockexport-to-anki")
+
+# Number of items requested per `get` request.
+RETRIEVE_PAGE_SIZE = 500
+# Status of deleted items, which `get` returns when given `since`.
+DELETED_STATUS = "2"
+
+
+def default_mirror_path():
+    return os.path.join(
+        os.path.dirname(default_state_db_path()), "pocket_items.sqlite3"
+    )
+
+
+def _item_data(item):
+    """Return the parts of `item`, a Pocket API item, that `PocketItem`
+    uses, as JSON.
+    """
+    return json.dumps(PocketItem.from_dict(item).__getstate__(), separators=(",", ":"))
+
+
+def _item_from_data(data):
+    state = json.loads(data)
+    state["authors"] = tuple(state["authors"])
+    item = PocketItem.__new__(PocketItem)
+    item.__setstate__(state)
+    return item
+
+
+class PocketSource:
+    """The Pocket items, read from the Pocket API into the mirror `path`.
+
+    `items` first requests the items changed since the cursor of the mirror,
+    `page_size` at a time, or all items if the mirror is new. Requests
+    failing with a retryable HTTP status are retried up to `retries` times
+    with exponential backoff. The cursor returned by Pocket is saved once
+    all the pages are in the mirror. The items stored are also marked as
+    changed, until `done` is called at the end of the sync.
+
+    If `dry_run` is true, the mirror is not written to, and the items read
+    are only kept in memory.
+    """
+
+    def __init__(
+        self,
+        client,
+        path,
+        page_size=RETRIEVE_PAGE_SIZE,
+        retries=3,
+        backoff=1.0,
+        dry_run=False,
+    ):
+        self.client = client
+        self.path = path
+        self.page_size = page_size
+        self.retries = retries
+        self.backoff = backoff
+        self.dry_run = dry_run
+        # Map item ID to the items read but not stored in a dry run, as
+        # returned by the Pocket API.
+        self._unstored = dict()
+        # IDs of the items yielded by the last `items`, for `done`.
+        self._yielded = set()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS items (
+                    item_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+                """
+            )
+            # Items stored since the last completed sync.
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS changed (item_id TEXT PRIMARY KEY)"
+            )
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'since'"
+        ).fetchone()
+        self.since = row[0] if row else None
+
+    def update(self):
+        """Request the items changed since `since` and store them in the
+        mirror. Returns the number of items changed.
+        """
+        offset = 0
+        count = 0
+        next_since = None
+        while True:
+            response = self._get(offset)
+            if next_since is None:
+                next_since = response.get("since")
+            page = response.get("list") or []
+            # Pocket returns an empty array rather than an object for an
+            # empty list.
+            if isinstance(page, dict):
+                page = list(page.values())
+            self.record(page)
+            count += len(page)
+            if len(page) < self.page_size:
+                break
+            offset += len(page)
+        if next_since is not None:
+            self.record([], int(next_since))
+        return count
+
+    def record(self, items, since=None):
+        """Store `items`, as returned by the Pocket API, in the mirror, and
+        set its cursor to `since` if given. Deleted items are removed.
+        """
+        if self.dry_run:
+            for item in items:
+                self._unstored[item["item_id"]] = item
+            if since is not None:
+                self.since = since
+            return
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM items WHERE item_id = ?",
+                [
+                    (item["item_id"],)
+                    for item in items
+                    if item.get("status") == DELETED_STATUS
+                ],
+            )
+            # Keep the row ID of existing items, so that the mirror stays in
+            # the order the items were first read.
+            self._conn.executemany(
+                "INSERT INTO items VALUES (?, ?)"
+                " ON CONFLICT (item_id) DO UPDATE SET data = excluded.data",
+                [
+                    (item["item_id"], _item_data(item))
+                    for item in items
+                    if item.get("status") != DELETED_STATUS
+                ],
+            )
+            self._conn.executemany(
+                "DELETE FROM changed WHERE item_id = ?",
+                [
+                    (item["item_id"],)
+                    for item in items
+                    if item.get("status") == DELETED_STATUS
+                ],
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO changed VALUES (?)",
+                [
+                    (item["item_id"],)
+                    for item in items
+                    if item.get("status") != DELETED_STATUS
+                ],
+            )
+            if since is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('since', ?)", (since,)
+                )
+                self.since = since
+
+    def items(self, full=False):
+        """Update the mirror, then yield the items changed since the last
+        `done` as `PocketItem`s, or all its items if `full` is true.
+        """
+        logger.info(
+            "Reading all Pocket items"
+            if self.since is None
+            else f"Reading the Pocket items changed since {self.since}"
+        )
+        logger.info(f"Read {self.update()} changed Pocket items")
+        if full:
+            query = "SELECT item_id, data FROM items ORDER BY rowid"
+        else:
+            query = (
+                "SELECT item_id, data FROM items"
+                " WHERE item_id IN (SELECT item_id FROM changed) ORDER BY rowid"
+            )
+        self._yielded = set()
+        unstored = dict(self._unstored)
+        for item_id, data in self._conn.execute(query):
+            if item_id not in unstored:
+                self._yielded.add(item_id)
+                yield _item_from_data(data)
+                continue
+            item = unstored.pop(item_id)
+            if item.get("status") != DELETED_STATUS:
+                self._yielded.add(item_id)
+                yield PocketItem.from_dict(item)
+        # The other items read in a dry run.
+        for item_id, item in unstored.items():
+            if item.get("status") != DELETED_STATUS:
+                self._yielded.add(item_id)
+                yield PocketItem.from_dict(item)
+
+    def done(self, failed_items=()):
+        """Mark the items yielded by the last `items` as synced, once the
+        sync of all of them completed, except those in `failed_items`, whose
+        writes failed.
+        """
+        if not self.dry_run:
+            with self._conn:
+                self._conn.executemany(
+                    "DELETE FROM changed WHERE item_id = ?",
+                    [
+                        (item_id,)
+                        for item_id in self._yielded
+                        if item_id not in failed_items
+                    ],
+                )
+        self._yielded = set()
+
+    def _get(self, offset):
+        """Request the page of items at `offset` and return the decoded
+        response.
+        """
+        import pocket
+        import requests
+
+        from pockexport_to_anki.pocket_writer import (
+            RETRY_STATUSES,
+            PocketWriteError,
+            post_request,
+        )
+
+        payload = dict(
+            self.client.get_payload(),
+            state="all",
+            detailType="complete",
+            sort="oldest",
+            count=self.page_size,
+            offset=offset,
+        )
+        if self.since is not None:
+            payload["since"] = self.since
+        body = json.dumps(payload)
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                response = post_request(self.client, "get", body)
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2**attempt
+                logger.warning(f"Pocket get failed ({e}), retrying in {delay:.0f}s")
+                time.sleep(delay)
+                continue
+            metrics.record_request(
+                "pocket",
+                "get",
+                time.perf_counter() - start,
+                len(body.encode()),
+                len(response.content),
+                1,
+            )
+            if response.status_code < 400:
+                return response.json()
+            error = pocket.EXCEPTIONS.get(response.status_code, PocketWriteError)(
+                "%s. %s"
+                % (
+                    self.client.statuses.get(response.status_code),
+                    response.headers.get("X-Error"),
+                )
+            )
+            if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                raise error
+            delay = self.backoff * 2**attempt
+            logger.warning(f"Pocket get failed ({error}), retrying in {delay:.0f}s")
+            time.sleep(delay)
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,185 @@
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+
+import pocket
+import requests
+
+from pockexport_to_anki.ankiconnect import batched
+from pockexport_to_anki.metrics import metrics
+
+logger = logging.getLogger("pockexport-to-anki")
+
+# Maximum number of actions per Pocket `send` request.
+SEND_BATCH_SIZE = 100
+# HTTP statuses worth retrying: rate limiting, maintenance and server errors.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Seconds to wait for Pocket to answer a request.
+REQUEST_TIMEOUT = 60
+
+
+class PocketWriteError(pocket.PocketException):
+    pass
+
+
+def post_request(client, endpoint, body, timeout=REQUEST_TIMEOUT):
+    """POST `body` to the Pocket API `endpoint` ("get", "send", ...).
+
+    The pocket library's `_post_request` sets no timeout, so the request is
+    sent here with one, unless `client` brings its own `_post_request`.
+    """
+    url = client.api_endpoints[endpoint]
+    headers = {"content-type": "application/json"}
+    if type(client)._post_request.__module__ != pocket.__name__:
+        return client._post_request(url, body, headers)
+    return requests.post(url, data=body, headers=headers, timeout=timeout)
+
+
+class PocketWriter:
+    """Sends Pocket modify actions (`add`, `archive`, `tags_replace`, ...).
+
+    Actions of all kinds are queued with `add` and sent by `flush` in mixed
+    batches of up to `batch_size` actions, with up to `max_in_flight` batches
+    sent in parallel. Requests failing with a retryable HTTP status or a
+    connection error, and the individual actions of a batch that Pocket
+    reports as failed, are retried up to `retries` times with exponential
+    backoff. Pocket's rate-limit
+    headers are honored: once a limit is exhausted, no request is sent until
+    it resets.
+    """
+
+    def __init__(
+        self,
+        client,
+        batch_size=SEND_BATCH_SIZE,
+        max_in_flight=1,
+        retries=3,
+        backoff=1.0,
+    ):
+        self.client = client
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self._actions = []
+        self._lock = threading.Lock()
+        # Earliest time at which the next request may be sent.
+        self._not_before = 0.0
+
+    def __len__(self):
+        return len(self._actions)
+
+    def add(self, action, **params):
+        """Queue `action` for `flush`. Returns its index in `flush`'s result."""
+        self._actions.append(dict(params, action=action))
+        return len(self._actions) - 1
+
+    def flush(self):
+        """Send all queued actions.
+
+        Returns a list with a `(result, error)` pair for each action, in the
+        order the actions were queued: `error` is None if the action
+        succeeded.
+        """
+        actions, self._actions = self._actions, []
+        batches = list(batched(range(len(actions)), self.batch_size))
+        outcomes = [(False, None)] * len(actions)
+        with concurrent.futures.ThreadPoolExecutor(self.max_in_flight) as executor:
+            futures = [
+                executor.submit(self._send_batch, [actions[i] for i in batch])
+                for batch in batches
+            ]
+            for batch, future in zip(batches, futures):
+                for i, outcome in zip(batch, future.result()):
+                    outcomes[i] = outcome
+        failed = sum(1 for _, error in outcomes if error is not None)
+        if failed:
+            logger.warning(f"{failed} of {len(actions)} Pocket actions failed")
+        return outcomes
+
+    def _wait_for_rate_limit(self):
+        with self._lock:
+            delay = self._not_before - time.monotonic()
+        if delay > 0:
+            logger.info(f"Pocket rate limit reached, waiting {delay:.0f}s")
+            time.sleep(delay)
+
+    def _update_rate_limit(self, headers):
+        for scope in ("User", "Key"):
+            try:
+                remaining = int(headers[f"X-Limit-{scope}-Remaining"])
+                reset = int(headers[f"X-Limit-{scope}-Reset"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if remaining <= 0:
+                with self._lock:
+                    self._not_before = max(self._not_before, time.monotonic() + reset)
+
+    def _post(self, actions):
+        """Send `actions` in one request and return the decoded response."""
+        payload = dict(self.client.get_payload(), actions=actions)
+        for attempt in range(self.retries + 1):
+            self._wait_for_rate_limit()
+            body = json.dumps(payload)
+            start = time.perf_counter()
+            try:
+                response = post_request(self.client, "send", body)
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    raise PocketWriteError(str(e)) from e
+                delay = self.backoff * 2**attempt
+                logger.warning(f"Pocket send failed ({e}), retrying in {delay:.0f}s")
+                time.sleep(delay)
+                continue
+            metrics.record_request(
+                "pocket",
+                "send",
+                time.perf_counter() - start,
+                len(body.encode()),
+                len(response.content),
+                len(actions),
+            )
+            self._update_rate_limit(response.headers)
+            if response.status_code < 400:
+                return response.json()
+            error = pocket.EXCEPTIONS.get(response.status_code, PocketWriteError)(
+                "%s. %s"
+                % (
+                    self.client.statuses.get(response.status_code),
+                    response.headers.get("X-Error"),
+                )
+            )
+            if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                raise error
+            delay = self.backoff * 2**attempt
+            logger.warning(f"Pocket send failed ({error}), retrying in {delay:.0f}s")
+            time.sleep(delay)
+
+    def _send_batch(self, actions):
+        outcomes = [(False, None)] * len(actions)
+        todo = list(range(len(actions)))
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._post([actions[i] for i in todo])
+            except pocket.PocketException as e:
+                for i in todo:
+                    outcomes[i] = (False, str(e))
+                break
+            results = response.get("action_results") or [False] * len(todo)
+            errors = response.get("action_errors") or [None] * len(todo)
+            retry = []
+            for i, result, error in zip(todo, results, errors):
+                if result is False or error is not None:
+                    retry.append(i)
+                    outcomes[i] = (result, error or "action failed")
+                else:
+                    outcomes[i] = (result, None)
+            todo = retry
+            if not todo or attempt == self.retries:
+                break
+            time.sleep(self.backoff * 2**attempt)
+        for i in todo:
+            logger.error(f"Pocket action {actions[i]} failed: {outcomes[i][1]}")
+        return outcomes
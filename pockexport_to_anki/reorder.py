@@ -0,0 +1,268 @@
+"""Ordering of the new Anki cards for review.
+
+A strategy takes a list of `NewCard`s, a random number generator from
+`make_rng` and the options given on the command line, and returns the cards
+in review order. Strategies are registered by name with `@strategy(name)`.
+
+With NumPy installed, `make_rng` returns a `numpy.random.Generator` and the
+strategies draw their random numbers in bulk; otherwise they use the
+standard `random` module. The same seed gives different orders in the two
+cases. The `mixed` strategy instead derives the random numbers of each card
+from a hash of its id and the seed, so that its order is the same with or
+without NumPy, and a card keeps its place when others are added or removed.
+"""
+
+import bisect
+import hashlib
+import math
+import struct
+
+from pockexport_to_anki.model import tag_table
+
+# Default `--card-order` strategy.
+DEFAULT_STRATEGY = "mixed"
+# Fraction of the cards left in recency order by the `mixed` strategy.
+RECENT_FRACTION = 0.7
+# Anki's Check Database wraps the due positions of new cards from 1,000,000.
+DUE_LIMIT = 1_000_000
+# Age, in days, at which the `age-weighted` strategy halves the weight of a
+# card.
+AGE_HALF_LIFE_DAYS = 30
+
+STRATEGIES = dict()
+
+
+def strategy(name):
+    """Register the decorated function as the strategy `name`."""
+
+    def register(f):
+        STRATEGIES[name] = f
+        return f
+
+    return register
+
+
+def make_rng(seed=None):
+    """Return a random number generator for the strategies, seeded with
+    `seed` if not None.
+    """
+    try:
+        import numpy
+    except ImportError:
+        import random
+
+        return random if seed is None else random.Random(seed)
+    return numpy.random.default_rng(seed)
+
+
+def _is_numpy(rng):
+    return hasattr(rng, "bit_generator")
+
+
+def order_new_cards(new_cards, rng, strategy=DEFAULT_STRATEGY, **options):
+    """Return `new_cards`, a list of `NewCard`s, in review order according to
+    `strategy`.
+    """
+    try:
+        order = STRATEGIES[strategy]
+    except KeyError:
+        raise ValueError(f"unknown card order strategy {strategy!r}") from None
+    return order(list(new_cards), rng, **options)
+
+
+def due_updates(card_order):
+    """Return `(card_id, due)` for each card in `card_order` whose due
+    position has to change for the cards to come up in that order.
+
+    The longest sequence of cards whose due positions already increase along
+    `card_order` keep them, and the other cards are spread over the gaps in
+    between. Where a gap is too small, it is widened over its neighbours,
+    which are spread out with it. A card added where there is room only
+    moves itself; one added among consecutive positions, as Anki numbers
+    new cards, also moves the cards after it, which leaves room for later
+    additions.
+    """
+    dues = [
+        card.due if card.due is not None and 0 <= card.due < DUE_LIMIT else None
+        for card in card_order
+    ]
+    kept = _longest_increasing(dues)
+    n = len(card_order)
+    i = 0
+    while i < n:
+        if i in kept:
+            i += 1
+            continue
+        start = end = i
+        while end < n and end not in kept:
+            end += 1
+        while True:
+            lo = dues[start - 1] if start > 0 else -1
+            hi = dues[end] if end < n else DUE_LIMIT
+            if hi - lo > end - start or (start == 0 and end == n):
+                break
+            if end < n:
+                end += 1
+                while end < n and end not in kept:
+                    end += 1
+            else:
+                start -= 1
+        for k in range(start, end):
+            dues[k] = lo + (k - start + 1) * (hi - lo) // (end - start + 1)
+        i = end
+    return [
+        (card.card_id, due) for card, due in zip(card_order, dues) if card.due != due
+    ]
+
+
+def _longest_increasing(values):
+    """Return the indices of a longest strictly increasing subsequence of
+    `values`, skipping None.
+    """
+    # tails[k] is the index ending the smallest-valued increasing
+    # subsequence of length k + 1 found so far.
+    tails = list()
+    tail_values = list()
+    previous = dict()
+    for i, value in enumerate(values):
+        if value is None:
+            continue
+        k = bisect.bisect_left(tail_values, value)
+        previous[i] = tails[k - 1] if k else None
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[k] = i
+            tail_values[k] = value
+    indices = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        indices.add(i)
+        i = previous[i]
+    return indices
+
+
+def card_random(card_id, seed=None):
+    """Return two random numbers in [0, 1) for `card_id`, always the same
+    for the same `seed`.
+    """
+    digest = hashlib.blake2b(f"{seed}:{card_id}".encode(), digest_size=16).digest()
+    a, b = struct.unpack("<QQ", digest)
+    return a / 2**64, b / 2**64
+
+
+@strategy("recency")
+def by_recency(cards, rng, **options):
+    """Most recently added to Pocket first."""
+    # `sorted` is stable, so cards added at the same time keep their order.
+    return sorted(cards, key=(lambda card: card.time_added), reverse=True)
+
+
+@strategy("random")
+def by_random(cards, rng, **options):
+    """Uniformly random order."""
+    if _is_numpy(rng):
+        return [cards[i] for i in rng.permutation(len(cards))]
+    rng.shuffle(cards)
+    return cards
+
+
+@strategy("mixed")
+def by_mixed(cards, rng, recent_fraction=RECENT_FRACTION, seed=None, **options):
+    """Generally I'd like to review the most recent additions to Pocket
+    first, but mix in some older material as well - by default 70% recent,
+    30% randomly selected.
+
+    Which cards are moved, and where to, comes from `card_random` with
+    `seed`, not from `rng`, so that cards keep their relative order from one
+    sync to the next.
+    """
+    if not cards:
+        return cards
+    oldest = min(card.time_added for card in cards)
+
+    def key(card):
+        stay, position = card_random(card.card_id, seed)
+        if stay < recent_fraction:
+            return card.time_added, card.card_id
+        # Move the card back to a random time between when it was added and
+        # when the oldest card was.
+        return card.time_added - position * (card.time_added - oldest), card.card_id
+
+    return sorted(cards, key=key, reverse=True)
+
+
+@strategy("age-weighted")
+def by_age_weight(cards, rng, half_life_days=AGE_HALF_LIFE_DAYS, **options):
+    """Random order, biased towards recent additions: a card's weight halves
+    every `half_life_days` days older than the newest card.
+    """
+    if not cards:
+        return cards
+    newest = max(card.time_added for card in cards)
+    rate = math.log(2) / (half_life_days * 24 * 3600)
+    # Weighted sampling without replacement (Efraimidis and Spirakis): sort
+    # by an exponential variate divided by the weight, smallest first. Keys
+    # are compared as logarithms, since the weights of old cards underflow.
+    if _is_numpy(rng):
+        import numpy
+
+        ages = numpy.fromiter(
+            (newest - card.time_added for card in cards), float, len(cards)
+        )
+        with numpy.errstate(divide="ignore"):
+            keys = numpy.log(rng.exponential(size=len(cards))) + ages * rate
+        return [cards[i] for i in numpy.argsort(keys, kind="stable")]
+    keys = list()
+    for card in cards:
+        variate = rng.expovariate(1.0)
+        keys.append(
+            (math.log(variate) if variate else -math.inf)
+            + (newest - card.time_added) * rate
+        )
+    return [cards[i] for i in sorted(range(len(cards)), key=keys.__getitem__)]
+
+
+@strategy("tag-quota")
+def by_tag_quota(cards, rng, tag_quotas=None, **options):
+    """Interleave the cards so that the cards with each tag in `tag_quotas`
+    (a dict mapping tag name to a share between 0 and 1) take up that share
+    of the order, and the remaining cards the rest. Each group is in `mixed`
+    order.
+
+    A card belongs to the group of the first tag of `tag_quotas` it has.
+    """
+    tag_quotas = dict(tag_quotas or dict())
+    groups = dict((tag_table.id(tag), list()) for tag in tag_quotas)
+    shares = dict((tag_table.id(tag), share) for tag, share in tag_quotas.items())
+    others = list()
+    for card in cards:
+        group = next((tag_id for tag_id in groups if tag_id in card.tags), None)
+        (groups[group] if group is not None else others).append(card)
+    queues = [
+        (shares[tag_id], by_mixed(group, rng, **options))
+        for tag_id, group in groups.items()
+    ]
+    queues.append(
+        (max(0.0, 1.0 - sum(shares.values())), by_mixed(others, rng, **options))
+    )
+    queues = [(share, group) for share, group in queues if group]
+    # Smooth weighted round robin: each turn, every group earns its share,
+    # and the group with the most credit gives its next card. Groups with a
+    # zero share only go once the others are used up.
+    credits = [0.0] * len(queues)
+    positions = [0] * len(queues)
+    order = list()
+    while queues:
+        total = sum(share for share, _ in queues)
+        for k, (share, _) in enumerate(queues):
+            credits[k] += share if total else 1.0
+        k = max(range(len(queues)), key=(lambda k: credits[k]))
+        credits[k] -= total if total else len(queues)
+        share, group = queues[k]
+        order.append(group[positions[k]])
+        positions[k] += 1
+        if positions[k] == len(group):
+            del queues[k], credits[k], positions[k]
+    return order
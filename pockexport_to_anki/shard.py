@@ -0,0 +1,111 @@
+"""Planning in worker processes, for very large exports.
+
+The items are read and their notes loaded in batches in the main process,
+as for `plan_sync`. Each batch is split into shards by a hash of the item
+ID, and each shard is planned by a worker process against the part of the
+`AnkiSnapshot` it needs. The item plans are merged back in the order of the
+items, so the resulting `SyncPlan` is the same as with `plan_sync`.
+"""
+
+import collections
+import itertools
+import logging
+import signal
+import zlib
+
+from pockexport_to_anki.ankiconnect import batched
+from pockexport_to_anki.plan import ItemPlan, SyncPlan, plan_item
+from pockexport_to_anki.snapshot import PREFETCH_BATCH_SIZE
+
+logger = logging.getLogger("pockexport-to-anki")
+
+
+def shard_of(item_id, shards):
+    # `hash` is randomized per process, so use a stable hash.
+    return zlib.crc32(item_id.encode()) % shards
+
+
+def _init_worker():
+    # Leave KeyboardInterrupt to the main process, which stops submitting
+    # batches and keeps the plan for the items seen so far.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _plan_shard(entries, snapshot):
+    """Plan the `(index, item)` pairs in `entries` in a worker process.
+
+    Returns `(index, record, new_note)` for each item planned, with `record`
+    from `ItemPlan.to_journal`.
+    """
+    results = list()
+    for index, item in entries:
+        item_plan = plan_item(item, snapshot)
+        if item_plan is not None:
+            results.append((index, item_plan.to_journal(), item_plan.new_note))
+    return results
+
+
+def plan_sync_sharded(
+    items,
+    snapshot,
+    workers,
+    plan=None,
+    journal=None,
+    batch_size=PREFETCH_BATCH_SIZE,
+    should_stop=None,
+):
+    """Like `plan_sync`, but plan the items in `workers` worker processes."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    if plan is None:
+        plan = SyncPlan()
+    batches = batched(snapshot.iter_loaded(items, batch_size), batch_size)
+    # Keep a couple of batches per worker in flight, so that workers do not
+    # wait for the main process to read and load the next batch.
+    window = collections.deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        try:
+            for batch in batches:
+                if should_stop is not None and should_stop():
+                    logger.info("Stop requested - finishing sync")
+                    plan.interrupted = True
+                    break
+                shards = [list() for _ in range(workers)]
+                for index, item in enumerate(batch):
+                    shards[shard_of(item.item_id, workers)].append((index, item))
+                futures = [
+                    executor.submit(
+                        _plan_shard,
+                        shard,
+                        snapshot.subset(item.item_id for _, item in shard),
+                    )
+                    for shard in shards
+                    if shard
+                ]
+                window.append((batch, futures))
+                if len(window) >= 2 * workers:
+                    _merge_batch(plan, journal, *window.popleft())
+            while window:
+                _merge_batch(plan, journal, *window.popleft())
+        except KeyboardInterrupt:
+            logger.info("Received KeyboardInterrupt - finishing sync")
+            plan.interrupted = True
+            for _, futures in window:
+                for future in futures:
+                    future.cancel()
+    return plan
+
+
+def _merge_batch(plan, journal, batch, futures):
+    results = sorted(
+        itertools.chain.from_iterable(future.result() for future in futures),
+        key=(lambda result: result[0]),
+    )
+    for index, record, new_note in results:
+        item_plan = ItemPlan.from_journal(record)
+        if new_note is not None:
+            item_plan.new_note = new_note
+            item_plan.item = batch[index]
+        plan.merge(item_plan)
+        if journal is not None and new_note is None:
+            journal.add(item_plan)
@@ -0,0 +1,541 @@
+import logging
+import threading
+import time
+
+from pockexport_to_anki.ankiconnect import batched
+from pockexport_to_anki.mapping import DEFAULT_MAPPING, SYNC_TIME_FIELD
+from pockexport_to_anki.model import AnkiCard, AnkiNote, CardStates, NewCard
+from pockexport_to_anki.state import ItemState
+
+logger = logging.getLogger("pockexport-to-anki")
+
+# Number of notes/cards requested per action when prefetching the Anki state.
+PREFETCH_BATCH_SIZE = 1000
+# Number of prefetch actions packed into each `multi` request.
+PREFETCH_MULTI_SIZE = 4
+# `refresh_anki_snapshot` finds the notes modified since the last refresh
+# with an `edited:` search over this many days, so it fetches everything
+# anew once the last refresh is older.
+REFRESH_DAYS = 1
+# `findCards` searches for each of the `CardStates`, within the note type.
+CARD_STATE_SEARCHES = (
+    # Anki's `is:review` matches relearning cards (type 3) as well as review
+    # cards (type 2), and `is:learn` only the cards in a learning queue, so
+    # this still matches the relearning cards that are suspended or buried.
+    # `classify_cards` checks the type of those with `cardsInfo`.
+    ("review", "is:review -is:learn"),
+    ("suspended", "is:suspended"),
+    ("new", "is:new -is:suspended -is:buried"),
+)
+# `findCards` searches for the cards of the "review" search that may be
+# relearning cards.
+SHELVED_REVIEW_SEARCHES = ("is:review is:suspended", "is:review is:buried")
+
+
+class AnkiSnapshot:
+    """In-memory index of the Anki notes and cards of the Pocket note type.
+
+    Built up front by `prefetch_anki_snapshot` so that planning can look up
+    notes and cards without any AnkiConnect round trips, and brought up to
+    date for a later sync by `refresh_anki_snapshot`. Notes and cards
+    are kept as compact `AnkiNote` and `AnkiCard` records. Notes
+    known to be unchanged since the last sync (see `SyncState`) are indexed
+    by ID only and loaded on first use. Fields are read as mapped by
+    `mapping`, a `NoteMapping`.
+
+    Once `classify_cards` has filled in `card_states`, only the new cards
+    are loaded, for their due position. Otherwise all the cards of the
+    loaded notes are, and classified as they are loaded.
+    """
+
+    def __init__(self, client, mapping=DEFAULT_MAPPING):
+        self.client = client
+        self.mapping = mapping
+        # Map Anki note ID to the `AnkiNote` for that note.
+        self.notes = dict()
+        # Map Pocket item ID to the Anki note ID holding it.
+        self.note_by_item_id = dict()
+        # Map Anki card ID to the `AnkiCard` for that card.
+        self.cards = dict()
+        self.card_states = CardStates()
+        # Whether `card_states` was filled in by `classify_cards`.
+        self.classified = False
+        # Map Anki card ID to its modification time.
+        self.card_mod = dict()
+        # Note IDs edited within the `--edited` window (all notes otherwise).
+        self.recently_edited = set()
+        # Map note ID to its card IDs, for notes not loaded yet.
+        self.unloaded = dict()
+        # Note IDs whose note and cards are unchanged since the last sync.
+        self.unchanged = set()
+        # Map note ID to its modification time as of `refreshed`, the
+        # `time.time()` at which `refresh_anki_snapshot` last ran, if at all.
+        self.note_mod = dict()
+        self.refreshed = None
+        self._lock = threading.Lock()
+
+    # Drop the client and the lock when pickling a `subset` for a planning
+    # worker.
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["client"], state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, client=None, _lock=threading.Lock())
+
+    def subset(self, item_ids):
+        """Return a snapshot with only what `plan_item` needs to plan the
+        items `item_ids`, whose notes must be loaded already.
+        """
+        sub = AnkiSnapshot(None, self.mapping)
+        sub.classified = self.classified
+        card_ids = list()
+        for item_id in item_ids:
+            note_id = self.note_by_item_id.get(item_id)
+            if note_id is None:
+                continue
+            sub.note_by_item_id[item_id] = note_id
+            if note_id not in self.recently_edited:
+                continue
+            sub.recently_edited.add(note_id)
+            note = self.notes.get(note_id)
+            if note is None:
+                continue
+            sub.notes[note_id] = note
+            card_ids.extend(note.card_ids)
+            for card_id in note.card_ids:
+                if card_id in self.cards:
+                    sub.cards[card_id] = self.cards[card_id]
+                if card_id in self.card_mod:
+                    sub.card_mod[card_id] = self.card_mod[card_id]
+        sub.card_states = self.card_states.subset(card_ids)
+        return sub
+
+    def drop(self, note_ids):
+        """Forget the notes in `note_ids` and their cards."""
+        note_ids = set(note_ids)
+        for note_id in note_ids:
+            note = self.notes.pop(note_id, None)
+            card_ids = self.unloaded.pop(note_id, ())
+            if note is not None:
+                card_ids = note.card_ids
+            for card_id in card_ids:
+                self.cards.pop(card_id, None)
+                self.card_mod.pop(card_id, None)
+            self.note_mod.pop(note_id, None)
+        self.unchanged -= note_ids
+        for item_id in [
+            item_id
+            for item_id, note_id in self.note_by_item_id.items()
+            if note_id in note_ids
+        ]:
+            del self.note_by_item_id[item_id]
+
+    def add_note(self, note_info):
+        note = AnkiNote.from_info(note_info, self.mapping)
+        self.notes[note.note_id] = note
+        if note.item_id:
+            self.add_item_id(note.item_id, note.note_id)
+
+    def add_item_id(self, item_id, note_id):
+        # Like `findNotes`, prefer the oldest note if several share an item
+        # ID.
+        existing = self.note_by_item_id.get(item_id)
+        if existing is None or note_id < existing:
+            self.note_by_item_id[item_id] = note_id
+
+    def add_card(self, card_info):
+        card = AnkiCard.from_info(card_info, self.mapping.time_added_field)
+        self.cards[card.card_id] = card
+        if not self.classified:
+            self.card_states.add(card)
+
+    def cards_to_load(self, card_ids):
+        """Return the IDs in `card_ids` of the cards whose `cardsInfo` is
+        needed.
+        """
+        if self.classified:
+            return [c for c in card_ids if c in self.card_states.new]
+        return list(card_ids)
+
+    def note_for_item(self, item_id):
+        note_id = self.note_by_item_id.get(item_id)
+        if note_id is None:
+            return None
+        if note_id in self.unloaded:
+            self._load([note_id])
+        return self.notes.get(note_id)
+
+    def iter_loaded(self, items, batch_size=PREFETCH_BATCH_SIZE):
+        """Yield the Pocket items in `items`, loading the notes of each batch
+        of `batch_size` items first, so that `note_for_item` makes no
+        requests for them.
+
+        Only notes in `recently_edited` are loaded, since the others are
+        skipped anyway.
+        """
+        for batch in batched(items, batch_size):
+            note_ids = list()
+            for item in batch:
+                note_id = self.note_by_item_id.get(item.item_id)
+                if note_id in self.unloaded and note_id in self.recently_edited:
+                    note_ids.append(note_id)
+            self._load(note_ids)
+            yield from batch
+
+    def _load(self, note_ids):
+        with self._lock:
+            note_ids = [note_id for note_id in note_ids if note_id in self.unloaded]
+            card_ids = self.cards_to_load(
+                card_id
+                for note_id in note_ids
+                for card_id in self.unloaded.pop(note_id)
+            )
+        if not note_ids:
+            return
+        payloads = [
+            {"action": "notesInfo", "params": {"notes": list(batch)}}
+            for batch in batched(note_ids, PREFETCH_BATCH_SIZE)
+        ] + [
+            {"action": "cardsInfo", "params": {"cards": list(batch)}}
+            for batch in batched(card_ids, PREFETCH_BATCH_SIZE)
+        ]
+        for payload, response in zip(payloads, self.client.stream(payloads)):
+            for info in response["result"] or []:
+                if not info:
+                    continue
+                if payload["action"] == "cardsInfo":
+                    self.add_card(info)
+                else:
+                    self.notes[info["noteId"]] = AnkiNote.from_info(info, self.mapping)
+
+    def note_cards(self, note):
+        """Return the loaded `AnkiCard`s of `note`."""
+        return [
+            self.cards[card_id] for card_id in note.card_ids if card_id in self.cards
+        ]
+
+    def new_cards(self, card_tags):
+        """Return the `NewCard`s of the cards in `card_tags`, a dict mapping
+        card ID to the tag IDs of its note.
+        """
+        cards = list()
+        for response in self.client.stream(
+            {"action": "cardsInfo", "params": {"cards": list(batch)}}
+            for batch in batched(sorted(card_tags), PREFETCH_BATCH_SIZE)
+        ):
+            for info in response["result"] or []:
+                if info:
+                    cards.append(
+                        AnkiCard.from_info(info, self.mapping.time_added_field)
+                    )
+        return [
+            NewCard(card.card_id, card.time_added, card.due, card_tags[card.card_id])
+            for card in cards
+        ]
+
+    def mod_time(self, note):
+        return max(
+            (self.card_mod.get(card_id, 0) for card_id in note.card_ids),
+            default=0,
+        )
+
+    def load_notes(self, note_ids, with_cards):
+        """Fetch the notes in `note_ids`, and the cards of those notes in
+        `with_cards`, in batched requests.
+        """
+        responses = self.client.stream(
+            (
+                {
+                    "action": "notesInfo",
+                    "params": {"notes": list(batch)},
+                }
+                for batch in batched(sorted(note_ids), PREFETCH_BATCH_SIZE)
+            ),
+            PREFETCH_MULTI_SIZE,
+        )
+        for response in responses:
+            for note_info in response["result"] or []:
+                if note_info:
+                    self.add_note(note_info)
+        card_ids = sorted(
+            card_id
+            for note_id in with_cards
+            if note_id in self.notes
+            for card_id in self.notes[note_id].card_ids
+        )
+        payloads = [
+            {"action": "cardsInfo", "params": {"cards": list(batch)}}
+            for batch in batched(self.cards_to_load(card_ids), PREFETCH_BATCH_SIZE)
+        ] + [
+            {"action": "cardsModTime", "params": {"cards": list(batch)}}
+            for batch in batched(card_ids, PREFETCH_BATCH_SIZE)
+        ]
+        responses = self.client.stream(payloads, PREFETCH_MULTI_SIZE)
+        for payload, response in zip(payloads, responses):
+            for card in response["result"] or []:
+                if not card:
+                    continue
+                if payload["action"] == "cardsInfo":
+                    self.add_card(card)
+                else:
+                    self.card_mod[card["cardId"]] = card["mod"]
+
+
+def _mod_times(client, action, key, ids):
+    payloads = [
+        {"action": action, "params": {key: list(batch)}}
+        for batch in batched(sorted(ids), PREFETCH_BATCH_SIZE)
+    ]
+    id_key = "noteId" if key == "notes" else "cardId"
+    return dict(
+        (x[id_key], x["mod"])
+        for response in client.stream(payloads, PREFETCH_MULTI_SIZE)
+        for x in response["result"] or []
+        if x
+    )
+
+
+def classify_cards(client, note_type, edited=None):
+    """Return the `CardStates` of the cards of the note type `note_type`,
+    with one `findCards` search per state, rather than the `cardsInfo` of
+    every card. Only the cards of notes edited in the past `edited` days are
+    classified, if given.
+
+    Like `CardStates.add`, this counts the cards of type 2 as reviewed. No
+    search tells them apart from suspended or buried relearning cards, so
+    the `cardsInfo` of those cards is fetched.
+    """
+    scope = f'"note:{note_type}"' + (f" edited:{edited}" if edited else "")
+    searches = [search for _, search in CARD_STATE_SEARCHES]
+    searches.extend(SHELVED_REVIEW_SEARCHES)
+    results = [
+        response["result"] or []
+        for response in client.stream(
+            {"action": "findCards", "params": {"query": f"{scope} {search}"}}
+            for search in searches
+        )
+    ]
+    states = CardStates(
+        **dict(
+            (state, result) for (state, _), result in zip(CARD_STATE_SEARCHES, results)
+        )
+    )
+    shelved = set()
+    for result in results[len(CARD_STATE_SEARCHES) :]:
+        shelved.update(result)
+    for response in client.stream(
+        {"action": "cardsInfo", "params": {"cards": list(batch)}}
+        for batch in batched(sorted(shelved), PREFETCH_BATCH_SIZE)
+    ):
+        for info in response["result"] or []:
+            if info and info["type"] != 2:
+                states.review.discard(info["cardId"])
+    return states
+
+
+def prefetch_anki_snapshot(client, mapping, edited=None, state=None):
+    """Fetch every note of the note type of `mapping`, a `NoteMapping`, with
+    its cards, in batched requests.
+
+    Cards are only fetched for notes edited in the past `edited` days, since
+    the sync loop skips all other notes, and only the new ones: the state of
+    the others is found with `classify_cards`. If `state` (a `SyncState`) is
+    given, only the modification times of notes and cards are fetched up
+    front, and notes whose note and cards did not change since the last sync
+    are left unloaded.
+    """
+    snapshot = AnkiSnapshot(client, mapping)
+    refresh_anki_snapshot(snapshot, edited, state)
+    return snapshot
+
+
+def refresh_anki_snapshot(snapshot, edited=None, state=None):
+    """Bring `snapshot`, from `prefetch_anki_snapshot` or new, up to date
+    for another sync, as `prefetch_anki_snapshot` would build it.
+
+    With `state`, only the notes that may have changed since the snapshot
+    was last fetched are fetched again: the notes it loaded, which the sync
+    may have written, notes added since, notes modified since, and notes of
+    cards that changed state. The snapshot is fetched anew without `state`,
+    or if it was last fetched more than `REFRESH_DAYS` days ago.
+    """
+    client = snapshot.client
+    note_type = snapshot.mapping.note_type
+    started = time.time()
+    note_ids = client.invoke("findNotes", query=f'"note:{note_type}"')
+    if edited:
+        snapshot.recently_edited = set(
+            client.invoke("findNotes", query=f'"note:{note_type}" edited:{edited}')
+        )
+    else:
+        snapshot.recently_edited = set(note_ids)
+    old_states = snapshot.card_states
+    snapshot.card_states = classify_cards(client, note_type, edited)
+    snapshot.classified = True
+    current = set(note_ids)
+    known = set(snapshot.notes) | set(snapshot.unloaded)
+    full = (
+        state is None
+        or snapshot.refreshed is None
+        or started - snapshot.refreshed >= REFRESH_DAYS * 86400
+    )
+    if full:
+        stale = known | current
+    else:
+        stale = (current - known) | set(snapshot.notes)
+        recent = client.invoke(
+            "findNotes", query=f'"note:{note_type}" edited:{REFRESH_DAYS}'
+        )
+        for note_id, mod in _mod_times(client, "notesModTime", "notes", recent).items():
+            if snapshot.note_mod.get(note_id) != mod:
+                stale.add(note_id)
+        moved = set()
+        for state_name in CardStates.__slots__:
+            moved.update(
+                getattr(old_states, state_name)
+                ^ getattr(snapshot.card_states, state_name)
+            )
+        for response in client.stream(
+            {"action": "cardsInfo", "params": {"cards": list(batch)}}
+            for batch in batched(sorted(moved), PREFETCH_BATCH_SIZE)
+        ):
+            for card_info in response["result"] or []:
+                if card_info:
+                    stale.add(card_info["note"])
+        stale |= known - current
+    snapshot.drop(stale)
+    snapshot.refreshed = started
+    # Otherwise the cards created since are among the cards that changed
+    # state.
+    _fetch_notes(snapshot, stale & current, state, find_new_cards=full)
+    logger.info(
+        f"Prefetched {len(snapshot.notes)} notes and {len(snapshot.cards)} new cards"
+        + (
+            f"; {len(snapshot.unchanged)} notes unchanged since last sync"
+            if state is not None
+            else ""
+        )
+    )
+
+
+def _fetch_notes(snapshot, note_ids, state=None, find_new_cards=True):
+    """Add the notes in `note_ids` to `snapshot`: unloaded if `state` shows
+    that neither they nor their cards changed since the last sync, loaded
+    otherwise. With `find_new_cards`, the notes of cards created since the
+    last sync are looked up and loaded too.
+    """
+    client = snapshot.client
+    changed = set(note_ids)
+    if state is not None:
+        known = state.items_by_note_id()
+        note_mod = _mod_times(client, "notesModTime", "notes", note_ids)
+        snapshot.note_mod.update(note_mod)
+        snapshot.card_mod.update(
+            _mod_times(
+                client,
+                "cardsModTime",
+                "cards",
+                [
+                    card_id
+                    for note_id in note_ids
+                    if note_id in known
+                    for card_id in known[note_id].card_ids
+                ],
+            )
+        )
+        unchanged = set()
+        for note_id in note_ids:
+            item = known.get(note_id)
+            if item is None or note_mod.get(note_id) != item.note_mod:
+                continue
+            if item.card_ids and all(
+                card_id in snapshot.card_mod for card_id in item.card_ids
+            ):
+                cards_mod = max(snapshot.card_mod[c] for c in item.card_ids)
+                if cards_mod == item.cards_mod:
+                    unchanged.add(note_id)
+        # Cards created since the last sync belong to notes that must be
+        # reloaded. There are usually few of them, so look up their notes
+        # with `cardsInfo`.
+        new_card_ids = list()
+        if find_new_cards and unchanged:
+            known_card_ids = set()
+            for item in known.values():
+                known_card_ids.update(item.card_ids)
+            new_card_ids = [
+                c
+                for c in client.invoke(
+                    "findCards", query=f'"note:{snapshot.mapping.note_type}"'
+                )
+                if c not in known_card_ids
+            ]
+        for response in client.stream(
+            {"action": "cardsInfo", "params": {"cards": list(batch)}}
+            for batch in batched(new_card_ids, PREFETCH_BATCH_SIZE)
+        ):
+            for card_info in response["result"] or []:
+                if card_info:
+                    unchanged.discard(card_info["note"])
+        for note_id in unchanged:
+            item = known[note_id]
+            snapshot.add_item_id(item.item_id, note_id)
+            snapshot.unloaded[note_id] = item.card_ids
+        snapshot.unchanged |= unchanged
+        changed -= unchanged
+    snapshot.load_notes(changed, changed & snapshot.recently_edited)
+
+
+def record_synced_items(client, state, synced_items, failed_items=()):
+    """Record the current Anki state of synced items in `state`.
+
+    `synced_items` maps each Pocket item ID to a `(note_id, field_hash,
+    time_updated)` tuple. The items in `failed_items`, some of whose writes
+    failed, are left out, so that the next sync does not skip them. Must be
+    called after all writes to Anki are done, so that the recorded
+    modification times include them.
+    """
+    by_note_id = dict(
+        (note_id, (item_id, field_hash, time_updated))
+        for item_id, (note_id, field_hash, time_updated) in synced_items.items()
+        if item_id not in failed_items
+    )
+    for batch in batched(sorted(by_note_id), PREFETCH_BATCH_SIZE):
+        note_response, mod_response = client.stream(
+            [
+                {"action": "notesInfo", "params": {"notes": list(batch)}},
+                {"action": "notesModTime", "params": {"notes": list(batch)}},
+            ]
+        )
+        note_mod = dict(
+            (x["noteId"], x["mod"]) for x in mod_response["result"] or [] if x
+        )
+        note_infos = [ni for ni in note_response["result"] or [] if ni]
+        card_mod = _mod_times(
+            client,
+            "cardsModTime",
+            "cards",
+            [card_id for ni in note_infos for card_id in ni["cards"]],
+        )
+        item_states = []
+        for ni in note_infos:
+            note_id = ni["noteId"]
+            item_id, field_hash, time_updated = by_note_id[note_id]
+            try:
+                time_last_synced = int(ni["fields"][SYNC_TIME_FIELD]["value"])
+            except (KeyError, ValueError):
+                time_last_synced = 0
+            item_states.append(
+                ItemState(
+                    item_id,
+                    note_id,
+                    ni["cards"],
+                    field_hash,
+                    time_updated,
+                    time_last_synced,
+                    note_mod.get(note_id, 0),
+                    max((card_mod.get(c, 0) for c in ni["cards"]), default=0),
+                )
+            )
+        state.record(item_states)
@@ -0,0 +1,122 @@
+import json
+import os
+import os.path
+import sqlite3
+import threading
+
+
+def default_state_db_path():
+    state_home = os.environ.get("XDG_STATE_HOME") or os.path.expanduser(
+        "~/.local/state"
+    )
+    return os.path.join(state_home, "pockexport-to-anki", "state.sqlite3")
+
+
+class ItemState:
+    """What was last synced for a single Pocket item."""
+
+    __slots__ = (
+        "item_id",
+        "note_id",
+        "card_ids",
+        "field_hash",
+        "time_updated",
+        "time_last_synced",
+        "note_mod",
+        "cards_mod",
+    )
+
+    def __init__(
+        self,
+        item_id,
+        note_id,
+        card_ids,
+        field_hash,
+        time_updated,
+        time_last_synced,
+        note_mod,
+        cards_mod,
+    ):
+        self.item_id = item_id
+        self.note_id = note_id
+        self.card_ids = card_ids
+        self.field_hash = field_hash
+        self.time_updated = time_updated
+        self.time_last_synced = time_last_synced
+        self.note_mod = note_mod
+        self.cards_mod = cards_mod
+
+
+class SyncState:
+    """Local SQLite database recording the state of each item after its last
+    sync, so that later runs can skip items that changed on neither side.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS items (
+                    item_id TEXT PRIMARY KEY,
+                    note_id INTEGER NOT NULL,
+                    card_ids TEXT NOT NULL,
+                    field_hash INTEGER NOT NULL,
+                    time_updated INTEGER NOT NULL,
+                    time_last_synced INTEGER NOT NULL,
+                    note_mod INTEGER NOT NULL,
+                    cards_mod INTEGER NOT NULL
+                )
+                """
+            )
+        self.items = self._load()
+
+    def _load(self):
+        items = dict()
+        for row in self._conn.execute(
+            "SELECT item_id, note_id, card_ids, field_hash, time_updated,"
+            " time_last_synced, note_mod, cards_mod FROM items"
+        ):
+            row = list(row)
+            row[2] = json.loads(row[2])
+            # SQLite integers are signed, see `record`.
+            row[3] &= (1 << 64) - 1
+            items[row[0]] = ItemState(*row)
+        return items
+
+    def items_by_note_id(self):
+        return dict((item.note_id, item) for item in self.items.values())
+
+    def record(self, item_states):
+        """Insert or replace the state of each `ItemState` in `item_states`."""
+        rows = []
+        for item in item_states:
+            self.items[item.item_id] = item
+            rows.append(
+                (
+                    item.item_id,
+                    item.note_id,
+                    json.dumps(sorted(item.card_ids)),
+                    # Store the unsigned 64-bit hash as a signed integer.
+                    item.field_hash - (1 << 64)
+                    if item.field_hash >= 1 << 63
+                    else item.field_hash,
+                    item.time_updated,
+                    item.time_last_synced,
+                    item.note_mod,
+                    item.cards_mod,
+                )
+            )
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,198 @@
+"""Compact binary copy of a pockexport data file, read with `mmap`.
+
+`convert_export` writes the items of a pockexport JSON data file to an export
+store, which the sync then reads wherever it takes a data file. The store
+holds:
+
+- a header: `MAGIC` and the number of items;
+- the index: one fixed-width `RECORD` per item, sorted by item ID, with the
+  `PocketItem.fingerprint` of the item and where its fields are in the heap;
+- the order: the index position of each item, in the order of the data file;
+- the heap: the fields of each item, as compact JSON.
+
+Only the items used are decoded, and comparing two stores is a merge of
+their indexes, so that finding the items changed between two exports does
+not decode the unchanged ones.
+"""
+
+import argparse
+import json
+import logging
+import mmap
+import os
+import os.path
+import struct
+
+from pockexport_to_anki.model import FINGERPRINT_FIELDS, PocketItem, tag_table
+
+logger = logging.getLogger("pockexport-to-anki")
+
+MAGIC = b"PXSTORE1"
+# Magic and number of items.
+HEADER = struct.Struct("<8sQ")
+# Item ID, fingerprint, and offset in the heap and length of the fields.
+RECORD = struct.Struct("<QQQI")
+# The item ID and fingerprint of a `RECORD`.
+RECORD_KEY = struct.Struct("<QQ12x")
+# Index position of an item, in the order of the data file.
+POSITION = struct.Struct("<I")
+# Bytes of the index or order copied out of the map at a time.
+CHUNK_SIZE = 1 << 16
+
+
+def is_export_store(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _item_id(item_id):
+    """Return the item ID `item_id` as an integer, for the index."""
+    if not (item_id.isdigit() and str(int(item_id)) == item_id):
+        raise ValueError(f"item ID {item_id!r} is not a number")
+    return int(item_id)
+
+
+def convert_export(path, store_path):
+    """Write the items of the pockexport data file `path` to a new export
+    store at `store_path`. Returns the number of items.
+
+    Raises ValueError if an item ID is not a number.
+    """
+    import tempfile
+
+    from pockexport_to_anki.export import iter_export_items
+
+    directory = os.path.dirname(os.path.abspath(store_path))
+    # Map item ID to its fingerprint, and the offset and length of its fields
+    # in the heap, in file order.
+    entries = dict()
+    with tempfile.TemporaryFile(dir=directory) as heap:
+        offset = 0
+        for item in iter_export_items(path):
+            data = json.dumps(
+                [getattr(item, k) for k in FINGERPRINT_FIELDS]
+                + [item.authors, tag_table.names(item.tags)],
+                separators=(",", ":"),
+            ).encode()
+            entries[_item_id(item.item_id)] = (item.fingerprint(), offset, len(data))
+            heap.write(data)
+            offset += len(data)
+        item_ids = sorted(entries)
+        positions = dict((item_id, i) for i, item_id in enumerate(item_ids))
+        tmp_path = f"{store_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(item_ids)))
+            f.write(
+                b"".join(
+                    RECORD.pack(item_id, *entries[item_id]) for item_id in item_ids
+                )
+            )
+            f.write(b"".join(POSITION.pack(positions[k]) for k in entries))
+            heap.seek(0)
+            while chunk := heap.read(1 << 20):
+                f.write(chunk)
+        os.replace(tmp_path, store_path)
+    return len(item_ids)
+
+
+class ExportStore:
+    """An export store, mapped into memory. Use as a context manager, or
+    call `close`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path}: not an export store")
+        self._order = HEADER.size + self.count * RECORD.size
+        self._heap = self._order + self.count * POSITION.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, position):
+        return RECORD.unpack_from(self._map, HEADER.size + position * RECORD.size)
+
+    def _iter_unpack(self, s, start, end):
+        """Yield the `struct.Struct` `s` unpacked from the map between
+        `start` and `end`.
+        """
+        # Copied a chunk at a time rather than read through a memoryview,
+        # which would keep `close` from closing the map while a caller still
+        # holds the iterator.
+        step = CHUNK_SIZE // s.size * s.size
+        for chunk in range(start, end, step):
+            yield from s.iter_unpack(self._map[chunk : min(chunk + step, end)])
+
+    def _decode(self, record, sparse=False):
+        item_id, _, offset, length = record
+        start = self._heap + offset
+        if sparse:
+            # Reading a few items through the map would map in the pages
+            # around each of them, and so most of the heap.
+            data = os.pread(self._file.fileno(), length, start)
+        else:
+            data = self._map[start : start + length]
+        values = json.loads(data)
+        item = PocketItem.__new__(PocketItem)
+        item.item_id = str(item_id)
+        for k, v in zip(FINGERPRINT_FIELDS, values):
+            setattr(item, k, v)
+        item.authors = tuple(values[-2])
+        item.tags = tag_table.ids(values[-1])
+        return item
+
+    def index(self):
+        """Yield `(item_id, fingerprint)` for each item, by item ID."""
+        return self._iter_unpack(RECORD_KEY, HEADER.size, self._order)
+
+    def items(self):
+        """Yield the items as `PocketItem`s, in the order of the data file."""
+        for (position,) in self._iter_unpack(POSITION, self._order, self._heap):
+            yield self._decode(self._record(position))
+
+    def changed_since(self, old):
+        """Yield the items that were added or changed since the export store
+        `old`, in the order of the data file.
+        """
+        old_index = old.index()
+        old_entry = next(old_index, None)
+        changed = list()
+        for position, entry in enumerate(self.index()):
+            while old_entry is not None and old_entry[0] < entry[0]:
+                old_entry = next(old_index, None)
+            if old_entry != entry:
+                changed.append(self._record(position))
+        # The heap is in the order of the data file.
+        changed.sort(key=lambda record: record[2])
+        for record in changed:
+            yield self._decode(record, sparse=True)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a pockexport JSON data file to an export store, "
+        "which pockexport-to-anki reads faster than the JSON file."
+    )
+    parser.add_argument("pockexport_data_file", help="The JSON data file.")
+    parser.add_argument("store", help="The export store to write.")
+    args = parser.parse_args()
+    try:
+        count = convert_export(args.pockexport_data_file, args.store)
+    except ValueError as e:
+        parser.error(str(e))
+    logger.info(f"Wrote {count} items to {args.store}")
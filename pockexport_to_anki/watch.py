@@ -0,0 +1,414 @@
+"""Long-running sync, with `--watch`.
+
+`watch` keeps the process, and with it the Anki and Pocket clients, the read
+cache, the `SyncState` and the Pocket items, between syncs. It polls for
+changes to the pockexport data file, or to the Pocket list with
+`--from-pocket`, and to the notes and cards of the note type in Anki, and
+runs a sync when any of them changed. The state database limits each sync to
+the items that changed on either side.
+
+Anki is only synced with AnkiWeb at the start of a sync every
+`FULL_SYNC_INTERVAL` seconds, since every sync ends with one.
+"""
+
+import gc
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+from pockexport_to_anki.ankiconnect import batched
+from pockexport_to_anki.export import iter_export_items
+from pockexport_to_anki.metrics import metrics
+from pockexport_to_anki.snapshot import CARD_STATE_SEARCHES
+
+logger = logging.getLogger("pockexport-to-anki")
+
+# Default seconds between checks for changes.
+WATCH_INTERVAL = 30.0
+# Default memory use, in MiB, above which the items and notes kept in memory
+# between syncs are dropped.
+WATCH_MAX_MEMORY_MB = 512
+# Seconds after which a sync is run even if nothing changed, also syncing
+# Anki with AnkiWeb first, to pick up changes made on other devices.
+FULL_SYNC_INTERVAL = 3600
+# Longest wait, in seconds, between retries after errors. The wait doubles
+# with each consecutive error, from `--watch-interval`.
+MAX_RETRY_INTERVAL = 600
+# Number of notes per modification time request when polling Anki.
+POLL_BATCH_SIZE = 1000
+
+
+def rss_bytes():
+    """Return the resident set size of the process, or None if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ExportSource:
+    """The items of the pockexport data file `path`, kept in memory while
+    the file is unchanged.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._items = None
+        # Status of the file when `_items` was read, and when last polled.
+        self._read_stat = None
+        self._polled_stat = None
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def items(self):
+        stat = self._stat()
+        if self._items is None or stat != self._read_stat:
+            self._items = list(iter_export_items(self.path))
+            self._read_stat = stat
+        return iter(self._items)
+
+    def changed(self):
+        """Return whether the file changed since it was read, and not since
+        the previous call, so that a file still being written is not read.
+        """
+        stat = self._stat()
+        settled = stat == self._polled_stat
+        self._polled_stat = stat
+        return stat is not None and settled and stat != self._read_stat
+
+    def drop(self):
+        """Drop the items kept in memory. They are read again when needed."""
+        self._items = None
+
+
+def anki_change_signal(client, note_type):
+    """Return the IDs of the notes of the note type `note_type` and of its
+    cards in each state the sync tells apart, and a dict mapping the IDs of
+    its notes edited in the past day to their modification time, to compare
+    with a later signal with `anki_changed`.
+
+    This takes a few searches, and modification times for the recently
+    edited notes only, rather than for every note and card.
+    """
+    query = f'"note:{note_type}"'
+    searches = [("findNotes", query), ("findNotes", f"{query} edited:1")]
+    searches.extend(
+        ("findCards", f"{query} {search}") for _, search in CARD_STATE_SEARCHES
+    )
+    results = [
+        tuple(sorted(response["result"] or []))
+        for response in client.stream(
+            {"action": action, "params": {"query": search}}
+            for action, search in searches
+        )
+    ]
+    recent = results.pop(1)
+    mods = dict(
+        (x["noteId"], x["mod"])
+        for response in client.stream(
+            {"action": "notesModTime", "params": {"notes": list(batch)}}
+            for batch in batched(recent, POLL_BATCH_SIZE)
+        )
+        for x in response["result"] or []
+        if x
+    )
+    return tuple(results), mods
+
+
+def anki_changed(old, new):
+    """Return whether notes were added, deleted or edited, or cards changed
+    state, between the `anki_change_signal`s `old` and `new`. Changes to the
+    scheduling of a card alone do not count.
+    """
+    if old is None:
+        return True
+    (old_ids, old_mods), (new_ids, new_mods) = old, new
+    # A note edited since `old` is among the recently edited notes of `new`,
+    # which `old` either has with an older modification time or, if it was
+    # last edited over a day before `old`, does not have.
+    return old_ids != new_ids or any(
+        old_mods.get(note_id) != mod for note_id, mod in new_mods.items()
+    )
+
+
+class Watcher:
+    """Runs the sync with the arguments `args` again whenever its Pocket
+    items or the Anki notes change.
+    """
+
+    def __init__(self, args):
+        from pockexport_to_anki import get_anki, get_anki_writes, get_pocket_client
+        from pockexport_to_anki.cache import CachedAnki
+        from pockexport_to_anki.state import SyncState
+
+        self.args = args
+        self.anki = get_anki()
+        self.anki_writes = get_anki_writes()
+        self.cached = isinstance(self.anki, CachedAnki)
+        # Poll Anki itself, since the read cache would answer with the
+        # modification times read by the last sync.
+        self.poll_client = self.anki.client if self.cached else self.anki
+        self.state = SyncState(args.state_db)
+        if args.from_pocket:
+            from pockexport_to_anki.pocket_source import PocketSource
+
+            self.source = PocketSource(get_pocket_client(), args.pocket_mirror)
+        else:
+            self.source = ExportSource(args.pockexport_data_file)
+        # `anki_change_signal` after the last sync, or as of the last poll.
+        self.anki_signal = None
+        # The `AnkiSnapshot` of the last sync, refreshed by the next one
+        # rather than fetched again. None to fetch it anew.
+        self.snapshot = None
+        self.last_full_sync = None
+        self.failed = False
+        # Set by `stop`, to end `run` after the sync in progress.
+        self.stopping = False
+        # Number of consecutive failed syncs or checks for changes.
+        self.errors = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._status = {
+            "status": "starting",
+            "syncs": 0,
+            "failures": 0,
+            "last_sync": None,
+            "last_success": None,
+        }
+
+    def run(self):
+        """Sync, then check for changes every `--watch-interval` seconds and
+        sync again, until stopped.
+        """
+        reason = "start"
+        while True:
+            if reason is not None:
+                self.sync(reason)
+            # The sync finishes what it planned when interrupted, so check
+            # whether it was.
+            if self.stopping:
+                return
+            interval = self.args.watch_interval
+            if self.errors:
+                interval = max(
+                    interval, min(interval * 2**self.errors, MAX_RETRY_INTERVAL)
+                )
+            self.sleep(interval)
+            if self.stopping:
+                return
+            try:
+                reason = self.poll()
+            except Exception as e:
+                logger.warning(f"Checking for changes failed: {e}")
+                self.errors += 1
+                reason = None
+            else:
+                if not self.failed:
+                    self.errors = 0
+
+    def stop(self, signum, frame):
+        """Signal handler for Ctrl-C and SIGTERM. Makes the sync in progress
+        stop planning, after the item being planned, and apply what it
+        planned, and `run` return after it.
+        """
+        # Raising here could interrupt a write, so only set the flag for the
+        # sync and `run` to check.
+        self.stopping = True
+
+    def sleep(self, seconds):
+        """Sleep for `seconds`, or until `stop` is called."""
+        deadline = time.monotonic() + seconds
+        while not self.stopping:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return
+            time.sleep(min(left, 1.0))
+
+    def poll(self):
+        """Return why a sync is needed, or None if nothing changed."""
+        if self.failed:
+            return "retry"
+        if (
+            self.last_full_sync is None
+            or time.monotonic() - self.last_full_sync >= FULL_SYNC_INTERVAL
+        ):
+            return "periodic"
+        if isinstance(self.source, ExportSource):
+            if self.source.changed():
+                return "export"
+        elif self.source.update():
+            return "pocket"
+        change_signal = anki_change_signal(
+            self.poll_client, self.args.mapping.note_type
+        )
+        changed = anki_changed(self.anki_signal, change_signal)
+        self.anki_signal = change_signal
+        return "anki" if changed else None
+
+    def sync(self, reason):
+        from pockexport_to_anki import sync
+        from pockexport_to_anki.journal import JournalError
+        from pockexport_to_anki.snapshot import AnkiSnapshot
+
+        full = reason in ("start", "periodic")
+        if full or self.snapshot is None:
+            # An empty snapshot, which the sync fetches in full.
+            self.snapshot = AnkiSnapshot(self.anki, self.args.mapping)
+        logger.info(f"Syncing ({reason})")
+        started = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            # Only a change in Pocket leaves the other items as they were.
+            sync(
+                self.args,
+                self.state,
+                self.source,
+                initial_sync=full,
+                all_items=reason != "pocket",
+                should_stop=lambda: self.stopping,
+                snapshot=self.snapshot,
+            )
+        except JournalError:
+            raise
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            logger.error(f"Sync failed: {error}")
+            logger.debug("Sync failure", exc_info=True)
+            # Drop what the failed sync left behind; the next one starts over.
+            self.anki_writes.discard()
+            self.snapshot = None
+            if self.cached:
+                self.anki.clear()
+        seconds = time.perf_counter() - start
+        # Only the first sync resumes the --journal.
+        self.args.resume = False
+        self.failed = error is not None
+        self.errors = self.errors + 1 if self.failed else 0
+        if full and not self.failed:
+            self.last_full_sync = time.monotonic()
+        # Take the changes made by the sync itself as the new baseline.
+        try:
+            self.anki_signal = anki_change_signal(
+                self.poll_client, self.args.mapping.note_type
+            )
+        except Exception as e:
+            logger.warning(f"Reading the Anki modification times failed: {e}")
+            self.anki_signal = None
+        self.limit_memory()
+        logger.info(
+            f"Sync ({reason}) {'failed' if error else 'done'} in {seconds:.2f}s"
+        )
+        with self._lock:
+            status = self._status
+            status["syncs"] += 1
+            status["last_sync"] = {
+                "reason": reason,
+                "started": started,
+                "seconds": seconds,
+                "error": error,
+            }
+            if error is None:
+                status["status"] = "ok"
+                status["failures"] = 0
+                status["last_success"] = started
+            else:
+                status["status"] = "failing"
+                status["failures"] += 1
+
+    def limit_memory(self):
+        """Drop the items and notes kept in memory if the process uses more
+        than `--watch-max-memory`.
+        """
+        rss = rss_bytes()
+        if rss is None or rss <= self.args.watch_max_memory * 1024 * 1024:
+            return
+        logger.warning(
+            f"Using {rss >> 20} MiB, dropping the items and notes kept in memory"
+        )
+        if isinstance(self.source, ExportSource):
+            self.source.drop()
+        self.snapshot = None
+        if self.cached:
+            self.anki.clear()
+        gc.collect()
+
+    def status(self):
+        """Return the status of the watcher, for the health endpoint."""
+        with self._lock:
+            status = dict(self._status)
+        status["uptime_seconds"] = time.time() - self.started
+        status["memory_bytes"] = rss_bytes()
+        return status
+
+    def close(self):
+        self.state.close()
+        if not isinstance(self.source, ExportSource):
+            self.source.close()
+
+
+def serve_health(port, watcher):
+    """Serve the status of `watcher` at `/health`, with status 503 while its
+    syncs fail, and the run metrics at `/metrics`, on localhost `port`, from
+    a background thread. Returns the server.
+    """
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def do_GET(self):
+            code = 200
+            if self.path == "/health":
+                body = watcher.status()
+                if body["status"] == "failing":
+                    code = 503
+            elif self.path == "/metrics":
+                body = metrics.to_dict()
+            else:
+                code = 404
+                body = {"error": "not found"}
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving health checks at http://127.0.0.1:{port}/health")
+    return server
+
+
+def watch(args):
+    """Sync with the arguments `args`, then again whenever something changes,
+    until interrupted or terminated.
+    """
+    watcher = Watcher(args)
+    server = None
+    if args.health_port is not None:
+        server = serve_health(args.health_port, watcher)
+    # Also stop when terminated, e.g. by a service manager.
+    signal.signal(signal.SIGINT, watcher.stop)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Stopped watching")
+        if server is not None:
+            server.shutdown()
+        watcher.close()
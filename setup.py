@@ -11,6 +11,7 @@ setup(
     entry_points={
         "console_scripts": [
             "pockexport-to-anki=pockexport_to_anki.__init__:main",
+            "pockexport-to-anki-store=pockexport_to_anki.store:main",
         ],
     },
 )
@@ -0,0 +1,242 @@
+import collections
+import json
+import os.path
+import sqlite3
+import sys
+import types
+
+import pytest
+
+# The fake AnkiConnect and Pocket APIs, and the synthetic data, are shared
+# with the benchmarks.
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "benchmarks")
+)
+
+import fake_pocket  # noqa: E402
+import pocket  # noqa: E402
+from fake_ankiconnect import FakeAnkiConnect, FakeCollection  # noqa: E402
+
+import pockexport_to_anki  # noqa: E402
+from pockexport_to_anki.ankiconnect import AnkiConnect  # noqa: E402
+from pockexport_to_anki.collection import (  # noqa: E402
+    FIELD_SEPARATOR,
+    _unicase,
+    field_checksum,
+    strip_html,
+)
+
+
+@pytest.fixture(autouse=True)
+def state_home(tmp_path, monkeypatch):
+    """Keep the state database, mirror, journal and read cache of each test
+    in its own directory.
+    """
+    path = tmp_path / "state"
+    monkeypatch.setenv("XDG_STATE_HOME", str(path))
+    return path
+
+
+@pytest.fixture
+def anki(monkeypatch):
+    """A fake AnkiConnect server, which `get_anki` talks to."""
+    server = FakeAnkiConnect(FakeCollection()).start()
+    monkeypatch.setattr(pockexport_to_anki, "_anki", AnkiConnect(server.url))
+    monkeypatch.setattr(pockexport_to_anki, "_anki_writes", None)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def pocket_api(monkeypatch):
+    """The fake Pocket API, which `get_pocket_client` talks to. Serves the
+    items put in `pocket_api.items`.
+    """
+    monkeypatch.setattr(pocket, "Pocket", pocket.Pocket)
+    monkeypatch.setattr(fake_pocket.FakePocket, "request_count", 0)
+    monkeypatch.setattr(fake_pocket.FakePocket, "actions", collections.Counter())
+    fake_pocket.install(dict())
+    monkeypatch.setattr(
+        pockexport_to_anki,
+        "_secrets",
+        types.SimpleNamespace(consumer_key="test", access_token="test"),
+    )
+    monkeypatch.setattr(pockexport_to_anki, "_pocket", None)
+    return fake_pocket.FakePocket
+
+
+@pytest.fixture
+def run(monkeypatch, anki, pocket_api):
+    """Return a function running pockexport-to-anki with the arguments
+    given, against the fake APIs.
+    """
+
+    def run(*args):
+        monkeypatch.setattr(sys, "argv", ["pockexport-to-anki"] + list(args))
+        monkeypatch.setattr(pockexport_to_anki, "_anki_writes", None)
+        pocket_api.actions.clear()
+        anki.actions.clear()
+        pockexport_to_anki.main()
+
+    return run
+
+
+LEGACY_SCHEMA = """
+CREATE TABLE col (
+    id integer PRIMARY KEY, crt integer NOT NULL, mod integer NOT NULL,
+    scm integer NOT NULL, ver integer NOT NULL, dty integer NOT NULL,
+    usn integer NOT NULL, ls integer NOT NULL, conf text NOT NULL,
+    models text NOT NULL, decks text NOT NULL, dconf text NOT NULL,
+    tags text NOT NULL
+);
+CREATE TABLE notes (
+    id integer PRIMARY KEY, guid text NOT NULL, mid integer NOT NULL,
+    mod integer NOT NULL, usn integer NOT NULL, tags text NOT NULL,
+    flds text NOT NULL, sfld integer NOT NULL, csum integer NOT NULL,
+    flags integer NOT NULL, data text NOT NULL
+);
+CREATE TABLE cards (
+    id integer PRIMARY KEY, nid integer NOT NULL, did integer NOT NULL,
+    ord integer NOT NULL, mod integer NOT NULL, usn integer NOT NULL,
+    type integer NOT NULL, queue integer NOT NULL, due integer NOT NULL,
+    ivl integer NOT NULL, factor integer NOT NULL, reps integer NOT NULL,
+    lapses integer NOT NULL, left integer NOT NULL, odue integer NOT NULL,
+    odid integer NOT NULL, flags integer NOT NULL, data text NOT NULL
+);
+"""
+# The tables of the current schema that replace the JSON in `col`.
+SCHEMA = """
+CREATE TABLE notetypes (
+    id integer NOT NULL PRIMARY KEY, name text NOT NULL COLLATE unicase,
+    mtime_secs integer NOT NULL, usn integer NOT NULL, config blob NOT NULL
+);
+CREATE TABLE fields (
+    ntid integer NOT NULL, ord integer NOT NULL,
+    name text NOT NULL COLLATE unicase, config blob NOT NULL,
+    PRIMARY KEY (ntid, ord)
+) WITHOUT ROWID;
+CREATE TABLE templates (
+    ntid integer NOT NULL, ord integer NOT NULL,
+    name text NOT NULL COLLATE unicase, mtime_secs integer NOT NULL,
+    usn integer NOT NULL, config blob NOT NULL, PRIMARY KEY (ntid, ord)
+) WITHOUT ROWID;
+CREATE TABLE decks (
+    id integer PRIMARY KEY NOT NULL, name text NOT NULL COLLATE unicase,
+    mtime_secs integer NOT NULL, usn integer NOT NULL, common blob NOT NULL,
+    kind blob NOT NULL
+);
+CREATE TABLE config (
+    KEY text NOT NULL PRIMARY KEY, usn integer NOT NULL,
+    mtime_secs integer NOT NULL, val blob NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE tags (
+    tag text NOT NULL PRIMARY KEY COLLATE unicase, usn integer NOT NULL,
+    collapsed boolean NOT NULL, config blob NULL
+) WITHOUT ROWID;
+"""
+
+
+@pytest.fixture
+def write_collection(tmp_path):
+    """Return a function writing the notes of a `FakeCollection` to an Anki
+    collection file, with the legacy schema or the current one, and
+    returning its path. The note types are given as a dict mapping name to
+    `(fields, sort_field)`.
+    """
+
+    def write_collection(fake, note_types, legacy=True, name="collection.anki2"):
+        path = str(tmp_path / name)
+        db = sqlite3.connect(path)
+        db.create_collation("unicase", _unicase)
+        db.executescript(LEGACY_SCHEMA)
+        mids = dict((name, i + 1) for i, name in enumerate(note_types))
+        dids = dict()
+        for card in fake.cards.values():
+            dids.setdefault(card["deckName"], len(dids) + 1)
+        models = dict(
+            (
+                str(mids[name]),
+                {
+                    "id": mids[name],
+                    "name": name,
+                    "type": 0,
+                    "sortf": sort_field,
+                    "flds": [{"name": f, "ord": i} for i, f in enumerate(fields)],
+                    "tmpls": [{"ord": 0}],
+                },
+            )
+            for name, (fields, sort_field) in note_types.items()
+        )
+        decks = dict(
+            (str(did), {"id": did, "name": name}) for name, did in dids.items()
+        )
+        db.execute(
+            "INSERT INTO col VALUES (1, 0, 0, 0, 11, 0, 0, 0, ?, ?, ?, '{}', '{}')",
+            (
+                json.dumps({"nextPos": len(fake.cards)}),
+                json.dumps(models),
+                json.dumps(decks),
+            ),
+        )
+        for note in fake.notes.values():
+            fields, sort_field = note_types[note["modelName"]]
+            values = [note["fields"].get(f, "") for f in fields]
+            db.execute(
+                "INSERT INTO notes VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?, 0, '')",
+                (
+                    note["noteId"],
+                    str(note["noteId"]),
+                    mids[note["modelName"]],
+                    note["mod"],
+                    f" {' '.join(note['tags'])} " if note["tags"] else "",
+                    FIELD_SEPARATOR.join(values),
+                    strip_html(values[sort_field]),
+                    field_checksum(values[0]),
+                ),
+            )
+        for card in fake.cards.values():
+            db.execute(
+                "INSERT INTO cards VALUES"
+                " (?, ?, ?, 0, ?, 0, ?, ?, ?, 0, 0, 0, 0, 0, 0, 0, 0, '')",
+                (
+                    card["cardId"],
+                    card["note"],
+                    dids[card["deckName"]],
+                    card["mod"],
+                    card["type"],
+                    card["queue"],
+                    card["due"],
+                ),
+            )
+        if not legacy:
+            db.executescript(SCHEMA)
+            for name, (fields, sort_field) in note_types.items():
+                # `Notetype.Config.sort_field_idx`, field 2, as a protobuf
+                # varint.
+                config = bytes([0x10, sort_field]) if sort_field else b""
+                db.execute(
+                    "INSERT INTO notetypes VALUES (?, ?, 0, 0, ?)",
+                    (mids[name], name, config),
+                )
+                db.executemany(
+                    "INSERT INTO fields VALUES (?, ?, ?, x'')",
+                    [(mids[name], i, f) for i, f in enumerate(fields)],
+                )
+                db.execute(
+                    "INSERT INTO templates VALUES (?, 0, 'Card 1', 0, 0, x'')",
+                    (mids[name],),
+                )
+            db.executemany(
+                "INSERT INTO decks VALUES (?, ?, 0, 0, x'', x'')",
+                [(did, name) for name, did in dids.items()],
+            )
+            db.execute(
+                "INSERT INTO config VALUES ('nextPos', 0, 0, ?)",
+                (json.dumps(len(fake.cards)).encode(),),
+            )
+            db.execute("UPDATE col SET ver = 18, models = '', decks = '', tags = ''")
+        db.commit()
+        db.close()
+        return path
+
+    return write_collection
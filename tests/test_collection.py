@@ -0,0 +1,74 @@
+import sqlite3
+
+import pytest
+from fake_ankiconnect import NOTE_FIELDS, FakeCollection
+
+from pockexport_to_anki.collection import AnkiCollection, _protobuf_int
+
+NOTE_TYPE = "Pocket Article"
+SORT_FIELD = NOTE_FIELDS.index("given_title")
+
+
+def test_protobuf_int():
+    # A string field 1, a fixed64 field 3 and the varint field 2, 300.
+    data = b"\x0a\x03abc" + b"\x19" + bytes(8) + b"\x10\xac\x02"
+    assert _protobuf_int(data, 2) == 300
+    assert _protobuf_int(data, 4) == 0
+    assert _protobuf_int(b"", 2) == 0
+
+
+@pytest.fixture(params=[True, False], ids=["legacy", "current"])
+def collection(request, write_collection):
+    fake = FakeCollection()
+    for i in range(3):
+        fake.add_note(
+            {
+                "item_id": str(i),
+                "given_url": f"https://example.com/{i}",
+                "given_title": f"Article {i}",
+            },
+            ["pocket"],
+        )
+    path = write_collection(fake, {NOTE_TYPE: (NOTE_FIELDS, SORT_FIELD)}, request.param)
+    collection = AnkiCollection(path, write=True)
+    yield fake, collection
+    collection.close()
+
+
+def sort_fields(collection):
+    with sqlite3.connect(collection.path) as db:
+        return dict(db.execute("SELECT id, sfld FROM notes"))
+
+
+def test_reads_match_ankiconnect(collection):
+    fake, collection = collection
+    note_ids = collection.invoke("findNotes", query=f'"note:{NOTE_TYPE}"')
+    assert note_ids == sorted(fake.notes)
+    infos = collection.invoke("notesInfo", notes=note_ids)
+    assert infos == [fake.invoke("notesInfo", {"notes": [i]})[0] for i in note_ids]
+
+
+def test_sort_field_of_note_type(collection):
+    fake, collection = collection
+    assert collection.note_types[NOTE_TYPE].sort_field == SORT_FIELD
+    (note_id,) = collection.invoke(
+        "addNotes",
+        notes=[
+            {
+                "deckName": fake.deck_name,
+                "modelName": NOTE_TYPE,
+                "fields": {
+                    "item_id": "9",
+                    "given_url": "https://example.com/9",
+                    "given_title": "<b>Added</b>",
+                },
+            }
+        ],
+    )
+    collection.invoke(
+        "updateNoteFields",
+        note={"id": sorted(fake.notes)[0], "fields": {"given_title": "Updated"}},
+    )
+    sort_values = sort_fields(collection)
+    assert sort_values[note_id] == "Added"
+    assert sort_values[sorted(fake.notes)[0]] == "Updated"
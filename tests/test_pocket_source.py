@@ -0,0 +1,100 @@
+import time
+
+import pocket
+import synthetic
+
+from pockexport_to_anki.pocket_source import DELETED_STATUS, PocketSource
+
+
+def item_ids(items):
+    return [item.item_id for item in items]
+
+
+def open_source(tmp_path):
+    return PocketSource(
+        pocket.Pocket("test", "test"), str(tmp_path / "mirror.sqlite3"), page_size=2
+    )
+
+
+def test_items_reads_changes_since_cursor(tmp_path, pocket_api):
+    pocket_api.items.update(synthetic.make_items(5))
+    source = open_source(tmp_path)
+    assert source.since is None
+    assert item_ids(source.items()) == sorted(pocket_api.items)
+    assert source.since is not None
+    source.done()
+
+    changed = sorted(pocket_api.items)[3]
+    time_updated = pocket_api.items[changed]["time_updated"]
+    pocket_api.items[changed]["time_updated"] = str(int(time.time()) + 60)
+    assert item_ids(source.items()) == [changed]
+    source.done()
+    pocket_api.items[changed]["time_updated"] = time_updated
+    assert item_ids(source.items()) == []
+    assert item_ids(source.items(full=True)) == sorted(pocket_api.items)
+    source.close()
+
+
+def test_cursor_and_changed_items_persist(tmp_path, pocket_api):
+    pocket_api.items.update(synthetic.make_items(3))
+    source = open_source(tmp_path)
+    list(source.items())
+    source.close()
+
+    source = open_source(tmp_path)
+    assert source.since is not None
+    assert item_ids(source.items()) == sorted(pocket_api.items)
+    source.close()
+
+
+def test_done_only_unmarks_yielded_items(tmp_path, pocket_api):
+    pocket_api.items.update(synthetic.make_items(4))
+    source = open_source(tmp_path)
+    items = source.items()
+    # The sync stopped after planning the first item.
+    first = next(items).item_id
+    items.close()
+    source.done()
+    assert item_ids(source.items()) == [
+        item_id for item_id in sorted(pocket_api.items) if item_id != first
+    ]
+    source.close()
+
+
+def test_done_keeps_failed_items_changed(tmp_path, pocket_api):
+    pocket_api.items.update(synthetic.make_items(3))
+    failed = sorted(pocket_api.items)[1]
+    source = open_source(tmp_path)
+    list(source.items())
+    source.done(failed_items={failed})
+    assert item_ids(source.items()) == [failed]
+    source.close()
+
+
+def test_deleted_items_are_removed(tmp_path, pocket_api):
+    pocket_api.items.update(synthetic.make_items(3))
+    deleted = sorted(pocket_api.items)[0]
+    source = open_source(tmp_path)
+    list(source.items())
+    source.done()
+
+    pocket_api.items[deleted].update(
+        status=DELETED_STATUS, time_updated=str(int(time.time()) + 60)
+    )
+    assert item_ids(source.items()) == []
+    assert deleted not in item_ids(source.items(full=True))
+    source.close()
+
+
+def test_dry_run_does_not_write_mirror(tmp_path, pocket_api):
+    pocket_api.items.update(synthetic.make_items(3))
+    source = PocketSource(
+        pocket.Pocket("test", "test"), str(tmp_path / "mirror.sqlite3"), dry_run=True
+    )
+    assert item_ids(source.items()) == sorted(pocket_api.items)
+    source.done()
+    source.close()
+
+    source = open_source(tmp_path)
+    assert source.since is None
+    source.close()
@@ -0,0 +1,116 @@
+import json
+
+import pocket
+import requests
+
+from pockexport_to_anki.pocket_writer import PocketWriter
+
+
+def response(status_code=200, body=None):
+    r = requests.Response()
+    r.status_code = status_code
+    r._content = json.dumps(body or dict()).encode()
+    return r
+
+
+class ScriptedPocket(pocket.Pocket):
+    """Pocket client answering `send` requests with `script`, a list of
+    functions of the actions sent, one per request, which return the
+    response or raise.
+    """
+
+    def __init__(self, script):
+        super().__init__("test", "test")
+        self.script = list(script)
+        self.sent = list()
+
+    def _post_request(self, url, payload, headers):
+        actions = json.loads(payload)["actions"]
+        self.sent.append([action["item_id"] for action in actions])
+        return self.script.pop(0)(actions)
+
+
+def ok(actions):
+    return response(
+        body={
+            "status": 1,
+            "action_results": [True] * len(actions),
+            "action_errors": [None] * len(actions),
+        }
+    )
+
+
+def fail_item(item_id):
+    def send(actions):
+        return response(
+            body={
+                "status": 1,
+                "action_results": [a["item_id"] != item_id for a in actions],
+                "action_errors": [
+                    {"message": "failed"} if a["item_id"] == item_id else None
+                    for a in actions
+                ],
+            }
+        )
+
+    return send
+
+
+def status(status_code):
+    return lambda actions: response(status_code)
+
+
+def connection_error(actions):
+    raise requests.ConnectionError("connection reset")
+
+
+def writer(client, **options):
+    w = PocketWriter(client, backoff=0, **options)
+    for item_id in (1, 2, 3):
+        w.add("archive", item_id=item_id)
+    return w
+
+
+def test_flush_sends_batches_in_order():
+    client = ScriptedPocket([ok, ok])
+    assert writer(client, batch_size=2).flush() == [(True, None)] * 3
+    assert client.sent == [[1, 2], [3]]
+
+
+def test_failed_actions_are_retried_alone():
+    client = ScriptedPocket([fail_item(2), ok])
+    assert writer(client).flush() == [(True, None)] * 3
+    assert client.sent == [[1, 2, 3], [2]]
+
+
+def test_actions_failing_every_attempt_are_reported():
+    client = ScriptedPocket([fail_item(2)] * 3)
+    outcomes = writer(client, retries=2).flush()
+    assert outcomes[0] == outcomes[2] == (True, None)
+    assert outcomes[1] == (False, {"message": "failed"})
+    assert client.sent == [[1, 2, 3], [2], [2]]
+
+
+def test_connection_errors_are_retried():
+    client = ScriptedPocket([connection_error, ok])
+    assert writer(client).flush() == [(True, None)] * 3
+    assert len(client.sent) == 2
+
+
+def test_connection_errors_fail_the_batch_after_retries():
+    client = ScriptedPocket([connection_error] * 2)
+    outcomes = writer(client, retries=1).flush()
+    assert [error for _, error in outcomes] == ["connection reset"] * 3
+
+
+def test_server_errors_are_retried():
+    client = ScriptedPocket([status(503), ok])
+    assert writer(client).flush() == [(True, None)] * 3
+    assert len(client.sent) == 2
+
+
+def test_forbidden_is_not_retried():
+    client = ScriptedPocket([status(403)])
+    outcomes = writer(client).flush()
+    assert all(result is False and error for result, error in outcomes)
+    assert len(client.sent) == 1
@@ -0,0 +1,113 @@
+import random
+
+import pytest
+
+from pockexport_to_anki.model import NewCard
+from pockexport_to_anki.reorder import (
+    DUE_LIMIT,
+    STRATEGIES,
+    due_updates,
+    make_rng,
+    order_new_cards,
+)
+
+
+def cards_with_dues(dues):
+    return [NewCard(i, 1000 + i, due, frozenset()) for i, due in enumerate(dues)]
+
+
+def apply(card_order, updates):
+    """Return the due positions along `card_order` once `updates` are
+    written.
+    """
+    updates = dict(updates)
+    return [updates.get(card.card_id, card.due) for card in card_order]
+
+
+def assert_in_order(dues):
+    assert all(0 <= due < DUE_LIMIT for due in dues)
+    assert all(a < b for a, b in zip(dues, dues[1:]))
+
+
+def test_ordered_cards_are_not_moved():
+    assert due_updates(cards_with_dues([0, 3, 4, 10, 999])) == []
+
+
+def test_added_card_moves_alone_when_there_is_room():
+    card_order = cards_with_dues([0, 10, 20, 5000, 30, 40])
+    updates = due_updates(card_order)
+    assert [card_id for card_id, _ in updates] == [3]
+    assert_in_order(apply(card_order, updates))
+
+
+def test_moved_cards_leave_room_for_the_next():
+    card_order = cards_with_dues(range(100))
+    card_order.insert(25, NewCard(100, 0, None, frozenset()))
+    updates = due_updates(card_order)
+    # There is no room between consecutive positions, so the cards after
+    # the added one are spread up to the limit.
+    assert 1 < len(updates) <= 76
+    dues = apply(card_order, updates)
+    assert_in_order(dues)
+
+    card_order = cards_with_dues(dues)
+    card_order.insert(60, NewCard(101, 0, None, frozenset()))
+    updates = due_updates(card_order)
+    assert [card_id for card_id, _ in updates] == [101]
+    assert_in_order(apply(card_order, updates))
+
+
+@pytest.mark.parametrize("due", [None, -1, DUE_LIMIT, DUE_LIMIT + 5])
+def test_missing_or_out_of_range_dues_are_replaced(due):
+    card_order = cards_with_dues([1, due, 7])
+    updates = due_updates(card_order)
+    assert [card_id for card_id, _ in updates] == [1]
+    assert_in_order(apply(card_order, updates))
+
+
+def test_any_order_comes_out_in_order():
+    rng = random.Random(0)
+    for _ in range(50):
+        n = rng.randint(1, 60)
+        dues = [rng.choice([None, rng.randint(0, 80)]) for _ in range(n)]
+        card_order = cards_with_dues(dues)
+        rng.shuffle(card_order)
+        assert_in_order(apply(card_order, due_updates(card_order)))
+
+
+def test_mixed_order_is_stable():
+    cards = [NewCard(i, 1000 + i * 60, None, frozenset()) for i in range(200)]
+    order = order_new_cards(cards, make_rng(), "mixed")
+    updates = dict(due_updates(order))
+    cards = [card._replace(due=updates[card.card_id]) for card in cards]
+    # Without a seed, the next sync keeps the order.
+    assert due_updates(order_new_cards(cards, make_rng(), "mixed")) == []
+
+    # An added card moves it and at most a few others.
+    cards.append(NewCard(200, 1000 + 200 * 60, 200, frozenset()))
+    new_order = order_new_cards(cards, make_rng(), "mixed")
+    assert [card.card_id for card in new_order if card.card_id != 200] == [
+        card.card_id for card in order
+    ]
+    assert len(due_updates(new_order)) <= 3
+
+
+def test_mixed_order_depends_on_seed():
+    cards = [NewCard(i, 1000 + i * 60, None, frozenset()) for i in range(200)]
+    orders = [
+        [card.card_id for card in order_new_cards(cards, make_rng(), seed=seed)]
+        for seed in (None, 1, 1)
+    ]
+    assert orders[0] != orders[1] == orders[2]
+
+
+@pytest.mark.parametrize("strategy", sorted(STRATEGIES))
+def test_strategies_order_every_card(strategy):
+    cards = [NewCard(i, 1000 + i * 60, i, frozenset()) for i in range(100)]
+    order = order_new_cards(cards, make_rng(0), strategy)
+    assert sorted(card.card_id for card in order) == list(range(100))
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        order_new_cards([], make_rng(), "alphabetical")
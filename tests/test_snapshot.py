@@ -0,0 +1,77 @@
+import time
+
+import pytest
+from fake_ankiconnect import NOTE_FIELDS
+
+from pockexport_to_anki.ankiconnect import AnkiConnect
+from pockexport_to_anki.collection import AnkiCollection
+from pockexport_to_anki.model import AnkiCard, CardStates
+from pockexport_to_anki.snapshot import classify_cards
+
+NOTE_TYPE = "Pocket Article"
+# Every `(type, queue)` a card can have.
+CARD_KINDS = [
+    (0, 0),
+    (0, -1),
+    (0, -2),
+    (0, -3),
+    (1, 1),
+    (1, 3),
+    (1, -1),
+    (1, -2),
+    (2, 2),
+    (2, -1),
+    (2, -2),
+    (2, -3),
+    (3, 1),
+    (3, 3),
+    (3, -1),
+    (3, -2),
+]
+
+
+def states(card_states):
+    return card_states.review, card_states.suspended, card_states.new
+
+
+@pytest.fixture
+def backends(anki, write_collection):
+    """Fill the fake collection with a card of each kind, some of whose notes
+    were edited a week ago, and return an AnkiConnect client for it and an
+    `AnkiCollection` with the same cards, in each schema.
+    """
+    week_ago = int(time.time()) - 7 * 86400
+    for i, (card_type, queue) in enumerate(CARD_KINDS * 2):
+        anki.collection.add_note(
+            {"item_id": str(i), "given_url": f"https://example.com/{i}"},
+            card_type=card_type,
+            queue=queue,
+            mod=week_ago if i % 2 else None,
+        )
+    note_types = {NOTE_TYPE: (NOTE_FIELDS, 0)}
+    return [
+        AnkiConnect(anki.url),
+        AnkiCollection(write_collection(anki.collection, note_types)),
+        AnkiCollection(
+            write_collection(anki.collection, note_types, False, "new.anki2")
+        ),
+    ]
+
+
+def expected_states(anki, edited=None):
+    card_states = CardStates()
+    cutoff = time.time() - edited * 86400 if edited else 0
+    for card_id, card in anki.collection.cards.items():
+        if anki.collection.notes[card["note"]]["mod"] < cutoff:
+            continue
+        info = anki.collection.invoke("cardsInfo", {"cards": [card_id]})[0]
+        card_states.add(AnkiCard.from_info(info, "time_added"))
+    return card_states
+
+
+@pytest.mark.parametrize("edited", [None, 1])
+def test_classify_cards_matches_card_states(anki, backends, edited):
+    expected = expected_states(anki, edited)
+    assert expected.review and expected.suspended and expected.new
+    for client in backends:
+        assert states(classify_cards(client, NOTE_TYPE, edited)) == states(expected)
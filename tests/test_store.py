@@ -0,0 +1,83 @@
+import pytest
+import synthetic
+
+from pockexport_to_anki.export import iter_changed_items, iter_export_items
+from pockexport_to_anki.store import (
+    ExportStore,
+    convert_export,
+    is_export_store,
+)
+
+
+def states(items):
+    return [item.__getstate__() for item in items]
+
+
+@pytest.fixture
+def exports(tmp_path):
+    """Write an old and a current export, as JSON files and as export stores,
+    and return their paths: `(old_json, old_store, json, store)`.
+    """
+    old_items = synthetic.make_items(300)
+    items = synthetic.mutate_items(old_items, 0.1, seed=1)
+    del items[sorted(items)[7]]
+    added = synthetic.make_items(320, seed=2)
+    items.update((item_id, added[item_id]) for item_id in sorted(added)[300:])
+    paths = list()
+    for name, export_items in (("old", old_items), ("new", items)):
+        path = str(tmp_path / f"{name}.json")
+        synthetic.write_export(path, export_items)
+        store_path = str(tmp_path / f"{name}.pxstore")
+        assert convert_export(path, store_path) == len(export_items)
+        paths.extend([path, store_path])
+    return paths
+
+
+def test_store_round_trip(exports):
+    _, _, path, store_path = exports
+    assert is_export_store(store_path) and not is_export_store(path)
+    with ExportStore(store_path) as store:
+        assert states(store.items()) == states(iter_export_items(path))
+        assert len(store) == len(list(store.index()))
+
+
+def test_index_is_sorted_by_item_id(exports):
+    with ExportStore(exports[3]) as store:
+        item_ids = [item_id for item_id, _ in store.index()]
+    assert item_ids == sorted(item_ids)
+
+
+def test_changed_since(exports):
+    old_path, old_store_path, path, store_path = exports
+    expected = states(iter_changed_items(path, old_path))
+    # The items changed by `mutate_items`, and the added ones.
+    assert len(expected) == 30 + 20
+    with ExportStore(store_path) as store, ExportStore(old_store_path) as old:
+        assert states(store.changed_since(old)) == expected
+    # Also when only one side is a store.
+    assert states(iter_changed_items(store_path, old_path)) == expected
+    assert states(iter_changed_items(path, old_store_path)) == expected
+
+
+def test_unchanged_export(exports):
+    _, _, _, store_path = exports
+    with ExportStore(store_path) as store, ExportStore(store_path) as old:
+        assert list(store.changed_since(old)) == []
+
+
+def test_close_with_live_iterators(exports):
+    store = ExportStore(exports[3])
+    items = store.items()
+    index = store.index()
+    next(items)
+    next(index)
+    store.close()
+
+
+def test_non_numeric_item_id(tmp_path):
+    path = str(tmp_path / "export.json")
+    items = synthetic.make_items(2)
+    items["abc"] = dict(items.popitem()[1], item_id="abc")
+    synthetic.write_export(path, items)
+    with pytest.raises(ValueError):
+        convert_export(path, str(tmp_path / "export.pxstore"))
@@ -0,0 +1,75 @@
+import synthetic
+from fake_ankiconnect import AnkiConnectError
+
+from pockexport_to_anki.state import SyncState
+
+
+def stale_notes(collection):
+    """Return the IDs of the notes whose title differs from their item's."""
+    return set(
+        note_id
+        for note_id, note in collection.notes.items()
+        if note["fields"]["given_title"].endswith(" (old)")
+    )
+
+
+def setup_sync(tmp_path, anki, n=60):
+    items = synthetic.make_items(n)
+    export_path = str(tmp_path / "export.json")
+    synthetic.write_export(export_path, items)
+    synthetic.populate_collection(anki.collection, items, anki_only=0)
+    assert stale_notes(anki.collection)
+    return items, export_path
+
+
+def test_sync_updates_notes(tmp_path, anki, run):
+    items, export_path = setup_sync(tmp_path, anki)
+    run(export_path)
+    assert not stale_notes(anki.collection)
+    item_ids = set(
+        note["fields"]["item_id"] for note in anki.collection.notes.values()
+    )
+    assert item_ids == set(items)
+
+
+def test_state_db_skips_unchanged_items(tmp_path, anki, pocket_api, run):
+    items, export_path = setup_sync(tmp_path, anki)
+    state_path = str(tmp_path / "state.sqlite3")
+    run(export_path, "--state-db", state_path)
+    assert anki.actions["updateNoteFields"]
+    state = SyncState(state_path)
+    assert set(state.items) == set(items)
+    state.close()
+
+    run(export_path, "--state-db", state_path)
+    assert anki.actions["updateNoteFields"] == 0
+    assert anki.actions["addNotes"] == 0
+    assert anki.actions["addTags"] == anki.actions["removeTags"] == 0
+    assert not pocket_api.actions
+
+
+def test_state_db_retries_failed_items(tmp_path, anki, run, monkeypatch):
+    items, export_path = setup_sync(tmp_path, anki)
+    failing = min(stale_notes(anki.collection))
+    failing_item = anki.collection.notes[failing]["fields"]["item_id"]
+    update_fields = anki.collection._update_fields
+
+    def fail_once(note_id, fields):
+        if note_id == failing:
+            raise AnkiConnectError("collection is busy")
+        update_fields(note_id, fields)
+
+    monkeypatch.setattr(anki.collection, "_update_fields", fail_once)
+    state_path = str(tmp_path / "state.sqlite3")
+    run(export_path, "--state-db", state_path)
+    assert stale_notes(anki.collection) == {failing}
+    state = SyncState(state_path)
+    assert set(state.items) == set(items) - {failing_item}
+    state.close()
+
+    monkeypatch.setattr(anki.collection, "_update_fields", update_fields)
+    run(export_path, "--state-db", state_path)
+    assert not stale_notes(anki.collection)
+    state = SyncState(state_path)
+    assert set(state.items) == set(items)
+    state.close()